@@ -0,0 +1,196 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from collections import deque
+
+import ipaddress
+import json
+import logging
+import os
+import time
+
+import bley.helpers
+
+logger = logging.getLogger('bley')
+
+
+class ActionLog(object):
+    '''Bounded queue of the actions taken by bley.
+
+    The actions are kept as tuples in the column order of bley_log and are
+    written to the database every log_flush_interval seconds, in
+    transactions of at most BATCH_SIZE rows.
+    When the queue is full, new actions are either dropped or spilled
+    to log_spill_file, depending on log_overflow.
+    '''
+
+    BATCH_SIZE = 500
+    COLUMNS = ('logtime', 'ip', 'sender', 'recipient', 'action',
+               'check_dnswl', 'check_dnsbl', 'check_helo', 'check_dyn',
+               'check_db', 'check_spf', 'check_s_eq_r', 'check_postmaster',
+               'check_cache')
+
+    __INSERT_QUERY = 'INSERT INTO bley_log (%s) VALUES(%s)' % (
+        ', '.join(COLUMNS), ', '.join(['%s'] * len(COLUMNS)))
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.queue = deque()
+        self.lock = defer.DeferredLock()
+        self.flusher = task.LoopingCall(self.flush)
+        self.dropped = 0
+        self.spilled = 0
+        self.written = 0
+        self.flushes = 0
+        self.flush_duration = 0.0
+        self.flush_duration_max = 0.0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def start(self):
+        self.flusher.start(self.settings.log_flush_interval, now=False)
+
+    def append(self, row):
+        '''Queue an action for writing.
+
+        @type  row: tuple
+        @param row: the values for the columns in C{COLUMNS}
+        '''
+        if len(self.queue) < self.settings.log_queue_size:
+            self.queue.append(row)
+        elif self.settings.log_overflow == 'spill':
+            self.spill([row])
+        else:
+            self.dropped += 1
+
+    def spill(self, rows):
+        '''Append rows to the spill file, to be written by the next flush.'''
+        try:
+            with open(self.settings.log_spill_file, 'a') as spill_fh:
+                for row in rows:
+                    spill_fh.write(json.dumps(row) + '\n')
+            self.spilled += len(rows)
+        except (OSError, IOError) as e:
+            logger.warning('Could not spill the action log: %s' % e)
+            self.dropped += len(rows)
+
+    def _read_spill(self):
+        try:
+            with open(self.settings.log_spill_file) as spill_fh:
+                rows = [tuple(json.loads(line)) for line in spill_fh if line.strip()]
+            os.remove(self.settings.log_spill_file)
+        except (OSError, IOError):
+            return []
+        return rows
+
+    def flush(self):
+        '''Write all queued actions to bley_log.
+
+        @rtype: C{Deferred}
+        @return: fires when all queued actions are written
+        '''
+        return self.lock.run(self._flush)
+
+    @defer.inlineCallbacks
+    def _flush(self):
+        rows = list(self.queue)
+        self.queue.clear()
+        if self.settings.log_overflow == 'spill':
+            rows.extend(self._read_spill())
+        if self.settings.compact_ip:
+            rows = self._drop_malformed(rows)
+        if not rows:
+            return
+        start = time.monotonic()
+        written = 0
+        try:
+            while written < len(rows):
+                batch = rows[written:written + self.BATCH_SIZE]
+                yield self.settings.dbpool.runInteraction(self._write, batch)
+                written += len(batch)
+        except Exception as e:
+            logger.warning('SQL error: %s' % e)
+            self._requeue(rows[written:])
+        self.written += written
+        self.flushes += 1
+        self.flush_duration = time.monotonic() - start
+        self.flush_duration_max = max(self.flush_duration_max,
+                                      self.flush_duration)
+        if self.settings.verbose:
+            logger.info('wrote %i actions to the database in %.3f seconds' %
+                        (written, self.flush_duration))
+
+    def _drop_malformed(self, rows):
+        '''Drop the rows whose client address can not be stored compactly.
+
+        Otherwise every batch holding such a row would fail, be requeued
+        and fail again, until the queue is full.
+        '''
+        valid = []
+        for row in rows:
+            try:
+                ipaddress.ip_address(row[1])
+            except ValueError:
+                logger.warning('Dropping action for malformed client address %r' % (row[1],))
+                self.dropped += 1
+                continue
+            valid.append(row)
+        return valid
+
+    def _requeue(self, rows):
+        free = max(self.settings.log_queue_size - len(self.queue), 0)
+        self.queue.extendleft(reversed(rows[:free]))
+        if len(rows) > free:
+            if self.settings.log_overflow == 'spill':
+                self.spill(rows[free:])
+            else:
+                self.dropped += len(rows) - free
+
+    def _write(self, txn, rows):
+        query = self.__INSERT_QUERY
+        if self.settings.dbtype == 'sqlite3':
+            query = bley.helpers.adapt_query_for_sqlite3(query)
+        if self.settings.compact_ip:
+            rows = [(row[0], bley.helpers.pack_ip(self.settings, row[1])) + tuple(row[2:])
+                    for row in rows]
+        txn.executemany(query, rows)
+
+    def stats(self):
+        '''Return the size of the queue and the counters of the log.
+
+        @rtype: dict
+        '''
+        return {'queued': len(self.queue), 'written': self.written,
+                'dropped': self.dropped, 'spilled': self.spilled,
+                'flushes': self.flushes,
+                'flush_duration': self.flush_duration,
+                'flush_duration_max': self.flush_duration_max}
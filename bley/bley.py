@@ -27,23 +27,34 @@
 
 from twisted.internet.protocol import Factory
 from twisted.names import client
+from twisted.names import error
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.enterprise import adbapi
+from twisted.python.threadpool import ThreadPool
 
 import datetime
+import json
 import logging
-import re
+import os
+import time
 
 import bley.helpers
 from bley.postfix import PostfixPolicy
+from bley.store import TripletStore
+from bley.cache import Cache
+from bley.sharedcache import SharedVerdictCache, GOOD, BAD
+from bley.actionlog import ActionLog
+from bley.stats import StatsRollup
+from bley.metrics import Metrics
 
 from configparser import ConfigParser
-from time import sleep
 
 import ipaddress
 
 logger = logging.getLogger('bley')
-regexp_type = type(re.compile(''))
 
 
 DEFAULT_CONFIG = {
@@ -59,12 +70,18 @@ DEFAULT_CONFIG = {
     'dbpath': '',
     'dbname': 'bley.db',
     'dbport': '0',
+    'db_pool_size': '5',
+    'db_reconnect_max': '60',
+    'db_failure_action': 'DUNNO',
+    'memory_store': 'false',
+    'memory_store_flush': '60',
     'whitelist_recipients_file': './whitelist_recipients',
     'whitelist_clients_file': './whitelist_clients',
     'dnsbls': 'ix.dnsbl.manitu.net, dnsbl.sorbs.net',
     'dnswls': 'list.dnswl.org',
     'dnswl_threshold': '1',
     'dnsbl_threshold': '1',
+    'dnsl_timeout': '5',
     'rfc_threshold': '2',
     'greylist_period': '29',
     'greylist_max': '720',
@@ -73,13 +90,43 @@ DEFAULT_CONFIG = {
     'purge_bad_days': '10',
     'use_spf': '1',
     'use_spf_guess': '0',
+    'spf_timeout': '10',
+    'spf_threads': '4',
     'exim_workaround': 'false',
     'cache_valid': '60',
+    'cache_size': '100000',
+    'dns_cache_size': '10000',
+    'log_flush_interval': '60',
+    'log_queue_size': '100000',
+    'log_overflow': 'drop',
+    'log_spill_file': 'bley_log.spill',
     'greylist_header': 'X-Greylist: delayed %(delta)s seconds by bley-%(version)s at %(hostname)s; %(date)s',
+    'reload_interval': '0',
+    'workers': '1',
+    'shared_cache_file': '',
+    'shared_cache_slots': '65536',
+    'cache_snapshot_file': '',
+    'compact_ip': 'false',
+    'purge_log_days': '0',
+    'purge_batch_size': '1000',
+    'log_partitions': 'false',
+    'aggregate_ipv4_prefix': '32',
+    'aggregate_ipv6_prefix': '128',
+    'metrics_addr': '127.0.0.1',
+    'metrics_port': '0',
     'destdir': 'stats',
 }
 
 
+STATUS_QUERIES = {
+    'insert': "INSERT INTO bley_status (ip, status, last_action, sender, recipient) VALUES(%(client_address)s, %(new_status)s, %(now)s, %(sender)s, %(recipient)s) ON CONFLICT (ip, sender, recipient) DO NOTHING",
+    'ungrey': "UPDATE bley_status SET status=0, last_action=%(now)s WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s",
+    'fail': "UPDATE bley_status SET fail_count=fail_count+1 WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s",
+    'touch': "UPDATE bley_status SET last_action=%(now)s WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s",
+}
+STATUS_QUERIES_MYSQL = dict(STATUS_QUERIES, insert="INSERT INTO bley_status (ip, status, last_action, sender, recipient) VALUES(%(client_address)s, %(new_status)s, %(now)s, %(sender)s, %(recipient)s) ON DUPLICATE KEY UPDATE ip=ip")
+
+
 def parse_config(conffile):
     config = ConfigParser(DEFAULT_CONFIG)
     if conffile:
@@ -93,8 +140,6 @@ def parse_config(conffile):
 class BleyPolicy(PostfixPolicy):
     '''Implementation of intelligent greylisting based on `PostfixPolicy`'''
 
-    db = None
-    dbc = None
     required_params = ['sender', 'recipient', 'client_address',
                        'client_name', 'helo_name']
 
@@ -121,18 +166,13 @@ class BleyPolicy(PostfixPolicy):
         @param postfix_params: parameters we got from Postfix
         '''
 
-        if not self.db:
-            self.db = self.factory.settings.db
-            try:
-                self.dbc = self.db.cursor()
-            except Exception:
-                self.safe_reconnect()
-
         check_results = {'DNSWL': 0, 'DNSBL': 0, 'HELO': 0, 'DYN': 0, 'DB': -1,
                          'SPF': 0, 'S_EQ_R': 0, 'WHITELISTED': 0, 'CACHE': 0}
         action = 'DUNNO'
         self.params['now'] = datetime.datetime.now()
         postfix_params = self.params
+        metrics = self.factory.metrics
+        start = metrics.clock()
 
         # sanitize sender and recipient parameters
         for param in ('sender', 'recipient'):
@@ -145,91 +185,88 @@ class BleyPolicy(PostfixPolicy):
             if len(postfix_params[param]) > 254:
                 postfix_params[param] = postfix_params[param][:254]
 
-        if postfix_params['client_address'] in self.factory.bad_cache.keys():
-            delta = datetime.datetime.now() - self.factory.bad_cache[postfix_params['client_address']]
-            if delta < datetime.timedelta(0, self.factory.settings.cache_valid, 0):
+        client_key = self.client_key(postfix_params['client_address'])
+        with metrics.timer('cache'):
+            if self.factory.bad_cache.get(client_key):
                 action = 'DEFER_IF_PERMIT %s (cached result)' % self.factory.settings.reject_msg
                 check_results['CACHE'] = 1
-                if self.factory.settings.verbose:
-                    logger.info('decided CACHED action=%s, checks: %s, postfix: %s' %
-                                (action, check_results, postfix_params))
-                else:
-                    logger.info('decided CACHED action=%s, from=%s, to=%s' %
-                                (action, postfix_params['sender'],
-                                 postfix_params['recipient']))
-                self.send_action(action)
-                self.factory.log_action(postfix_params, action, check_results)
-                return
-            else:
-                del self.factory.bad_cache[postfix_params['client_address']]
-
-        if postfix_params['client_address'] in self.factory.good_cache.keys():
-            delta = datetime.datetime.now() - self.factory.good_cache[postfix_params['client_address']]
-            if delta < datetime.timedelta(0, self.factory.settings.cache_valid, 0):
+            elif self.factory.good_cache.get(client_key):
                 action = 'DUNNO'
                 check_results['CACHE'] = 1
-                if self.factory.settings.verbose:
-                    logger.info('decided CACHED action=%s, checks: %s, postfix: %s' %
-                                (action, check_results, postfix_params))
-                else:
-                    logger.info('decided CACHED action=%s, from=%s, to=%s' %
-                                (action, postfix_params['sender'],
-                                 postfix_params['recipient']))
-                self.send_action(action)
-                self.factory.log_action(postfix_params, action, check_results)
-                return
+        if check_results['CACHE']:
+            if self.factory.settings.verbose:
+                logger.info('decided CACHED action=%s, checks: %s, postfix: %s' %
+                            (action, check_results, postfix_params))
             else:
-                del self.factory.good_cache[postfix_params['client_address']]
-
-        status = self.check_local_db(postfix_params)
+                logger.info('decided CACHED action=%s, from=%s, to=%s' %
+                            (action, postfix_params['sender'],
+                             postfix_params['recipient']))
+            self.send_action(action)
+            self.factory.log_action(postfix_params, action, check_results)
+            metrics.decision('cached', start)
+            return
+
+        with metrics.timer('whitelist'):
+            whitelisted = (self.check_whitelist(postfix_params['recipient'].lower(),
+                                                self.factory.settings.whitelist_recipients)
+                           or self.check_whitelist(postfix_params['client_name'].lower(),
+                                                   self.factory.settings.whitelist_clients)
+                           or self.check_whitelist_ip(postfix_params['client_address'].lower(),
+                                                      self.factory.settings.whitelist_clients_ip))
+        # whitelisted mail is let through whatever the database says,
+        # so it is not looked up there
+        if not whitelisted:
+            with metrics.timer('db'):
+                status = yield self.check_local_db(postfix_params)
+        # None: database not available
         # -1 : not found
         #  0 : regular host, not in black, not in white, let it go
         #  1 : regular host, but in white, let it go, dont check EHLO
         #  2 : regular host, but in black, lets grey for now
-        if self.check_whitelist(postfix_params['recipient'].lower(),
-                                self.factory.settings.whitelist_recipients):
-            action = 'DUNNO'
-            check_results['WHITELISTED'] = 1
-        elif self.check_whitelist(postfix_params['client_name'].lower(),
-                                  self.factory.settings.whitelist_clients):
-            action = 'DUNNO'
-            check_results['WHITELISTED'] = 1
-        elif self.check_whitelist_ip(postfix_params['client_address'].lower(),
-                                     self.factory.settings.whitelist_clients_ip):
+        if whitelisted:
             action = 'DUNNO'
             check_results['WHITELISTED'] = 1
+            path = 'whitelisted'
+        elif status is None:  # database not available
+            action = self.factory.settings.db_failure_action
+            path = 'db_unavailable'
         elif status == -1:  # not found in local db...
-            check_results['DNSWL'] = yield self.check_dnswls(postfix_params['client_address'], self.factory.settings.dnswl_threshold)
+            path = 'new'
+            with metrics.timer('dnswl'):
+                check_results['DNSWL'] = yield self.check_dnswls(postfix_params['client_address'], self.factory.settings.dnswl_threshold)
             if check_results['DNSWL'] >= self.factory.settings.dnswl_threshold:
                 new_status = 1
             else:
-                check_results['DNSBL'] = yield self.check_dnsbls(postfix_params['client_address'], self.factory.settings.dnsbl_threshold)
-                check_results['HELO'] = bley.helpers.check_helo(postfix_params)
-                check_results['DYN'] = bley.helpers.check_dyn_host(postfix_params['client_name'])
+                with metrics.timer('dnsbl'):
+                    check_results['DNSBL'] = yield self.check_dnsbls(postfix_params['client_address'], self.factory.settings.dnsbl_threshold)
+                with metrics.timer('helo'):
+                    check_results['HELO'] = bley.helpers.check_helo(postfix_params)
+                    check_results['DYN'] = bley.helpers.check_dyn_host(postfix_params['client_name'])
                 # check_sender_eq_recipient:
                 if postfix_params['sender'] == postfix_params['recipient']:
                     check_results['S_EQ_R'] = 1
                 if self.factory.settings.use_spf and check_results['DNSBL'] < self.factory.settings.dnsbl_threshold and check_results['HELO'] + check_results['DYN'] + check_results['S_EQ_R'] < self.factory.settings.rfc_threshold:
-                    check_results['SPF'] = bley.helpers.check_spf(postfix_params, self.factory.settings.use_spf_guess)
+                    with metrics.timer('spf'):
+                        check_results['SPF'] = yield self.check_spf(postfix_params)
                 else:
                     check_results['SPF'] = 0
                 if check_results['DNSBL'] >= self.factory.settings.dnsbl_threshold or check_results['HELO'] + check_results['DYN'] + check_results['SPF'] + check_results['S_EQ_R'] >= self.factory.settings.rfc_threshold:
                     new_status = 2
                     action = 'DEFER_IF_PERMIT %s' % self.factory.settings.reject_msg
-                    self.factory.bad_cache[postfix_params['client_address']] = datetime.datetime.now()
+                    self.factory.bad_cache.set(client_key)
                 else:
                     new_status = 0
-                    self.factory.good_cache[postfix_params['client_address']] = datetime.datetime.now()
-            query = "INSERT INTO bley_status (ip, status, last_action, sender, recipient) VALUES(%(client_address)s, %(new_status)s, %(now)s, %(sender)s, %(recipient)s)"
+                    self.factory.good_cache.set(client_key)
             postfix_params['new_status'] = new_status
             try:
-                self.safe_execute(query, postfix_params)
+                with metrics.timer('db_update'):
+                    yield self.update_local_db(postfix_params, 'insert')
             except Exception:
-                # the other thread already commited while we checked, ignore
-                pass
+                logger.info('could not update the database.')
 
         elif status[0] >= 2:  # found to be greyed
             check_results['DB'] = status[0]
+            path = 'greyed'
             delta = datetime.datetime.now() - status[1]
             if delta > self.factory.settings.greylist_period + status[2] * self.factory.settings.greylist_penalty or delta > self.factory.settings.greylist_max:
                 if self.factory.settings.greylist_header:
@@ -238,20 +275,28 @@ class BleyPolicy(PostfixPolicy):
                     action = 'PREPEND %s' % header
                 else:
                     action = 'DUNNO'
-                query = "UPDATE bley_status SET status=0, last_action=%(now)s WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s"
-                self.factory.good_cache[postfix_params['client_address']] = datetime.datetime.now()
+                operation = 'ungrey'
+                self.factory.good_cache.set(client_key)
             else:
                 action = 'DEFER_IF_PERMIT %s' % self.factory.settings.reject_msg
-                query = "UPDATE bley_status SET fail_count=fail_count+1 WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s"
-                self.factory.bad_cache[postfix_params['client_address']] = datetime.datetime.now()
-            self.safe_execute(query, postfix_params)
+                operation = 'fail'
+                self.factory.bad_cache.set(client_key)
+            try:
+                with metrics.timer('db_update'):
+                    yield self.update_local_db(postfix_params, operation)
+            except Exception:
+                logger.info('could not update the database.')
 
         else:  # found to be clean
             check_results['DB'] = status[0]
             action = 'DUNNO'
-            query = "UPDATE bley_status SET last_action=%(now)s WHERE ip=%(client_address)s AND sender=%(sender)s AND recipient=%(recipient)s"
-            self.safe_execute(query, postfix_params)
-            self.factory.good_cache[postfix_params['client_address']] = datetime.datetime.now()
+            path = 'known_good'
+            try:
+                with metrics.timer('db_update'):
+                    yield self.update_local_db(postfix_params, 'touch')
+            except Exception:
+                logger.info('could not update the database.')
+            self.factory.good_cache.set(client_key)
 
         if self.factory.settings.verbose:
             logger.info('decided action=%s, checks: %s, postfix: %s' %
@@ -262,11 +307,12 @@ class BleyPolicy(PostfixPolicy):
                          postfix_params['recipient']))
         self.factory.log_action(postfix_params, action, check_results)
         self.send_action(action)
+        metrics.decision(path, start)
 
     def check_whitelist(self, email, whitelist):
         '''Check the arg email against a whitelist
-        The whitelist consists of strings or compiled regular expressions
-        from the whitelist file
+        The whitelist is a compiled C{bley.whitelist.Whitelist} of the
+        strings and regular expressions from the whitelist file
         Return 1 if any of
             email matches the entire entry
             email matches the regular expression
@@ -274,48 +320,16 @@ class BleyPolicy(PostfixPolicy):
             name)
             email user@ part matches an entry of the form user@
         '''
-        for entry_wl in whitelist:
-            if isinstance(entry_wl, regexp_type):
-                if entry_wl.search(email) is not None:
-                    logger.info('whitelisted %s due to rule %s' %
-                                (email, entry_wl.pattern))
-                    return 1
-                else:
-                    # It's a regex, but it doesn't match
-                    # next whitelist item please
-                    continue
-            # whitelist item is a string
-            if entry_wl.endswith('@'):
-                # user@ (any domain) match
-                if email.startswith(entry_wl):
-                    logger.info('whitelisted %s due to rule %s' %
-                                (email, entry_wl))
-                    return 1
-                else:
-                    continue
-            if len(email) > len(entry_wl):
-                entry_wl_length = len(entry_wl) + 1
-                if ('.' + entry_wl) == email[-entry_wl_length:]:
-                    # subdomain match
-                    logger.info('whitelisted %s due to rule %s' %
-                                (email, entry_wl))
-                    return 1
-                elif ('@' + entry_wl) == email[-entry_wl_length:]:
-                    # @domain match
-                    logger.info('whitelisted %s due to rule %s' %
-                                (email, entry_wl))
-                    return 1
-            if entry_wl == email:
-                # Whole email match (for whitelist_recipients)
-                # Or domain match (for whitelist_clients)
-                logger.info('whitelisted %s due to rule %s' %
-                            (email, entry_wl))
-                return 1
+        rule = whitelist.match(email)
+        if rule is not None:
+            logger.info('whitelisted %s due to rule %s' % (email, rule))
+            return 1
         return 0
 
     def check_whitelist_ip(self, ipstr, whitelist_ip):
         '''Check the arg ipstr against a whitelist
-        The whitelist consists of ip objects generated from the whitelist file
+        The whitelist is a C{bley.whitelist.NetworkWhitelist} of the
+        networks from the whitelist file
         Return 1 if
             ipstr is a valie ip address
             -- AND --
@@ -325,13 +339,14 @@ class BleyPolicy(PostfixPolicy):
             ip = ipaddress.ip_address(ipstr)
         except (ValueError):
             return 0
-        for net in whitelist_ip:
-            if ip in net:
-                logger.info('whitelisted %s because it is in subnet %s' %
-                            (str(ip), str(net)))
-                return 1
+        net = whitelist_ip.match(ip)
+        if net is not None:
+            logger.info('whitelisted %s because it is in subnet %s' %
+                        (str(ip), str(net)))
+            return 1
         return 0
 
+    @defer.inlineCallbacks
     def check_local_db(self, postfix_params):
         '''Check the sender for being in the local database.
 
@@ -339,28 +354,74 @@ class BleyPolicy(PostfixPolicy):
 
         @type  postfix_params: dict
         @param postfix_params: parameters we got from Postfix
-        @rtype: list
-        @return: the result from SQL if any
+        @rtype: C{Deferred}
+        @return: the result from SQL if any, None if the database is
+                 not available
         '''
 
         query = """SELECT status,last_action,fail_count,sender,recipient
                     FROM bley_status
                     WHERE ip=%(client_address)s
-                    AND sender=%(sender)s AND recipient=%(recipient)s
-                    ORDER BY status ASC
-                    LIMIT 1"""
+                    AND sender=%(sender)s AND recipient=%(recipient)s"""
+        if self.factory.store and self.factory.store.loaded:
+            defer.returnValue(self.factory.store.lookup(self.key_params(postfix_params)))
+        if not self.factory.db_available:
+            defer.returnValue(None)
         try:
-            self.safe_execute(query, postfix_params)
-            result = self.dbc.fetchone()
+            result = yield self.safe_execute(query, self.db_params(postfix_params),
+                                             fetch=True)
         except Exception:
             result = None
             logger.info('check_local_db failed. sending unknown.')
+            if not self.factory.db_available:
+                defer.returnValue(None)
         if not result:
-            return -1
+            defer.returnValue(-1)
         else:
-            return result
+            defer.returnValue(result[0])
+
+    def update_local_db(self, postfix_params, operation):
+        '''Update the (ip,sender,recipient) tuple in the local database.
+
+        @type  postfix_params: dict
+        @param postfix_params: parameters we got from Postfix
+        @type  operation: string
+        @param operation: one of the keys of C{STATUS_QUERIES}
+        @rtype: C{Deferred}
+        @return: fires when the database was updated
+        '''
+        if self.factory.store and self.factory.store.loaded:
+            self.factory.store.update(self.key_params(postfix_params), operation)
+            return defer.succeed(None)
+        if self.factory.settings.dbtype == 'mysql':
+            query = STATUS_QUERIES_MYSQL[operation]
+        else:
+            query = STATUS_QUERIES[operation]
+        return self.safe_execute(query, self.db_params(postfix_params))
+
+    def client_key(self, ip):
+        '''Return the key used for ip in the caches and the database.
+
+        That is ip itself or, if aggregate_ipv4_prefix/aggregate_ipv6_prefix
+        are set, the address of the network ip belongs to.
+        '''
+        return bley.helpers.aggregate_ip(ip,
+                                         self.factory.settings.aggregate_ipv4_prefix,
+                                         self.factory.settings.aggregate_ipv6_prefix)
+
+    def key_params(self, postfix_params):
+        '''Return postfix_params with the client address replaced by its key.'''
+        params = dict(postfix_params)
+        params['client_address'] = self.client_key(params['client_address'])
+        return params
+
+    def db_params(self, postfix_params):
+        '''Return postfix_params with the client key as stored in the database.'''
+        params = self.key_params(postfix_params)
+        params['client_address'] = bley.helpers.pack_ip(self.factory.settings,
+                                                        params['client_address'])
+        return params
 
-    @defer.inlineCallbacks
     def check_dnswls(self, ip, max_listed):
         '''Check the IP address in DNSWLs.
 
@@ -368,21 +429,12 @@ class BleyPolicy(PostfixPolicy):
         @param ip: the IP to check
         @type max: int
         @param max: stop after max hits
-        @rtype: int
+        @rtype: C{Deferred}
         @return: in how many DNSWLs did we find ip?
         '''
-        result = 0
-        for dnsl in self.factory.settings.dnswls:
-            try:
-                d = yield self.check_dnsl(dnsl, ip)
-                result += 1
-            except Exception:
-                pass
-            if result >= max_listed:
-                break
-        defer.returnValue(result)
+        return self.check_dnsls(self.factory.settings.dnswls, ip, max_listed,
+                                lambda answer: True)
 
-    @defer.inlineCallbacks
     def check_dnsbls(self, ip, max_listed):
         '''Check the IP address in DNSBLs.
 
@@ -390,20 +442,67 @@ class BleyPolicy(PostfixPolicy):
         @param ip: the IP to check
         @type max: int
         @param max: stop after max hits
-        @rtype: int
+        @rtype: C{Deferred}
         @return: in how many DNSBLs did we find ip?
         '''
-        result = 0
-        for dnsl in self.factory.settings.dnsbls:
-            try:
-                d = yield self.check_dnsl(dnsl, ip)
-                if len(d[0]) > 0:
-                    result += 1
-            except Exception:
-                pass
-            if result >= max_listed:
+        return self.check_dnsls(self.factory.settings.dnsbls, ip, max_listed,
+                                lambda answer: len(answer[0]) > 0)
+
+    def check_dnsls(self, lists, ip, max_listed, is_listed):
+        '''Check the IP address in several DNS lists at once.
+
+        All lists are queried in parallel. The result is returned as soon
+        as max_listed lists have listed ip, all lists have answered or
+        dnsl_timeout seconds have passed, whatever happens first.
+        Lists which did not answer by then count as not listing ip.
+
+        @type lists: list
+        @param lists: the DNS lists to check in
+        @type ip: string
+        @param ip: the IP to check
+        @type max_listed: int
+        @param max_listed: stop after max_listed hits
+        @type is_listed: callable
+        @param is_listed: tells whether an answer of a list is a hit
+        @rtype: C{Deferred}
+        @return: in how many lists did we find ip?
+        '''
+        result = defer.Deferred()
+        state = {'listed': 0, 'pending': len(lists), 'finished': False}
+        lookups = []
+
+        def finish():
+            if state['finished']:
+                return
+            state['finished'] = True
+            if deadline.active():
+                deadline.cancel()
+            for d in lookups:
+                if not d.called:
+                    d.cancel()
+            result.callback(state['listed'])
+
+        def answered(answer):
+            if is_listed(answer):
+                state['listed'] += 1
+
+        def done(ignored):
+            state['pending'] -= 1
+            if state['listed'] >= max_listed or not state['pending']:
+                finish()
+
+        deadline = reactor.callLater(self.factory.settings.dnsl_timeout, finish)
+        if not lists:
+            finish()
+        for dnsl in lists:
+            if state['finished']:
                 break
-        defer.returnValue(result)
+            d = self.check_dnsl(dnsl, ip)
+            d.addCallback(answered)
+            d.addErrback(lambda failure: None)
+            d.addCallback(done)
+            lookups.append(d)
+        return result
 
     def check_dnsl(self, lst, ip):
         '''Check the IP address in a DNS list.
@@ -418,87 +517,275 @@ class BleyPolicy(PostfixPolicy):
 
         rip = bley.helpers.reverse_ip(ip)
         lookup = '%s.%s' % (rip, lst)
+        cached = self.factory.dns_cache.get(lookup)
+        if isinstance(cached, Exception):
+            return defer.fail(cached)
+        elif cached is not None:
+            return defer.succeed(cached)
         d = client.lookupAddress(lookup)
+        d.addCallbacks(self.factory.cache_dns_answer,
+                       self.factory.cache_dns_error,
+                       callbackArgs=(lookup,), errbackArgs=(lookup,))
+        return d
+
+    def check_spf(self, postfix_params):
+        '''Check the SPF record of the sending address.
+
+        The check runs in the SPF thread pool, so the DNS lookups of pyspf
+        do not block the reactor. Checks that take longer than spf_timeout
+        seconds are scored as good, a spf_timeout of 0 or less disables
+        the limit.
+        Results are cached per client address, sender domain and HELO.
+
+        @type  postfix_params: dict
+        @param postfix_params: parameters we got from Postfix
+        @rtype: C{Deferred}
+        @return: 1 if bad SPF, 0 else
+        '''
+        params = {'client_address': postfix_params['client_address'],
+                  'sender': postfix_params['sender'],
+                  'helo_name': postfix_params['helo_name']}
+        key = (params['client_address'], params['sender'].rsplit('@', 1)[-1],
+               params['helo_name'])
+        cached = self.factory.spf_cache.get(key)
+        if cached is not None:
+            return defer.succeed(cached)
+
+        def cache_result(score):
+            self.factory.spf_cache.set(key, score)
+            return score
+
+        timeout = max(self.factory.settings.spf_timeout, 0)
+        d = threads.deferToThreadPool(reactor, self.factory.spf_pool,
+                                      bley.helpers.check_spf, params,
+                                      self.factory.settings.use_spf_guess,
+                                      timeout)
+        d.addCallback(cache_result)
+        if timeout:
+            d.addTimeout(timeout, self.factory.clock,
+                         onTimeoutCancel=lambda result, timeout: 0)
         return d
 
-    def safe_execute(self, query, params=None):
+    def safe_execute(self, query, params=None, fetch=False):
+        '''Run a query in the database connection pool.
+
+        The query is executed in one of the threads of the pool, so the
+        reactor is not blocked while waiting for the database.
+        If the connection was lost, the query is retried once on a fresh
+        connection, before the database is considered unavailable.
+
+        @type  query: string
+        @param query: the SQL query to execute
+        @type  params: dict
+        @param params: parameters for the query
+        @type  fetch: bool
+        @param fetch: return the rows of the result
+        @rtype: C{Deferred}
+        @return: the rows of the result if fetch is set, None else
+        '''
         if self.factory.settings.dbtype == 'sqlite3':
             query = bley.helpers.adapt_query_for_sqlite3(query)
-        try:
-            self.dbc.execute(query, params)
-            self.db.commit()
-        except self.factory.settings.database.OperationalError:
-            self.safe_reconnect()
-            if self.db:
-                self.dbc.execute(query, params)
-                self.db.commit()
-            else:
-                logger.info('Could not reconnect to the database, exiting.')
-                reactor.stop()
+        d = self._run_query(query, params, fetch)
+        d.addErrback(self._retry_query, query, params, fetch)
+        return d
 
-    def safe_reconnect(self):
-        logger.info('Reconnecting to the database after an error.')
-        try:
-            self.db.close()
-        except Exception:
-            pass
-        self.db = None
-        retries = 0
-        while not self.db and retries < 30:
-            try:
-                self.factory.settings.db = self.db = self.factory.settings.database.connect(**self.factory.settings.dbsettings)
-                self.dbc = self.db.cursor()
-            except self.factory.settings.database.OperationalError:
-                self.db = None
-                retries += 1
-                sleep(1)
+    def _run_query(self, query, params, fetch):
+        if fetch:
+            return self.factory.settings.dbpool.runQuery(query, params)
+        return self.factory.settings.dbpool.runOperation(query, params)
+
+    def _retry_query(self, failure, query, params, fetch):
+        failure.trap(self.factory.settings.database.OperationalError,
+                     adbapi.ConnectionLost)
+        # the pool drops broken connections and connects again on next use
+        d = self._run_query(query, params, fetch)
+        d.addErrback(self.factory.database_error)
+        return d
 
 
 class BleyPolicyFactory(Factory):
     protocol = BleyPolicy
+    clock = reactor
 
     def __init__(self, settings):
         self.settings = settings
-        self.good_cache = {}
-        self.bad_cache = {}
-        self.actionlog = []
+        if settings.shared_cache_file:
+            self.shared_cache = SharedVerdictCache(settings.shared_cache_file,
+                                                   settings.shared_cache_slots,
+                                                   settings.cache_valid)
+            self.good_cache = self.shared_cache.view(GOOD)
+            self.bad_cache = self.shared_cache.view(BAD)
+        else:
+            self.good_cache = Cache(settings.cache_size, settings.cache_valid)
+            self.bad_cache = Cache(settings.cache_size, settings.cache_valid)
+            if settings.cache_snapshot_file:
+                self.load_caches()
+        self.dns_cache = Cache(settings.dns_cache_size, 0)
+        self.spf_cache = Cache(settings.cache_size, settings.cache_valid)
+        self.spf_pool = ThreadPool(0, settings.spf_threads, 'bley-spf')
+        reactor.callWhenRunning(self.spf_pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.spf_pool.stop)
+        self.cache_sweeper = task.LoopingCall(self.sweep_caches)
+        reactor.callWhenRunning(self.cache_sweeper.start, 60, now=False)
+        self.actionlog = ActionLog(settings)
+        self.rollup = StatsRollup(settings)
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.collect_metrics)
         self.exim_workaround = settings.exim_workaround
-        reactor.callLater(30 * 60, self.dump_log)
-        reactor.addSystemEventTrigger('before', 'shutdown', self.dump_log)
+        self.db_available = True
+        self.db_reconnect_delay = 1
+        if settings.memory_store:
+            self.store = TripletStore(settings)
+            reactor.callWhenRunning(self.store.start)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.store.flush)
+        else:
+            self.store = None
+        reactor.callWhenRunning(self.actionlog.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.actionlog.flush)
+        reactor.callWhenRunning(self.rollup.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.rollup.flush)
+
+    def settings_changed(self):
+        '''Apply reloaded settings to the caches.'''
+        self.good_cache.ttl = self.settings.cache_valid
+        self.bad_cache.ttl = self.settings.cache_valid
+        self.spf_cache.ttl = self.settings.cache_valid
+        self.rollup.settings_changed()
+
+    def load_caches(self):
+        '''Fill the good and the bad cache from cache_snapshot_file.
+
+        Entries which expired since the snapshot was written are dropped.
+        '''
+        try:
+            with open(self.settings.cache_snapshot_file) as f:
+                snapshot = json.load(f)
+            age = time.time() - snapshot['time']
+            for name, cache in (('good', self.good_cache), ('bad', self.bad_cache)):
+                cache.load([(key, value, ttl - age) for key, value, ttl in snapshot[name]],
+                           self.settings.cache_valid)
+        except IOError:
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('Could not read cache snapshot %s: %s' %
+                           (self.settings.cache_snapshot_file, e))
+            return
+        logger.info('Loaded %d good and %d bad cache entries from %s' %
+                    (len(self.good_cache), len(self.bad_cache),
+                     self.settings.cache_snapshot_file))
+
+    def save_caches(self):
+        '''Write the good and the bad cache to cache_snapshot_file.'''
+        snapshot = {'time': time.time(),
+                    'good': self.good_cache.dump(),
+                    'bad': self.bad_cache.dump()}
+        filename = self.settings.cache_snapshot_file
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write cache snapshot %s: %s' % (filename, e))
+
+    def verdict_caches(self):
+        '''Return the (name, stats) of the good and the bad cache.
+
+        With shared_cache_file, both are views of the same table, whose
+        stats are returned once.
+        '''
+        if self.settings.shared_cache_file:
+            return [('shared', self.shared_cache.stats())]
+        return [('good', self.good_cache.stats()), ('bad', self.bad_cache.stats())]
+
+    def sweep_caches(self):
+        '''Remove expired entries from the caches and log their stats.'''
+        self.good_cache.sweep()
+        self.bad_cache.sweep()
+        self.dns_cache.sweep()
+        self.spf_cache.sweep()
+        if self.settings.verbose:
+            logger.info('%s, dns cache: %s' %
+                        (', '.join('%s cache: %s' % cache for cache in self.verdict_caches()),
+                         self.dns_cache.stats()))
+            logger.info('action log: %s' % self.actionlog.stats())
+
+    def collect_metrics(self):
+        '''Return the sizes and counters of the caches and the action log
+        as metric families for L{bley.metrics.Metrics}.'''
+        caches = self.verdict_caches() + [('dns', self.dns_cache.stats()),
+                                          ('spf', self.spf_cache.stats())]
+        families = [('bley_cache_entries', 'gauge', 'Entries in the caches.',
+                     [({'cache': name}, stats['size']) for name, stats in caches])]
+        for counter in ('hits', 'misses', 'evictions', 'expirations'):
+            families.append(('bley_cache_%s_total' % counter, 'counter',
+                             'Cache %s.' % counter,
+                             [({'cache': name}, stats[counter]) for name, stats in caches]))
+        log = self.actionlog.stats()
+        families.append(('bley_actionlog_queued', 'gauge',
+                         'Entries of the action log waiting to be written.',
+                         [({}, log['queued'])]))
+        families.append(('bley_actionlog_entries_total', 'counter',
+                         'Entries of the action log, by what happened to them.',
+                         [({'result': result}, log[result])
+                          for result in ('written', 'dropped', 'spilled')]))
+        return families
+
+    def cache_dns_answer(self, answer, name):
+        '''Cache the answer to the DNS lookup of name for its TTL.'''
+        self.dns_cache.set(name, answer,
+                           bley.helpers.dns_ttl(answer[0], answer[1]))
+        return answer
+
+    def cache_dns_error(self, failure, name):
+        '''Cache NXDOMAIN answers for their negative caching TTL.'''
+        if failure.check(error.DNSNameError):
+            message = failure.value.args[0]
+            self.dns_cache.set(name, failure.value,
+                               bley.helpers.dns_ttl([], message.authority))
+        return failure
+
+    def database_error(self, failure):
+        '''Mark the database as unavailable after a connection error.
+
+        While the database is unavailable, requests are answered with
+        the configured db_failure_action and reconnects are attempted
+        with an exponential backoff.
+        '''
+        failure.trap(self.settings.database.OperationalError,
+                     adbapi.ConnectionLost)
+        if self.db_available:
+            logger.info('Lost the connection to the database, reconnecting.')
+            self.db_available = False
+            self.db_reconnect_delay = 1
+            self.clock.callLater(self.db_reconnect_delay, self.reconnect_database)
+        return failure
+
+    def reconnect_database(self):
+        d = self.settings.dbpool.runQuery('SELECT 1')
+        d.addCallbacks(self._database_reconnected,
+                       self._database_reconnect_failed)
+        return d
+
+    def _database_reconnected(self, result):
+        logger.info('Reconnected to the database.')
+        self.db_available = True
+
+    def _database_reconnect_failed(self, failure):
+        self.db_reconnect_delay = min(self.db_reconnect_delay * 2,
+                                      self.settings.db_reconnect_max)
+        logger.info('Could not reconnect to the database, retrying in %i seconds.' %
+                    self.db_reconnect_delay)
+        self.clock.callLater(self.db_reconnect_delay, self.reconnect_database)
 
     def log_action(self, postfix_params, action, check_results):
         now = datetime.datetime.now()
         action = action.split(' ')[0]
-        logline = {'time': str(now), 'ip': postfix_params['client_address'],
-                   'from': postfix_params['sender'],
-                   'to': postfix_params['recipient'],
-                   'action': action}
-        logline.update(check_results)
-        self.actionlog.append(logline)
-
-    def dump_log(self):
-        query = '''INSERT INTO bley_log (logtime, ip, sender, recipient,
-                action, check_dnswl, check_dnsbl, check_helo, check_dyn,
-                check_db, check_spf, check_s_eq_r, check_postmaster,
-                check_cache)
-                VALUES(%(time)s, %(ip)s, %(from)s, %(to)s, %(action)s,
-                %(DNSWL)s, %(DNSBL)s, %(HELO)s, %(DYN)s, %(DB)s,
-                %(SPF)s, %(S_EQ_R)s, %(WHITELISTED)s, %(CACHE)s)'''
-
-        if self.settings.dbtype == 'sqlite3':
-            query = bley.helpers.adapt_query_for_sqlite3(query)
-
-        try:
-            db = self.settings.database.connect(**self.settings.dbsettings)
-            dbc = db.cursor()
-            i = len(self.actionlog)
-            while i:
-                logline = self.actionlog.pop(0)
-                dbc.execute(query, logline)
-                i -= 1
-            db.commit()
-            dbc.close()
-            db.close()
-        except self.settings.database.DatabaseError as e:
-            logger.warn('SQL error: %s' % e)
-        reactor.callLater(30 * 60, self.dump_log)
+        row = (str(now), postfix_params['client_address'],
+               postfix_params['sender'], postfix_params['recipient'], action,
+               check_results['DNSWL'], check_results['DNSBL'],
+               check_results['HELO'], check_results['DYN'],
+               check_results['DB'], check_results['SPF'],
+               check_results['S_EQ_R'], check_results['WHITELISTED'],
+               check_results['CACHE'])
+        self.actionlog.append(row)
+        self.rollup.add(now, row)
@@ -0,0 +1,132 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from collections import OrderedDict
+
+import time
+
+
+class Cache(object):
+    '''A bounded least-recently-used cache with expiring entries.
+
+    Every entry expires after ttl seconds, when more than maxsize entries
+    are stored, the least recently used ones are evicted.
+    '''
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        '''
+        @type  maxsize: int
+        @param maxsize: maximum number of entries
+        @type  ttl: int
+        @param ttl: default lifetime of an entry in seconds
+        @type  clock: callable
+        @param clock: returns the current time in seconds
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        '''Return the value stored for key, default if none is valid.'''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] <= self.clock():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value=True, ttl=None):
+        '''Store value for key, valid for ttl (or the default) seconds.'''
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            self.entries.pop(key, None)
+            return
+        self.entries[key] = (self.clock() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def dump(self):
+        '''Return the valid entries, least recently used first.
+
+        @rtype: list
+        @return: (key, value, remaining lifetime) tuples
+        '''
+        now = self.clock()
+        return [(key, entry[1], entry[0] - now)
+                for key, entry in self.entries.items() if entry[0] > now]
+
+    def load(self, entries, max_ttl=None):
+        '''Store entries as returned by dump().
+
+        @type  entries: list
+        @param entries: (key, value, remaining lifetime) tuples
+        @type  max_ttl: int
+        @param max_ttl: if set, no entry lives longer than max_ttl seconds
+        '''
+        for key, value, ttl in entries:
+            if max_ttl is not None:
+                ttl = min(ttl, max_ttl)
+            if ttl > 0:
+                self.set(key, value, ttl)
+
+    def sweep(self):
+        '''Remove all expired entries.'''
+        now = self.clock()
+        expired = [key for key, entry in self.entries.items() if entry[0] <= now]
+        for key in expired:
+            del self.entries[key]
+        self.expirations += len(expired)
+
+    def stats(self):
+        '''Return the size and the counters of the cache.
+
+        @rtype: dict
+        '''
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -33,14 +33,18 @@ import os
 import sys
 import datetime
 import logging
+import signal
 import socket
 
-from optparse import OptionParser
+from optparse import OptionParser, SUPPRESS_HELP, Values
 
 import ipaddress
 import re
 
 from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import threads
+from twisted.enterprise import adbapi
 
 try:
     from twisted.scripts._twistd_unix import UnixApplicationRunner
@@ -49,7 +53,15 @@ except ImportError:
     sys.exit(1)
 
 from twisted.application import internet, service
+from twisted.web.server import Site
 from .bley import BleyPolicyFactory, parse_config
+from .helpers import pack_ip
+from .metrics import MetricsResource
+from .partitions import LogPartitions
+from .purge import Purger
+from .stats import StatsRollup
+from .whitelist import Whitelist, NetworkWhitelist
+from .workers import AdoptedPortService, WorkerSupervisor, listen_socket
 
 logger = logging.getLogger('bley')
 
@@ -62,7 +74,7 @@ __CREATE_DB_QUERY = '''
     sender VARCHAR(254),
     recipient VARCHAR(254),
     fail_count INT DEFAULT 0,
-    INDEX bley_status_index USING btree (ip, sender, recipient),
+    UNIQUE INDEX bley_status_key USING btree (ip, sender, recipient),
     INDEX bley_status_action_index USING btree (last_action)
   ) CHARACTER SET 'ascii'
 '''
@@ -80,7 +92,7 @@ __CREATE_DB_QUERY_PG = '''
     recipient VARCHAR(254),
     fail_count INT DEFAULT 0
   );
-  CREATE INDEX bley_status_index
+  CREATE UNIQUE INDEX bley_status_key
    ON bley_status USING btree (ip ASC NULLS LAST, sender ASC NULLS LAST,
    recipient ASC NULLS LAST);
   CREATE INDEX bley_status_action_index
@@ -100,19 +112,72 @@ __CREATE_DB_QUERY_SL = '''
     recipient VARCHAR(254),
     fail_count INT DEFAULT 0
   );
-  CREATE INDEX IF NOT EXISTS bley_status_index
+  CREATE UNIQUE INDEX IF NOT EXISTS bley_status_key
    ON bley_status (ip ASC, sender ASC, recipient ASC);
   CREATE INDEX IF NOT EXISTS bley_status_action_index
    ON bley_status (last_action);
 '''
+__CHECK_DB_QUERY_SL = '''
+  SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'bley_status'
+'''
+
+__CHECK_KEY_QUERY = '''
+  SHOW INDEX FROM bley_status WHERE Key_name = 'bley_status_key'
+'''
+__CHECK_KEY_QUERY_PG = '''
+  SELECT indexname FROM pg_catalog.pg_indexes WHERE indexname = 'bley_status_key'
+'''
+__CHECK_KEY_QUERY_SL = '''
+  SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'bley_status_key'
+'''
+
+# Older versions of bley did not have a unique key on (ip, sender, recipient),
+# keep the entry with the lowest status of every tuple and add the key.
+__ADD_KEY_QUERIES = [
+    'CREATE TABLE bley_status_new LIKE bley_status',
+    '''ALTER TABLE bley_status_new DROP INDEX bley_status_index,
+       ADD UNIQUE INDEX bley_status_key USING btree (ip, sender, recipient)''',
+    'INSERT IGNORE INTO bley_status_new SELECT * FROM bley_status ORDER BY status ASC',
+    'RENAME TABLE bley_status TO bley_status_old, bley_status_new TO bley_status',
+    'DROP TABLE bley_status_old',
+]
+__ADD_KEY_QUERY_PG = '''
+  DELETE FROM bley_status a USING bley_status b
+   WHERE a.ip = b.ip AND a.sender = b.sender AND a.recipient = b.recipient
+   AND (b.status < a.status OR (b.status = a.status AND b.ctid < a.ctid));
+  DROP INDEX IF EXISTS bley_status_index;
+  CREATE UNIQUE INDEX bley_status_key
+   ON bley_status USING btree (ip ASC NULLS LAST, sender ASC NULLS LAST,
+   recipient ASC NULLS LAST);
+'''
+__ADD_KEY_QUERY_SL = '''
+  DELETE FROM bley_status WHERE EXISTS (SELECT 1 FROM bley_status b
+   WHERE b.ip = bley_status.ip AND b.sender = bley_status.sender
+   AND b.recipient = bley_status.recipient
+   AND (b.status < bley_status.status
+        OR (b.status = bley_status.status AND b.rowid < bley_status.rowid)));
+  DROP INDEX IF EXISTS bley_status_index;
+  CREATE UNIQUE INDEX bley_status_key
+   ON bley_status (ip ASC, sender ASC, recipient ASC);
+'''
 
-__CLEAN_DB_QUERY = '''
-   DELETE FROM bley_status WHERE last_action<%(old)s OR
-   (last_action<%(old_bad)s AND status>=2)
+# With compact_ip, client addresses are stored as inet (PostgreSQL) or as
+# packed binary (MySQL, SQLite) instead of strings.
+__CHECK_IP_TYPE_QUERY = '''
+  SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()
+   AND TABLE_NAME = %s AND COLUMN_NAME = 'ip'
+'''
+__CHECK_IP_TYPE_QUERY_PG = '''
+  SELECT data_type FROM information_schema.columns WHERE table_name = %s
+   AND column_name = 'ip'
 '''
-__CLEAN_DB_QUERY_SL = '''
-   DELETE FROM bley_status WHERE last_action<:old OR
-   (last_action<:old_bad AND status>=2)
+__COMPACT_IP_QUERIES = [
+    'ALTER TABLE %s MODIFY ip VARBINARY(39) NOT NULL',
+    'UPDATE %s SET ip = INET6_ATON(ip)',
+    'ALTER TABLE %s MODIFY ip VARBINARY(16) NOT NULL',
+]
+__COMPACT_IP_QUERY_PG = '''
+  ALTER TABLE %s ALTER COLUMN ip TYPE inet USING ip::inet
 '''
 
 __CREATE_LOGDB_QUERY = '''
@@ -182,6 +247,44 @@ __CREATE_LOGDB_QUERY_SL = '''
    ON bley_log (logtime DESC, action ASC);
 '''
 
+# Hourly counters of the logged actions per category, see bley.stats.
+__CREATE_STATSDB_QUERY = '''
+  CREATE TABLE IF NOT EXISTS bley_stats
+  (
+    period DATETIME NOT NULL,
+    category VARCHAR(32) NOT NULL,
+    mails INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, category)
+  )  CHARACTER SET 'ascii';
+'''
+__CREATE_STATSDB_QUERY_PG = '''
+  CREATE TABLE bley_stats
+  (
+    period TIMESTAMP NOT NULL,
+    category VARCHAR(32) NOT NULL,
+    mails INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, category)
+  );
+'''
+__CHECK_STATSDB_QUERY = '''
+  SHOW TABLES LIKE 'bley_stats'
+'''
+__CHECK_STATSDB_QUERY_PG = '''
+  SELECT tablename FROM pg_catalog.pg_tables WHERE tablename = 'bley_stats'
+'''
+__CHECK_STATSDB_QUERY_SL = '''
+  SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'bley_stats'
+'''
+__CREATE_STATSDB_QUERY_SL = '''
+  CREATE TABLE IF NOT EXISTS bley_stats
+  (
+    period TIMESTAMP NOT NULL,
+    category VARCHAR(32) NOT NULL,
+    mails INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, category)
+  );
+'''
+
 
 def bley_start():
 
@@ -200,6 +303,10 @@ def bley_start():
     parser.add_option("-f", "--foreground",
                       action="store_true", dest="foreground",
                       help="don't daemonize the process")
+    parser.add_option("--worker-fd", dest="worker_fd", type="int",
+                      help=SUPPRESS_HELP)
+    parser.add_option("--worker-id", dest="worker_id", type="int",
+                      default=0, help=SUPPRESS_HELP)
     (settings, args) = parser.parse_args()
     settings.version = version
     settings.hostname = socket.getfqdn()
@@ -221,7 +328,7 @@ def bley_start():
     settings.listen_port = config.getint('bley', 'listen_port')
     settings.pid_file = settings.pid_file or config.get('bley', 'pid_file')
     settings.log_file = config.get('bley', 'log_file')
-    settings.cache_valid = config.getint('bley', 'cache_valid')
+    settings.cache_size = config.getint('bley', 'cache_size')
     settings.dbtype = config.get('bley', 'dbtype')
     if settings.dbtype == 'pgsql':
         database = 'psycopg2'
@@ -240,41 +347,80 @@ def bley_start():
                                'user': config.get('bley', 'dbuser'),
                                'passwd': config.get('bley', 'dbpass')}
     elif settings.dbtype == 'sqlite3':
-        global __CLEAN_DB_QUERY
         database = 'sqlite3'
         import sqlite3
         settings.database = sqlite3
         settings.dbsettings = {'database': os.path.join(config.get('bley', 'dbpath'), config.get('bley', 'dbname')), 'detect_types': 1}
-        __CLEAN_DB_QUERY = __CLEAN_DB_QUERY_SL
     else:
         print("No supported database configured.")
         sys.exit(1)
     if config.has_option('bley', 'dbport') and config.getint('bley', 'dbport') != 0:
         settings.dbsettings['port'] = config.getint('bley', 'dbport')
+    settings.db_pool_size = config.getint('bley', 'db_pool_size')
+    if settings.dbtype == 'sqlite3':
+        # SQLite serializes all writes anyway
+        settings.db_pool_size = 1
 
-    settings.reject_msg = config.get('bley', 'reject_msg')
-    settings.greylist_header = config.get('bley', 'greylist_header', raw=True)
-
-    settings.dnswls = [d.strip() for d in config.get('bley', 'dnswls').split(',') if d.strip() != ""]
-    settings.dnsbls = [d.strip() for d in config.get('bley', 'dnsbls').split(',') if d.strip() != ""]
-
-    settings.dnswl_threshold = config.getint('bley', 'dnswl_threshold')
-    settings.dnsbl_threshold = config.getint('bley', 'dnsbl_threshold')
-    settings.rfc_threshold = config.getint('bley', 'rfc_threshold')
-    settings.greylist_period = datetime.timedelta(0, config.getint('bley', 'greylist_period') * 60, 0)
-    settings.greylist_max = datetime.timedelta(0, config.getint('bley', 'greylist_max') * 60, 0)
-    settings.greylist_penalty = datetime.timedelta(0, config.getint('bley', 'greylist_penalty') * 60, 0)
-    settings.purge_days = config.getint('bley', 'purge_days')
-    settings.purge_bad_days = config.getint('bley', 'purge_bad_days')
-    settings.use_spf = config.getint('bley', 'use_spf')
-    settings.use_spf_guess = config.getint('bley', 'use_spf_guess')
+    settings.db_reconnect_max = config.getint('bley', 'db_reconnect_max')
+    settings.dns_cache_size = config.getint('bley', 'dns_cache_size')
+    settings.spf_threads = config.getint('bley', 'spf_threads')
 
     settings.exim_workaround = config.getboolean('bley', 'exim_workaround')
 
+    settings.log_flush_interval = config.getint('bley', 'log_flush_interval')
+    settings.log_queue_size = config.getint('bley', 'log_queue_size')
+    settings.log_overflow = config.get('bley', 'log_overflow')
+    if settings.log_overflow not in ('drop', 'spill'):
+        print("log_overflow must be either drop or spill.")
+        sys.exit(1)
+    settings.log_spill_file = config.get('bley', 'log_spill_file')
+
+    settings.memory_store = config.getboolean('bley', 'memory_store')
+    settings.memory_store_flush = config.getint('bley', 'memory_store_flush')
+    settings.workers = config.getint('bley', 'workers')
+    settings.shared_cache_file = config.get('bley', 'shared_cache_file')
+    settings.shared_cache_slots = config.getint('bley', 'shared_cache_slots')
+    settings.cache_snapshot_file = config.get('bley', 'cache_snapshot_file')
+    settings.compact_ip = config.getboolean('bley', 'compact_ip')
+    settings.purge_batch_size = config.getint('bley', 'purge_batch_size')
+    settings.log_partitions = config.getboolean('bley', 'log_partitions')
+    settings.aggregate_ipv4_prefix = config.getint('bley', 'aggregate_ipv4_prefix')
+    settings.aggregate_ipv6_prefix = config.getint('bley', 'aggregate_ipv6_prefix')
+    if not 0 <= settings.aggregate_ipv4_prefix <= 32:
+        print("aggregate_ipv4_prefix must be between 0 and 32.")
+        sys.exit(1)
+    if not 0 <= settings.aggregate_ipv6_prefix <= 128:
+        print("aggregate_ipv6_prefix must be between 0 and 128.")
+        sys.exit(1)
+    if settings.shared_cache_slots < 1:
+        print("shared_cache_slots must be at least 1.")
+        sys.exit(1)
+    settings.reload_interval = config.getint('bley', 'reload_interval')
+    settings.metrics_addr = config.get('bley', 'metrics_addr')
+    settings.metrics_port = config.getint('bley', 'metrics_port')
+
     if settings.debug:
         settings.foreground = True
         settings.log_file = None
 
+    if settings.worker_fd is not None:
+        # started by the supervisor, which takes care of the PID file
+        settings.foreground = True
+        settings.pid_file = None
+        settings.log_spill_file = '%s.%d' % (settings.log_spill_file,
+                                             settings.worker_id)
+        if settings.cache_snapshot_file:
+            settings.cache_snapshot_file = '%s.%d' % (settings.cache_snapshot_file,
+                                                      settings.worker_id)
+    elif settings.workers > 1:
+        try:
+            settings.listen_socket = listen_socket(settings.listen_addr,
+                                                   settings.listen_port)
+        except socket.error as e:
+            print("Could not listen on %s:%s: %s" % (settings.listen_addr,
+                                                     settings.listen_port, e))
+            sys.exit(1)
+
     logger.setLevel(logging.INFO)
     if settings.log_file == 'syslog':
         from logging.handlers import SysLogHandler
@@ -304,47 +450,21 @@ def bley_start():
         lh.setFormatter(formatter)
         logger.addHandler(lh)
 
-    if config.has_option('bley', 'whitelist_recipients_file'):
-        settings.whitelist_recipients_file = config.get('bley', 'whitelist_recipients_file')
-        if not os.path.isabs(settings.whitelist_recipients_file):
-            settings.whitelist_recipients_file = os.path.join(settings.confdir, settings.whitelist_recipients_file)
-        settings.whitelist_recipients = read_whitelist(settings.whitelist_recipients_file)[0]
-    else:
-        settings.whitelist_recipients = []
-    if config.has_option('bley', 'whitelist_clients_file'):
-        settings.whitelist_clients_file = config.get('bley', 'whitelist_clients_file')
-        if not os.path.isabs(settings.whitelist_clients_file):
-            settings.whitelist_clients_file = os.path.join(settings.confdir, settings.whitelist_clients_file)
-        (settings.whitelist_clients, settings.whitelist_clients_ip) = read_whitelist(settings.whitelist_clients_file)
-    else:
-        settings.whitelist_clients = []
-        settings.whitelist_clients_ip = []
+    try:
+        read_policy_config(settings, config)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-    logger.info("Starting up")
+    if settings.workers > 1 and settings.memory_store:
+        logger.warning("memory_store can not be used with multiple workers, disabling it")
+        settings.memory_store = False
 
-    db = settings.database.connect(**settings.dbsettings)
-    dbc = db.cursor()
-    if settings.dbtype == 'pgsql':
-        dbc.execute(__CHECK_DB_QUERY_PG)
-        if not dbc.fetchall():
-            dbc.execute(__CREATE_DB_QUERY_PG)
-        dbc.execute(__CHECK_LOGDB_QUERY_PG)
-        if not dbc.fetchall():
-            dbc.execute(__CREATE_LOGDB_QUERY_PG)
-    elif settings.dbtype == 'sqlite3':
-        dbc.executescript(__CREATE_DB_QUERY_SL)
-        dbc.executescript(__CREATE_LOGDB_QUERY_SL)
+    if settings.worker_fd is None:
+        logger.info("Starting up")
+        create_db(settings)
     else:
-        dbc.execute("set sql_notes = 0")
-        dbc.execute(__CREATE_DB_QUERY)
-        dbc.execute(__CREATE_LOGDB_QUERY)
-        dbc.execute("set sql_notes = 1")
-        dbc.execute(__UPDATE_DB_QUERY)
-    db.commit()
-    dbc.close()
-    db.close()
-
-    settings.db = settings.database.connect(**settings.dbsettings)
+        logger.info("Starting worker %d" % settings.worker_id)
 
     class NoLogObserver(object):
         def emit(self, eventDict):
@@ -364,16 +484,6 @@ def bley_start():
         def stop(self):
             return
 
-    class BleyRunner(UnixApplicationRunner):
-        loggerFactory = NoAppLogger
-
-        def createOrGetApplication(self):
-            bley_app = service.Application("bley")
-            bley_service = internet.TCPServer(settings.listen_port,
-                                              BleyPolicyFactory(settings),
-                                              interface=settings.listen_addr)
-            bley_service.setServiceParent(bley_app)
-            return bley_app
     bley_config = {'originalname': None, 'euid': None, 'profile': None,
                    'no_save': True, 'debug': False, 'uid': None, 'gid': None,
                    'chroot': None, 'rundir': '.',
@@ -381,30 +491,277 @@ def bley_start():
                    'pidfile': settings.pid_file,
                    'syslog': settings.log_file == 'syslog', 'prefix': 'bley',
                    'logfile': settings.log_file}
-    runner = BleyRunner(bley_config)
-    reactor.addSystemEventTrigger('before', 'shutdown', bley_stop, settings)
-    reactor.callWhenRunning(clean_db, settings)
-    runner.run()
 
+    if settings.worker_fd is None and settings.workers > 1:
+        class SupervisorRunner(UnixApplicationRunner):
+            loggerFactory = NoAppLogger
 
-def bley_stop(settings):
-    logger.info("Shutting down")
+            def createOrGetApplication(self):
+                bley_app = service.Application("bley")
+                supervisor = WorkerSupervisor(settings, settings.listen_socket)
+                supervisor.setServiceParent(bley_app)
+                return bley_app
+        runner = SupervisorRunner(bley_config)
+        reactor.addSystemEventTrigger('before', 'shutdown', bley_stop, settings)
+        runner.run()
+        return
+
+    settings.dbpool = adbapi.ConnectionPool(database, cp_min=1,
+                                            cp_max=settings.db_pool_size,
+                                            cp_reconnect=True,
+                                            **settings.dbsettings)
+
+    factory = BleyPolicyFactory(settings)
+
+    class BleyRunner(UnixApplicationRunner):
+        loggerFactory = NoAppLogger
+
+        def createOrGetApplication(self):
+            bley_app = service.Application("bley")
+            if settings.worker_fd is not None:
+                bley_service = AdoptedPortService(settings.worker_fd, factory)
+            else:
+                bley_service = internet.TCPServer(settings.listen_port,
+                                                  factory,
+                                                  interface=settings.listen_addr)
+            bley_service.setServiceParent(bley_app)
+            if settings.metrics_port:
+                # every worker serves its own metrics on the following ports
+                metrics_service = internet.TCPServer(settings.metrics_port + settings.worker_id,
+                                                     Site(MetricsResource(factory.metrics)),
+                                                     interface=settings.metrics_addr)
+                metrics_service.setServiceParent(bley_app)
+            return bley_app
+    runner = BleyRunner(bley_config)
+    reactor.addSystemEventTrigger('before', 'shutdown', bley_stop, settings, factory)
+    if settings.worker_id == 0:
+        purger = Purger(settings)
+        reactor.callWhenRunning(purger.start)
+    reactor.callWhenRunning(install_reload_handler, settings, factory)
+    runner.run()
 
 
-def clean_db(settings):
-    if settings.verbose:
-        logger.info("cleaning database")
+def create_db(settings):
+    '''Create the tables of bley if they do not exist yet.'''
     db = settings.database.connect(**settings.dbsettings)
     dbc = db.cursor()
-    now = datetime.datetime.now()
-    old = now - datetime.timedelta(settings.purge_days, 0, 0)
-    old_bad = now - datetime.timedelta(settings.purge_bad_days, 0, 0)
-    p = {'old': str(old), 'old_bad': str(old_bad)}
-    dbc.execute(__CLEAN_DB_QUERY, p)
+    if settings.dbtype == 'pgsql':
+        dbc.execute(__CHECK_DB_QUERY_PG)
+        if not dbc.fetchall():
+            dbc.execute(__CREATE_DB_QUERY_PG)
+        dbc.execute(__CHECK_LOGDB_QUERY_PG)
+        if not dbc.fetchall():
+            dbc.execute(__CREATE_LOGDB_QUERY_PG)
+        dbc.execute(__CHECK_KEY_QUERY_PG)
+        if not dbc.fetchall():
+            logger.info("Adding unique key to bley_status")
+            dbc.execute(__ADD_KEY_QUERY_PG)
+        dbc.execute(__CHECK_STATSDB_QUERY_PG)
+        new_stats = not dbc.fetchall()
+        if new_stats:
+            dbc.execute(__CREATE_STATSDB_QUERY_PG)
+    elif settings.dbtype == 'sqlite3':
+        dbc.execute(__CHECK_DB_QUERY_SL)
+        if dbc.fetchall():
+            dbc.execute(__CHECK_KEY_QUERY_SL)
+            if not dbc.fetchall():
+                logger.info("Adding unique key to bley_status")
+                dbc.executescript(__ADD_KEY_QUERY_SL)
+        dbc.executescript(__CREATE_DB_QUERY_SL)
+        dbc.execute("SELECT type FROM sqlite_master WHERE name = 'bley_log'")
+        if dbc.fetchone() != ('view',):
+            # a view if bley_log is partitioned
+            dbc.executescript(__CREATE_LOGDB_QUERY_SL)
+        dbc.execute(__CHECK_STATSDB_QUERY_SL)
+        new_stats = not dbc.fetchall()
+        dbc.executescript(__CREATE_STATSDB_QUERY_SL)
+    else:
+        dbc.execute("set sql_notes = 0")
+        dbc.execute(__CREATE_DB_QUERY)
+        dbc.execute(__CREATE_LOGDB_QUERY)
+        dbc.execute(__CHECK_STATSDB_QUERY)
+        new_stats = not dbc.fetchall()
+        dbc.execute(__CREATE_STATSDB_QUERY)
+        dbc.execute("set sql_notes = 1")
+        dbc.execute(__UPDATE_DB_QUERY)
+        dbc.execute(__CHECK_KEY_QUERY)
+        if not dbc.fetchall():
+            logger.info("Adding unique key to bley_status")
+            for query in __ADD_KEY_QUERIES:
+                dbc.execute(query)
+    if settings.compact_ip:
+        for table in ('bley_status', 'bley_log'):
+            compact_ip_column(settings, dbc, table)
+    if settings.log_partitions:
+        LogPartitions(settings).maintain(dbc)
+    if new_stats:
+        logger.info("Filling bley_stats from bley_log")
+        StatsRollup(settings).backfill(dbc)
     db.commit()
     dbc.close()
     db.close()
-    reactor.callLater(30 * 60, clean_db, settings)
+
+
+def compact_ip_column(settings, dbc, table):
+    '''Convert the ip column of table to the compact representation.
+
+    Does nothing if the column is already converted.
+    '''
+    if settings.dbtype == 'pgsql':
+        dbc.execute(__CHECK_IP_TYPE_QUERY_PG, (table,))
+        if dbc.fetchone()[0] == 'inet':
+            return
+        logger.info("Converting %s.ip to inet" % table)
+        dbc.execute(__COMPACT_IP_QUERY_PG % table)
+    elif settings.dbtype == 'sqlite3':
+        dbc.execute("SELECT type FROM sqlite_master WHERE name = %r" % table)
+        if dbc.fetchone() == ('view',):
+            # the partitions of bley_log
+            dbc.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%s_%%'" % table)
+            for (partition,) in dbc.fetchall():
+                compact_ip_column(settings, dbc, partition)
+            return
+        dbc.execute("SELECT rowid, ip FROM %s WHERE typeof(ip) = 'text'" % table)
+        rows = [(pack_ip(settings, ip), rowid) for (rowid, ip) in dbc.fetchall()]
+        if rows:
+            logger.info("Converting %s.ip to binary" % table)
+            dbc.executemany("UPDATE %s SET ip = ? WHERE rowid = ?" % table, rows)
+    else:
+        dbc.execute(__CHECK_IP_TYPE_QUERY, (table,))
+        if dbc.fetchone()[0] == 'varbinary':
+            return
+        logger.info("Converting %s.ip to binary" % table)
+        for query in __COMPACT_IP_QUERIES:
+            dbc.execute(query % table)
+
+
+def read_policy_config(settings, config):
+    '''Read the options which can be changed by reloading bley.
+
+    @type  settings: C{optparse.Values}
+    @param settings: the settings to update
+    @type  config: C{ConfigParser}
+    @param config: the parsed configuration files
+    @raise ValueError: if an option has an invalid value
+    '''
+    settings.cache_valid = config.getint('bley', 'cache_valid')
+
+    settings.reject_msg = config.get('bley', 'reject_msg')
+    settings.db_failure_action = config.get('bley', 'db_failure_action').upper()
+    if settings.db_failure_action == 'DEFER':
+        settings.db_failure_action = 'DEFER_IF_PERMIT %s' % settings.reject_msg
+    elif settings.db_failure_action != 'DUNNO':
+        raise ValueError("db_failure_action must be either DUNNO or DEFER.")
+    settings.greylist_header = config.get('bley', 'greylist_header', raw=True)
+
+    settings.dnswls = [d.strip() for d in config.get('bley', 'dnswls').split(',') if d.strip() != ""]
+    settings.dnsbls = [d.strip() for d in config.get('bley', 'dnsbls').split(',') if d.strip() != ""]
+
+    settings.dnswl_threshold = config.getint('bley', 'dnswl_threshold')
+    settings.dnsbl_threshold = config.getint('bley', 'dnsbl_threshold')
+    settings.dnsl_timeout = config.getfloat('bley', 'dnsl_timeout')
+    settings.rfc_threshold = config.getint('bley', 'rfc_threshold')
+    settings.greylist_period = datetime.timedelta(0, config.getint('bley', 'greylist_period') * 60, 0)
+    settings.greylist_max = datetime.timedelta(0, config.getint('bley', 'greylist_max') * 60, 0)
+    settings.greylist_penalty = datetime.timedelta(0, config.getint('bley', 'greylist_penalty') * 60, 0)
+    settings.purge_days = config.getint('bley', 'purge_days')
+    settings.purge_bad_days = config.getint('bley', 'purge_bad_days')
+    settings.purge_log_days = config.getint('bley', 'purge_log_days')
+    settings.use_spf = config.getint('bley', 'use_spf')
+    settings.use_spf_guess = config.getint('bley', 'use_spf_guess')
+    settings.spf_timeout = config.getint('bley', 'spf_timeout')
+
+    if config.has_option('bley', 'whitelist_recipients_file'):
+        settings.whitelist_recipients_file = config.get('bley', 'whitelist_recipients_file')
+        if not os.path.isabs(settings.whitelist_recipients_file):
+            settings.whitelist_recipients_file = os.path.join(settings.confdir, settings.whitelist_recipients_file)
+        settings.whitelist_recipients = read_whitelist(settings.whitelist_recipients_file)[0]
+    else:
+        settings.whitelist_recipients = Whitelist()
+    if config.has_option('bley', 'whitelist_clients_file'):
+        settings.whitelist_clients_file = config.get('bley', 'whitelist_clients_file')
+        if not os.path.isabs(settings.whitelist_clients_file):
+            settings.whitelist_clients_file = os.path.join(settings.confdir, settings.whitelist_clients_file)
+        (settings.whitelist_clients, settings.whitelist_clients_ip) = read_whitelist(settings.whitelist_clients_file)
+    else:
+        settings.whitelist_clients = Whitelist()
+        settings.whitelist_clients_ip = NetworkWhitelist()
+
+
+def install_reload_handler(settings, factory, clock=reactor):
+    '''Reload the configuration on SIGHUP and, if reload_interval is set,
+    when one of the configuration or whitelist files changed.
+
+    @rtype: C{task.LoopingCall}
+    @return: the loop checking the files, None if reload_interval is unset
+    '''
+    def sighup_handler(signum, frame):
+        reactor.callFromThread(reload_config, settings, factory)
+    signal.signal(signal.SIGHUP, sighup_handler)
+
+    if settings.reload_interval > 0:
+        mtimes = {'files': config_mtimes(settings)}
+
+        def check_mtimes():
+            current = config_mtimes(settings)
+            if current != mtimes['files']:
+                mtimes['files'] = current
+                reload_config(settings, factory)
+        checker = task.LoopingCall(check_mtimes)
+        checker.clock = clock
+        checker.start(settings.reload_interval, now=False)
+        return checker
+
+
+def config_mtimes(settings):
+    files = list(settings.conffile or [])
+    for attr in ('whitelist_recipients_file', 'whitelist_clients_file'):
+        if hasattr(settings, attr):
+            files.append(getattr(settings, attr))
+    mtimes = {}
+    for filename in files:
+        try:
+            mtimes[filename] = os.stat(filename).st_mtime
+        except OSError:
+            mtimes[filename] = None
+    return mtimes
+
+
+def reload_config(settings, factory):
+    '''Re-read the configuration and the whitelists.
+
+    The files are parsed in a thread. Afterwards the new values are swapped
+    into the settings at once, the caches and connections are kept.
+    Only the options set by read_policy_config() are swapped, so settings
+    changed in the meantime are not reverted. All other options need a
+    restart.
+    '''
+    logger.info("Reloading configuration")
+
+    def read_config():
+        new_settings = Values({'confdir': settings.confdir})
+        read_policy_config(new_settings, parse_config(settings.conffile))
+        del new_settings.confdir
+        return new_settings
+
+    def swap_settings(new_settings):
+        vars(settings).update(vars(new_settings))
+        factory.settings_changed()
+        logger.info("Reloaded configuration")
+
+    def reload_failed(failure):
+        logger.warning("Could not reload configuration: %s" %
+                       failure.getErrorMessage())
+
+    d = threads.deferToThread(read_config)
+    d.addCallbacks(swap_settings, reload_failed)
+    return d
+
+
+def bley_stop(settings, factory=None):
+    logger.info("Shutting down")
+    if factory is not None and settings.cache_snapshot_file and not settings.shared_cache_file:
+        factory.save_caches()
 
 
 def read_whitelist(whitelist_filename):
@@ -413,7 +770,7 @@ def read_whitelist(whitelist_filename):
         whitelist_fh = open(whitelist_filename, 'r')
     except OSError:
         logger.warning('Could not open file: %s' % (whitelist_filename))
-        return (['postmaster@'], ())
+        return (Whitelist(['postmaster@']), NetworkWhitelist())
     whitelist = list()
     whitelist_ip = list()
     for line in whitelist_fh:
@@ -433,7 +790,7 @@ def read_whitelist(whitelist_filename):
         except (ValueError):
             # Ordinary string (domain name or username)
             whitelist.append(line)
-    return (whitelist, whitelist_ip)
+    return (Whitelist(whitelist), NetworkWhitelist(whitelist_ip))
 
 
 if __name__ == '__main__':
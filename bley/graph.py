@@ -29,17 +29,231 @@
 
 from __future__ import print_function
 
+import csv
 import datetime
+import hashlib
+import json
 import sys
 import os
 
+from concurrent.futures import ProcessPoolExecutor
+
 from optparse import OptionParser
 
 from .bley import parse_config
-
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from .helpers import adapt_query_for_sqlite3
+from .stats import categories, count_log, hour_start
+
+# the graphs are plotted for these timeslots, each split into 12 slots of
+# 'slot' minutes, the locators are (unit, interval) of the axis ticks
+TIMESLOTS = [
+    {'title': '12h', 'slot': 60, 'major_locator': ('hour', 2),
+     'minor_locator': ('hour', 1), 'formatter': '%Y/%m/%d %H:%M', 'slotname': '1h'},
+    {'title': '24h', 'slot': 2 * 60, 'major_locator': ('hour', 4),
+     'minor_locator': ('hour', 2), 'formatter': '%Y/%m/%d %H:%M', 'slotname': '2h'},
+    {'title': '7d', 'slot': 12 * 60, 'major_locator': ('day', 1),
+     'minor_locator': ('hour', 12), 'formatter': '%Y/%m/%d', 'slotname': '12h'},
+    {'title': '28d', 'slot': 2 * 24 * 60, 'major_locator': ('day', 4),
+     'minor_locator': ('day', 2), 'formatter': '%Y/%m/%d', 'slotname': '2d'},
+    {'title': '365d', 'slot': 28 * 24 * 60, 'major_locator': ('day', 28),
+     'minor_locator': ('day', 28), 'formatter': '%Y/%m/%d', 'slotname': '28d'},
+]
+
+# the counters of the last run are kept in this file in destdir
+STATE_FILE = 'bleygraph.state'
+
+
+def parse_period(period):
+    return datetime.datetime.strptime(period, '%Y-%m-%d %H:%M:%S')
+
+
+def load_state(filename, source):
+    '''Return the hourly counters saved by an earlier run.
+
+    @type  filename: string
+    @param filename: the state file
+    @type  source: dict
+    @param source: describes where the counters come from, a state saved
+                   for another source is ignored
+    @rtype: tuple
+    @return: (until, counters, digests), all counters before until are
+             saved, digests are those of the written series by file name,
+             (None, [], {}) if there is no usable state
+    '''
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None, [], {}
+    if state.get('source') != source:
+        return None, [], {}
+    return (parse_period(state['until']),
+            [(parse_period(period), category, mails)
+             for period, category, mails in state['counters']],
+            state.get('digests', {}))
+
+
+def save_state(filename, source, until, counters, digests=None):
+    '''Save the hourly counters before until for the next run.'''
+    state = {'source': source, 'until': str(until),
+             'counters': [(str(period), category, mails)
+                          for period, category, mails in counters if period < until],
+             'digests': digests or {}}
+    try:
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.rename(filename + '.tmp', filename)
+    except (IOError, OSError) as e:
+        print('could not write %s: %s' % (filename, e))
+
+
+def series(counters, end, category_defs, timeslot):
+    '''Sum the hourly counters into the slots of timeslot.
+
+    @type  counters: list
+    @param counters: (period, category, mails) tuples
+    @type  end: C{datetime.datetime}
+    @param end: the end of the newest slot
+    @type  category_defs: C{OrderedDict}
+    @param category_defs: as returned by L{categories}
+    @type  timeslot: dict
+    @param timeslot: one of L{TIMESLOTS}
+    @rtype: dict
+    @return: the dates of the slots, the ham and spam series and the
+             (name, color, series) of every category, newest slot first
+    '''
+    d = datetime.timedelta(0, timeslot['slot'] * 60, 0)
+    mails = {}
+    for category in ['ham', 'spam'] + list(category_defs):
+        mails[category] = [0] * 12
+    for period, category, count in counters:
+        # slot i holds the hours from end - (i + 1) * d up to end - i * d
+        i = (int((end - period).total_seconds()) - 1) // int(d.total_seconds())
+        if 0 <= i < 12 and category in mails:
+            mails[category][i] += count
+    return {'dates': [end - d * i for i in range(12)],
+            'ham': mails['ham'], 'spam': mails['spam'],
+            'checks': [(name, category['color'], mails[name])
+                       for name, category in category_defs.items()]}
+
+
+def digest(data):
+    '''Return a digest of the series of a timeslot.'''
+    return hashlib.sha1(json.dumps(data, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def output_files(fmt, timeslot):
+    '''Return the names of the files written for timeslot in format fmt.'''
+    if fmt == 'png':
+        return ['ar-%s.png' % timeslot['title'], 'ch-%s.png' % timeslot['title']]
+    if fmt == 'csv':
+        return ['stats-%s.csv' % timeslot['title']]
+    return ['stats.json']
+
+
+def render(destdir, timeslot, data):
+    '''Plot the ACCEPT/REJECT and the check graphs of timeslot.
+
+    matplotlib is only imported here, so the graphs can be plotted in
+    worker processes.
+
+    @rtype: list
+    @return: the names of the written files
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    def locator(spec):
+        unit, interval = spec
+        if unit == 'hour':
+            return mdates.HourLocator(interval=interval)
+        return mdates.DayLocator(interval=interval)
+
+    dates = [mdates.date2num(date) for date in data['dates']]
+    ham = data['ham']
+    spam = data['spam']
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    fig2 = plt.figure()
+    ax2 = fig2.add_subplot(111)
+
+    ax.plot(dates, ham, label="ham", color='green')
+    ax.plot(dates, spam, label="spam", color='red')
+    for check, color, mails in data['checks']:
+        ax2.plot(dates, mails, label=check, color=color)
+
+    ax.legend(loc=2)
+    ax2.legend(loc=2)
+
+    fig.text(0.125, 0, "ham [ max: %s, avg: %s, min: %s  ]\nspam [ max: %s, avg: %s, min: %s  ]" %
+             (max(ham), round(float(sum(ham)) / len(ham), 2), min(ham),
+              max(spam), round(float(sum(spam)) / len(spam), 2), min(spam)))
+
+    for axis in (ax.xaxis, ax2.xaxis):
+        axis.set_major_formatter(mdates.DateFormatter(timeslot['formatter']))
+        axis.set_major_locator(locator(timeslot['major_locator']))
+        axis.set_minor_locator(locator(timeslot['minor_locator']))
+
+    fig.suptitle('bley ACCEPT/REJECT stats for the last %s (slot=%s)' % (timeslot['title'], timeslot['slotname']))
+    fig2.suptitle('bley check stats for the last %s (slot=%s)' % (timeslot['title'], timeslot['slotname']))
+
+    fig.autofmt_xdate()
+    fig2.autofmt_xdate()
+    files = [os.path.join(destdir, name) for name in output_files('png', timeslot)]
+    fig.savefig(files[0])
+    fig2.savefig(files[1])
+    plt.close(fig)
+    plt.close(fig2)
+    return files
+
+
+def export_json(destdir, timeslots):
+    '''Write the series of all timeslots to stats.json.
+
+    @type  timeslots: list
+    @param timeslots: (timeslot, series) tuples
+    @rtype: list
+    @return: the names of the written files
+    '''
+    stats = {}
+    for timeslot, data in timeslots:
+        stats[timeslot['title']] = {
+            'slot': timeslot['slotname'],
+            'dates': [str(date) for date in data['dates']],
+            'ham': data['ham'], 'spam': data['spam'],
+            'checks': dict((name, mails) for name, color, mails in data['checks'])}
+    filename = os.path.join(destdir, 'stats.json')
+    with open(filename, 'w') as f:
+        json.dump(stats, f, separators=(',', ':'))
+    return [filename]
+
+
+def export_csv(destdir, timeslots):
+    '''Write the series of every timeslot to stats-<timeslot>.csv.
+
+    Every row holds the date of a slot, the ham and spam mails and the
+    mails of every category.
+
+    @type  timeslots: list
+    @param timeslots: (timeslot, series) tuples
+    @rtype: list
+    @return: the names of the written files
+    '''
+    files = []
+    for timeslot, data in timeslots:
+        filename = os.path.join(destdir, output_files('csv', timeslot)[0])
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['date', 'ham', 'spam'] + [name for name, color, mails in data['checks']])
+            for i, date in enumerate(data['dates']):
+                row = [str(date), data['ham'][i], data['spam'][i]]
+                row.extend(mails[i] for name, color, mails in data['checks'])
+                writer.writerow(row)
+        files.append(filename)
+    return files
 
 
 def main():
@@ -48,9 +262,24 @@ def main():
                       help="write to DESTDIR")
     parser.add_option("-c", "--config", dest="conffile",
                       help="load configuration from CONFFILE")
+    parser.add_option("-F", "--format", dest="format", default="png",
+                      choices=["png", "json", "csv"],
+                      help="write png graphs (default), or the data as json or csv")
+    parser.add_option("-f", "--full",
+                      action="store_true", dest="full",
+                      help="ignore the counters saved by the last run")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      default=os.cpu_count() or 1,
+                      help="plot in JOBS processes")
+    parser.add_option("-l", "--log",
+                      action="store_true", dest="log",
+                      help="count the actions in bley_log instead of reading bley_stats")
     parser.add_option("-q", "--quiet",
                       action="store_true", dest="quiet",
                       help="be quiet (no output)")
+    parser.add_option("-s", "--skip-unchanged",
+                      action="store_true", dest="skip_unchanged",
+                      help="do not write files whose data did not change")
     (settings, args) = parser.parse_args()
 
     if not settings.conffile:
@@ -88,8 +317,6 @@ def main():
     if config.has_option('bley', 'dbport') and config.getint('bley', 'dbport') != 0:
         dbsettings['port'] = config.getint('bley', 'dbport')
 
-    matplotlib.use('Agg')
-
     dnswl_threshold = config.getint('bley', 'dnswl_threshold')
     dnsbl_threshold = config.getint('bley', 'dnsbl_threshold')
     rfc_threshold = config.getint('bley', 'rfc_threshold')
@@ -99,49 +326,9 @@ def main():
     db = database.connect(**dbsettings)
     dbc = db.cursor()
 
-    years = mdates.YearLocator()   # every year
-    months = mdates.MonthLocator()  # every month
-    hours = mdates.HourLocator()
-    twohours = mdates.HourLocator(interval=2)
-    fourhours = mdates.HourLocator(interval=4)
-    halfday = mdates.HourLocator(interval=12)
-    oneday = mdates.DayLocator()
-    twoday = mdates.DayLocator(interval=2)
-    fourday = mdates.DayLocator(interval=4)
-    teday = mdates.DayLocator(interval=28)
-    hoursFmt = mdates.DateFormatter('%Y/%m/%d %H:%M')
-    daysFmt = mdates.DateFormatter('%Y/%m/%d')
-
-    __TIMESLOTS = [
-        {'title': '12h', 'slot': 60, 'major_locator': twohours,
-         'minor_locator': hours, 'formatter': hoursFmt, 'slotname': '1h'},
-        {'title': '24h', 'slot': 2 * 60, 'major_locator': fourhours,
-         'minor_locator': twohours, 'formatter': hoursFmt, 'slotname': '2h'},
-        {'title': '7d', 'slot': 12 * 60, 'major_locator': oneday,
-         'minor_locator': halfday, 'formatter': daysFmt, 'slotname': '12h'},
-        {'title': '28d', 'slot': 2 * 24 * 60, 'major_locator': fourday,
-         'minor_locator': twoday, 'formatter': daysFmt, 'slotname': '2d'},
-        {'title': '365d', 'slot': 28 * 24 * 60, 'major_locator': teday,
-         'minor_locator': teday, 'formatter': daysFmt, 'slotname': '28d'},
-    ]
-    __QUERY_BASE = "SELECT COUNT(action) FROM bley_log WHERE action=%s AND logtime<'%s' AND logtime>='%s'"
-
-    __badcheck_queries = {
-        'in DNSBL': {'query': 'check_db=-1 and check_cache=0 and check_dnsbl>=%i' % (dnsbl_threshold), 'color': 'black'},
-        'bad HELO': {'query': 'check_db=-1 and check_cache=0 and check_helo>=%i and check_dnsbl<%i' % (rfc_threshold, dnsbl_threshold), 'color': 'red'},
-        'bad grey': {'query': 'check_db=2 and check_cache=0 and check_dnsbl<%i' % (dnsbl_threshold), 'color': 'blue'},
-        'from DynIP': {'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn)>=%i and check_helo<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold), 'color': 'orange'},
-        'bad SPF': {'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn+check_spf)>=%i and (check_helo+check_dyn)<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold), 'color': 'yellow'},
-        'sender==recipient': {'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn+check_spf+check_s_eq_r)>=%i and (check_helo+check_dyn+check_spf)<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold), 'color': 'orange'},
-        'bad cache': {'query': 'check_db=-1 and check_cache=1 and check_dnsbl<%i' % (dnsbl_threshold), 'color': 'pink'},
-    }
-    __goodcheck_queries = {
-        'known good': {'query': '(check_db=0 or check_db=1) and check_cache=0', 'color': 'green'},
-        'good grey': {'query': 'check_db=2 and check_cache=0', 'color': 'lightblue'},
-        'new good': {'query': 'check_db=-1 and check_cache=0 and check_dnswl<%i' % (dnswl_threshold), 'color': 'lightgreen'},
-        'in DNSWL': {'query': 'check_db=-1 and check_cache=0 and check_dnswl>=%i' % (dnswl_threshold), 'color': 'lightgrey'},
-        'good cache': {'query': 'check_db=-1 and check_cache=1', 'color': 'darkgreen'},
-    }
+    __QUERY = "SELECT period, category, mails FROM bley_stats WHERE period>=%(start)s AND period<%(end)s"
+
+    category_defs = categories(dnswl_threshold, dnsbl_threshold, rfc_threshold)
 
     __HTML_TEMPLATE = '''<html>
     <head>
@@ -156,94 +343,85 @@ def main():
     __ar_files = []
     __ch_files = []
 
-    for s in __TIMESLOTS:
-        d = datetime.timedelta(0, s['slot'] * 60, 0)
-        n = now - datetime.timedelta(0, 30 * 60, 0)
-        i = 12
-        a = {'dates': [], 'mails': []}
-        r = {'dates': [], 'mails': []}
-        checks = {}
-        for check in __badcheck_queries:
-            checks[check] = {'dates': [], 'mails': [], 'color': __badcheck_queries[check]['color']}
-        for check in __goodcheck_queries:
-            checks[check] = {'dates': [], 'mails': [], 'color': __goodcheck_queries[check]['color']}
+    end = hour_start(now)
+    start = end - datetime.timedelta(0, 12 * TIMESLOTS[-1]['slot'] * 60, 0)
+    # only the hours after the last run are read from the database, the
+    # newest hour is read again as bley might still have been counting it
+    state_file = os.path.join(settings.destdir, STATE_FILE)
+    source = {'log': bool(settings.log),
+              'thresholds': [dnswl_threshold, dnsbl_threshold, rfc_threshold]}
+    since, counters, digests = None, [], {}
+    if not settings.full:
+        since, counters, digests = load_state(state_file, source)
+    counters = [counter for counter in counters if counter[0] >= start]
+    if since is None or since < start:
+        since = start
+    if settings.log:
+        counters.extend(count_log(dbc, dbtype, category_defs, since, end))
+    else:
+        query = __QUERY
+        if dbtype == 'sqlite3':
+            query = adapt_query_for_sqlite3(query)
+        dbc.execute(query, {'start': str(since), 'end': str(end)})
+        counters.extend(dbc.fetchall())
+
+    dbc.close()
+    db.close()
 
+    timeslots = [(s, series(counters, end, category_defs, s)) for s in TIMESLOTS]
+    if settings.format == 'json':
+        # stats.json holds all timeslots, it is written if any of them changed
+        jobs = [(['stats.json'], timeslots)]
+    else:
+        jobs = [(output_files(settings.format, s), [(s, data)]) for s, data in timeslots]
+
+    # write only the files whose series changed since the last run
+    new_digests = dict(digests)
+    changed = []
+    for names, job in jobs:
+        job_digest = digest([data for s, data in job])
+        if (settings.skip_unchanged
+                and all(digests.get(name) == job_digest
+                        and os.path.exists(os.path.join(settings.destdir, name))
+                        for name in names)):
+            if not settings.quiet:
+                print("skipping %s, unchanged" % (', '.join(names)))
+        else:
+            changed.extend(job)
+        for name in names:
+            new_digests[name] = job_digest
+
+    if settings.format == 'png':
+        if settings.jobs > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(min(settings.jobs, len(changed))) as pool:
+                files = list(pool.map(render, [settings.destdir] * len(changed),
+                                      [s for s, data in changed], [data for s, data in changed]))
+        else:
+            files = [render(settings.destdir, s, data) for s, data in changed]
         if not settings.quiet:
-            print("plotting %s:" % (s['title']))
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        fig2 = plt.figure()
-        ax2 = fig2.add_subplot(111)
-        while i:
-            q1 = __QUERY_BASE % ("'DUNNO'", str(n), str(n - d))
-            q2 = __QUERY_BASE % ("'DEFER_IF_PERMIT'", str(n), str(n - d))
-            if dbtype == 'sqlite3':
-                q1 = q1.replace('%s', '?')
-                q2 = q2.replace('%s', '?')
-
-            dbc.execute(q1)
-            r1 = dbc.fetchone()
-            dbc.execute(q2)
-            r2 = dbc.fetchone()
-            numdate = mdates.date2num(n)
-            a['dates'].append(numdate)
-            r['dates'].append(numdate)
-            a['mails'].append(r1[0])
-            r['mails'].append(r2[0])
-            for check in __badcheck_queries:
-                q = "%s AND %s" % (q2, __badcheck_queries[check]['query'])
-                if dbtype == 'sqlite3':
-                    q = q.replace('%s', '?')
-                dbc.execute(q)
-                res = dbc.fetchone()
-                checks[check]['dates'].append(numdate)
-                checks[check]['mails'].append(res[0])
-            for check in __goodcheck_queries:
-                q = "%s AND %s" % (q1, __goodcheck_queries[check]['query'])
-                if dbtype == 'sqlite3':
-                    q = q.replace('%s', '?')
-                dbc.execute(q)
-                res = dbc.fetchone()
-                checks[check]['dates'].append(numdate)
-                checks[check]['mails'].append(res[0])
-            n = n - d
-            i -= 1
-
-        ax.plot(a['dates'], a['mails'], label="ham", color='green')
-        ax.plot(r['dates'], r['mails'], label="spam", color='red')
-        for check in checks:
-            ax2.plot(checks[check]['dates'], checks[check]['mails'], label=check, color=checks[check]['color'])
-
-        ax.legend(loc=2)
-        ax2.legend(loc=2)
-
-        fig.text(0.125, 0, "ham [ max: %s, avg: %s, min: %s  ]\nspam [ max: %s, avg: %s, min: %s  ]" %
-                 (max(a['mails']), round(float(sum(a['mails'])) / len(a['mails']), 2), min(a['mails']),
-                  max(r['mails']), round(float(sum(r['mails'])) / len(r['mails']), 2), min(r['mails'])))
-
-        ax.xaxis.set_major_formatter(s['formatter'])
-        ax.xaxis.set_major_locator(s['major_locator'])
-        ax.xaxis.set_minor_locator(s['minor_locator'])
-        ax2.xaxis.set_major_formatter(s['formatter'])
-        ax2.xaxis.set_major_locator(s['major_locator'])
-        ax2.xaxis.set_minor_locator(s['minor_locator'])
-
-        fig.suptitle('bley ACCEPT/REJECT stats for the last %s (slot=%s)' % (s['title'], s['slotname']))
-        fig2.suptitle('bley check stats for the last %s (slot=%s)' % (s['title'], s['slotname']))
-
-        fig.autofmt_xdate()
-        fig2.autofmt_xdate()
+            for (s, data), written in zip(changed, files):
+                print("plotting %s:" % (s['title']))
+                for filename in written:
+                    print(" - %s" % (filename))
+    else:
+        if settings.format == 'json':
+            files = export_json(settings.destdir, changed) if changed else []
+        else:
+            files = export_csv(settings.destdir, changed)
         if not settings.quiet:
-            print(" - %s" % (os.path.join(settings.destdir, 'ar-%s.png' % s['title'])))
-            print(" - %s" % (os.path.join(settings.destdir, 'ch-%s.png' % s['title'])))
-        fig.savefig(os.path.join(settings.destdir, 'ar-%s.png' % s['title']))
-        fig2.savefig(os.path.join(settings.destdir, 'ch-%s.png' % s['title']))
+            for filename in files:
+                print(" - %s" % (filename))
+
+    save_state(state_file, source, end - datetime.timedelta(0, 60 * 60, 0), counters,
+               new_digests)
+
+    if settings.format != 'png':
+        return
+
+    for s in TIMESLOTS:
         __ar_files.append('<img src="ar-%s.png" alt="bley ACCEPT/REJECT stats for the last %s" />' % (s['title'], s['title']))
         __ch_files.append('<img src="ch-%s.png" alt="bley check stats for the last %s" />' % (s['title'], s['title']))
 
-    dbc.close()
-    db.close()
-
     html = {
         'ar': '<br />'.join(__ar_files),
         'ch': '<br />'.join(__ch_files),
@@ -30,6 +30,7 @@ from __future__ import print_function
 import spf
 import re
 import ipaddress
+from twisted.names import dns
 try:
     import publicsuffix2
 except ImportError:
@@ -60,6 +61,28 @@ def reverse_ip(ip):
         return '.'.join(a)
 
 
+def dns_ttl(answers, authority):
+    '''Return how long a DNS answer may be cached.
+
+    Positive answers are valid for the lowest TTL of their records,
+    negative answers for the negative caching TTL of the SOA record
+    in the authority section (RFC 2308).
+
+    @type  answers: list
+    @param answers: the records of the answer section
+    @type  authority: list
+    @param authority: the records of the authority section
+    @rtype:    int
+    @return:   the TTL in seconds, 0 if the answer must not be cached
+    '''
+    if answers:
+        return min(rr.ttl for rr in answers)
+    for rr in authority:
+        if rr.type == dns.SOA:
+            return min(rr.ttl, rr.payload.minimum)
+    return 0
+
+
 def domain_from_host(host):
     '''Return the domain part of a host.
 
@@ -127,7 +150,7 @@ def check_helo(params):
     return score
 
 
-def check_spf(params, guess):
+def check_spf(params, guess, timeout=0):
     '''Check the SPF record of the sending address.
     Try Best Guess when the domain has no SPF record.
     Returns 1 when the SPF result is in ['fail', 'softfail'],
@@ -137,12 +160,15 @@ def check_spf(params, guess):
     @param params: the params from Postfix
     @type  guess:  int
     @param guess:  1 if use 'best guess', 0 if not
+    @type  timeout: int
+    @param timeout: max seconds for all DNS lookups, 0 for pyspf's default
     @rtype:        int
     @return:       1 if bad SPF, 0 else
     '''
     score = 0
     try:
-        s = spf.query(params['client_address'], params['sender'], params['helo_name'])
+        s = spf.query(params['client_address'], params['sender'], params['helo_name'],
+                      querytime=timeout)
         r = s.check()
         if r[0] in ['fail', 'softfail']:
             score = 1
@@ -161,6 +187,67 @@ def check_spf(params, guess):
 
 
 def adapt_query_for_sqlite3(query):
-    # WARNING: This is a hack to convert the usual pyformat strings
-    # to named ones used by sqlite3
-    return query.replace('%(', ':').replace(')s', '')
+    # WARNING: This is a hack to convert the usual pyformat and format
+    # strings to named and qmark ones used by sqlite3
+    return query.replace('%(', ':').replace(')s', '').replace('%s', '?')
+
+
+def aggregate_ip(ip, ipv4_prefix, ipv6_prefix):
+    '''Returns the address of the network ip belongs to.
+
+    @type  ip: string
+    @param ip: the IP address
+    @type  ipv4_prefix: int
+    @param ipv4_prefix: prefix length of the networks IPv4 addresses belong to
+    @type  ipv6_prefix: int
+    @param ipv6_prefix: prefix length of the networks IPv6 addresses belong to
+    @rtype:    string
+    @return:   the network address in exploded form, like the addresses we
+               get from Postfix, ip itself for full-length prefixes
+    '''
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 4:
+        prefix = ipv4_prefix
+    else:
+        prefix = ipv6_prefix
+    if prefix >= address.max_prefixlen:
+        return ip
+    return ipaddress.ip_network((address, prefix), strict=False).network_address.exploded
+
+
+def pack_ip(settings, ip):
+    '''Returns the IP address the way it is stored in the database.
+
+    With compact_ip, MySQL and SQLite store the packed binary address,
+    PostgreSQL uses the inet type and takes the address as string.
+
+    @type  settings: C{optparse.Values}
+    @param settings: the settings of bley
+    @type  ip: string
+    @param ip: the IP address
+    @rtype:    string or bytes
+    '''
+    if settings.compact_ip and settings.dbtype != 'pgsql':
+        return ipaddress.ip_address(ip).packed
+    return ip
+
+
+def unpack_ip(value):
+    '''Returns an IP address read from the database as string.
+
+    The address is returned in exploded form, like the client addresses
+    we get from Postfix, as PostgreSQL returns inet values compressed.
+
+    @type  value: string or bytes
+    @param value: the address as stored by L{pack_ip}
+    @rtype:    string
+    '''
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+    try:
+        return ipaddress.ip_address(value).exploded
+    except ValueError:
+        return value
@@ -0,0 +1,140 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.web import resource
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import bisect
+import time
+
+
+class Histogram(object):
+    '''Counts observed values in buckets, like a Prometheus histogram.'''
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self):
+        '''Return the cumulative (upper bound, count) of every bucket.
+
+        @rtype: list
+        '''
+        bounds = ['%g' % bound for bound in self.BUCKETS] + ['+Inf']
+        cumulative = 0
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+
+class Metrics(object):
+    '''Latency histograms of the stages of the policy check and of the
+    decisions, by the path taken to them.
+
+    Further metrics are added by the collectors, callables returning a list
+    of (name, type, help, samples) metric families, where samples is a list
+    of (labels, value) tuples and labels is a dict.
+    '''
+
+    STAGES = ('cache', 'db', 'whitelist', 'dnswl', 'dnsbl', 'helo', 'spf',
+              'db_update')
+    PATHS = ('cached', 'whitelisted', 'db_unavailable', 'new', 'greyed',
+             'known_good')
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.stages = OrderedDict((stage, Histogram()) for stage in self.STAGES)
+        self.paths = OrderedDict((path, Histogram()) for path in self.PATHS)
+        self.collectors = []
+
+    @contextmanager
+    def timer(self, stage):
+        '''Measure the time spent in the with block as stage.'''
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[stage].observe(self.clock() - start)
+
+    def decision(self, path, start):
+        '''Record a decision taken by path, the check started at start.'''
+        self.paths[path].observe(self.clock() - start)
+
+    def render(self):
+        '''Return all metrics in the Prometheus text format.
+
+        @rtype: string
+        '''
+        lines = []
+        for name, label, histograms, help_text in (
+                ('bley_stage_duration_seconds', 'stage', self.stages,
+                 'Time spent in the stages of the policy check.'),
+                ('bley_decision_duration_seconds', 'path', self.paths,
+                 'Time taken by the policy check, by decision path.')):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s histogram' % name)
+            for key, histogram in histograms.items():
+                for bound, count in histogram.buckets():
+                    lines.append('%s_bucket{%s="%s",le="%s"} %i' % (name, label, key, bound, count))
+                lines.append('%s_sum{%s="%s"} %r' % (name, label, key, histogram.sum))
+                lines.append('%s_count{%s="%s"} %i' % (name, label, key, histogram.count))
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in samples:
+                    labels = ','.join('%s="%s"' % item for item in sorted(labels.items()))
+                    lines.append('%s%s %r' % (name, '{%s}' % labels if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    '''Serves the metrics over HTTP, on any path.'''
+
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self.metrics.render().encode('utf-8')
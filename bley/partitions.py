@@ -0,0 +1,228 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+import datetime
+import logging
+import re
+
+from bley.actionlog import ActionLog
+
+logger = logging.getLogger('bley')
+
+
+def month_start(date):
+    '''Return the first moment of the month date is in.'''
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def next_month(date):
+    '''Return the first moment of the month after the one date is in.'''
+    return datetime.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+class LogPartitions(object):
+    '''Monthly partitions of bley_log.
+
+    On PostgreSQL and MySQL, bley_log is a natively range partitioned table,
+    on SQLite it is a view over one table per month, with a trigger routing
+    inserted rows to the right table.
+    Every partition is named after the month it holds, bley_log_YYYYMM, the
+    rows of a table which existed before it was partitioned are kept in
+    bley_log_before_YYYYMM. As that table already holds rows of the month
+    it was partitioned in, it takes the rest of that month too, and YYYYMM
+    is the month after. Partitions for the current and the next
+    MONTHS_AHEAD months are created in advance, partitions which only
+    hold rows older than purge_log_days are dropped.
+    '''
+
+    MONTHS_AHEAD = 1
+
+    __NAME = re.compile(r'^bley_log_(before_)?(\d{4})(\d{2})$')
+
+    def __init__(self, settings, clock=datetime.datetime.now):
+        self.settings = settings
+        self.clock = clock
+
+    def bounds(self, name):
+        '''Return the (start, end) of the rows in partition name.
+
+        @rtype: tuple
+        @return: start is None for bley_log_before_YYYYMM partitions,
+                 None if name is not the name of a partition
+        '''
+        match = self.__NAME.match(name)
+        if not match:
+            return None
+        month = datetime.datetime(int(match.group(2)), int(match.group(3)), 1)
+        if match.group(1):
+            return (None, month)
+        return (month, next_month(month))
+
+    def name(self, month):
+        return 'bley_log_%04i%02i' % (month.year, month.month)
+
+    def plan(self, names):
+        '''Decide which partitions to create and which to drop.
+
+        @type  names: list
+        @param names: the names of the existing partitions
+        @rtype: tuple
+        @return: (months to create, names to drop)
+        '''
+        now = self.clock()
+        ends = [self.bounds(name)[1] for name in names]
+        create = []
+        month = month_start(now)
+        for i in range(self.MONTHS_AHEAD + 1):
+            if not ends or month >= max(ends):
+                create.append(month)
+            month = next_month(month)
+        drop = []
+        if self.settings.purge_log_days > 0:
+            cutoff = now - datetime.timedelta(self.settings.purge_log_days)
+            drop = [name for name, end in zip(names, ends) if end <= cutoff]
+        return create, drop
+
+    def maintain(self, txn):
+        '''Partition bley_log if needed, create and drop partitions.
+
+        @type  txn: cursor
+        @param txn: a cursor of the database connection
+        @rtype: list
+        @return: the names of the dropped partitions
+        '''
+        if self.settings.dbtype == 'pgsql':
+            return self._maintain_pg(txn)
+        elif self.settings.dbtype == 'sqlite3':
+            return self._maintain_sqlite(txn)
+        return self._maintain_mysql(txn)
+
+    def _convert_name(self):
+        month = next_month(self.clock())
+        return 'bley_log_before_%04i%02i' % (month.year, month.month)
+
+    def _maintain_pg(self, txn):
+        txn.execute("SELECT relkind FROM pg_catalog.pg_class WHERE relname = 'bley_log'")
+        if txn.fetchone()[0] != 'p':
+            legacy = self._convert_name()
+            logger.info('Partitioning bley_log, existing rows are kept in %s' % legacy)
+            txn.execute('ALTER TABLE bley_log RENAME TO %s' % legacy)
+            txn.execute('ALTER INDEX bley_log_index RENAME TO %s_index' % legacy)
+            txn.execute('''CREATE TABLE bley_log (LIKE %s INCLUDING DEFAULTS)
+                           PARTITION BY RANGE (logtime)''' % legacy)
+            txn.execute('''CREATE INDEX bley_log_index ON bley_log
+                           (logtime DESC NULLS FIRST, action ASC NULLS LAST)''')
+            txn.execute('''ALTER TABLE bley_log ATTACH PARTITION %s
+                           FOR VALUES FROM (MINVALUE) TO (%%s)''' % legacy,
+                        (self.bounds(legacy)[1],))
+        txn.execute('''SELECT c.relname FROM pg_catalog.pg_inherits i
+                       JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+                       JOIN pg_catalog.pg_class p ON p.oid = i.inhparent
+                       WHERE p.relname = 'bley_log' ''')
+        names = [row[0] for row in txn.fetchall() if self.bounds(row[0])]
+        create, drop = self.plan(names)
+        for month in create:
+            txn.execute('''CREATE TABLE %s PARTITION OF bley_log
+                           FOR VALUES FROM (%%s) TO (%%s)''' % self.name(month),
+                        (month, next_month(month)))
+        for name in drop:
+            txn.execute('DROP TABLE %s' % name)
+        return drop
+
+    def _maintain_mysql(self, txn):
+        txn.execute('''SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+                       WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'bley_log' ''')
+        names = [row[0] for row in txn.fetchall() if row[0]]
+        if not names:
+            legacy = self._convert_name()
+            logger.info('Partitioning bley_log, existing rows are kept in %s' % legacy)
+            txn.execute('''ALTER TABLE bley_log
+                           PARTITION BY RANGE (UNIX_TIMESTAMP(logtime)) (
+                           PARTITION %s VALUES LESS THAN (UNIX_TIMESTAMP(%%s)),
+                           PARTITION bley_log_max VALUES LESS THAN MAXVALUE)''' % legacy,
+                        (self.bounds(legacy)[1],))
+            names = [legacy]
+        names = [name for name in names if self.bounds(name)]
+        create, drop = self.plan(names)
+        for month in create:
+            txn.execute('''ALTER TABLE bley_log REORGANIZE PARTITION bley_log_max INTO (
+                           PARTITION %s VALUES LESS THAN (UNIX_TIMESTAMP(%%s)),
+                           PARTITION bley_log_max VALUES LESS THAN MAXVALUE)''' % self.name(month),
+                        (next_month(month),))
+        for name in drop:
+            txn.execute('ALTER TABLE bley_log DROP PARTITION %s' % name)
+        return drop
+
+    def _maintain_sqlite(self, txn):
+        txn.execute("SELECT type FROM sqlite_master WHERE name = 'bley_log'")
+        if txn.fetchone()[0] == 'table':
+            legacy = self._convert_name()
+            logger.info('Partitioning bley_log, existing rows are kept in %s' % legacy)
+            txn.execute('ALTER TABLE bley_log RENAME TO %s' % legacy)
+        txn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name LIKE 'bley_log_%'")
+        tables = dict((name, sql) for (name, sql) in txn.fetchall() if self.bounds(name))
+        create, drop = self.plan(list(tables))
+        template = tables[max(tables, key=lambda name: self.bounds(name)[1])]
+        for month in create:
+            name = self.name(month)
+            txn.execute(re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?"?\w+"?', 'CREATE TABLE %s' % name, template))
+            txn.execute('CREATE INDEX %s_index ON %s (logtime DESC, action ASC)' % (name, name))
+            tables[name] = template
+        for name in drop:
+            del tables[name]
+        if create or drop:
+            self._create_view(txn, sorted(tables, key=lambda name: self.bounds(name)[1]))
+        for name in drop:
+            txn.execute('DROP TABLE %s' % name)
+        return drop
+
+    def _create_view(self, txn, names):
+        '''Create the bley_log view over names and its insert trigger.'''
+        columns = ', '.join(ActionLog.COLUMNS)
+        new_columns = ', '.join('NEW.%s' % column for column in ActionLog.COLUMNS)
+        inserts = []
+        for i, name in enumerate(names):
+            conditions = []
+            if i > 0:
+                conditions.append("NEW.logtime >= '%s'" % self._start(names[i]))
+            if i < len(names) - 1:
+                conditions.append("NEW.logtime < '%s'" % self._start(names[i + 1]))
+            inserts.append('INSERT INTO %s (%s) SELECT %s WHERE %s;' %
+                           (name, columns, new_columns, ' AND '.join(conditions) or '1'))
+        txn.execute('DROP VIEW IF EXISTS bley_log')
+        txn.execute('CREATE VIEW bley_log AS %s' %
+                    ' UNION ALL '.join('SELECT %s FROM %s' % (columns, name) for name in names))
+        txn.execute('CREATE TRIGGER bley_log_insert INSTEAD OF INSERT ON bley_log BEGIN %s END' %
+                    ' '.join(inserts))
+
+    def _start(self, name):
+        '''Return the first logtime of partition name, as stored by bley.'''
+        start, end = self.bounds(name)
+        if start is None:
+            start = end
+        return str(start)
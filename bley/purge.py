@@ -0,0 +1,147 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+import datetime
+import logging
+import time
+
+import bley.helpers
+from bley.partitions import LogPartitions
+
+logger = logging.getLogger('bley')
+
+
+class Purger(object):
+    '''Remove old entries from bley_status, bley_log and bley_stats.
+
+    Every PURGE_INTERVAL seconds, expired rows are deleted in batches of
+    at most purge_batch_size rows, each in its own transaction in the
+    database pool. Between two batches the purger pauses for BATCH_PAUSE
+    seconds, so other queries are not blocked by a long-running DELETE.
+    If bley_log is partitioned, its partitions are maintained instead.
+    The counters in bley_stats are kept for STATS_DAYS days, as long as
+    the longest timeslot bleygraph plots.
+    '''
+
+    PURGE_INTERVAL = 30 * 60
+    BATCH_PAUSE = 1
+    STATS_DAYS = 365
+
+    __STATUS_CONDITION = 'last_action<%(old)s OR (last_action<%(old_bad)s AND status>=2)'
+    __LOG_CONDITION = 'logtime<%(old_log)s'
+    __STATS_CONDITION = 'period<%(old_stats)s'
+
+    __DELETE_QUERY = 'DELETE FROM %s WHERE %s LIMIT %%(limit)s'
+    __DELETE_QUERY_PG = '''DELETE FROM %s WHERE ctid = ANY(ARRAY(
+                           SELECT ctid FROM %s WHERE %s LIMIT %%(limit)s))'''
+    __DELETE_QUERY_SL = '''DELETE FROM %s WHERE rowid IN (
+                           SELECT rowid FROM %s WHERE %s LIMIT %%(limit)s)'''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.running = False
+        self.purger = task.LoopingCall(self.purge)
+        self.partitions = LogPartitions(settings)
+        self.deleted = 0
+        self.purge_duration = 0.0
+
+    def start(self):
+        self.purger.start(self.PURGE_INTERVAL)
+
+    def delete_query(self, table, condition):
+        '''Return the query deleting one batch of rows matching condition.'''
+        if self.settings.dbtype == 'pgsql':
+            return self.__DELETE_QUERY_PG % (table, table, condition)
+        elif self.settings.dbtype == 'sqlite3':
+            return bley.helpers.adapt_query_for_sqlite3(
+                self.__DELETE_QUERY_SL % (table, table, condition))
+        return self.__DELETE_QUERY % (table, condition)
+
+    @defer.inlineCallbacks
+    def purge(self):
+        '''Delete the expired rows of all tables.
+
+        @rtype: C{Deferred}
+        @return: fires when all expired rows are deleted
+        '''
+        if self.running:
+            return
+        self.running = True
+        if self.settings.verbose:
+            logger.info("cleaning database")
+        now = datetime.datetime.now()
+        params = {'old': str(now - datetime.timedelta(self.settings.purge_days)),
+                  'old_bad': str(now - datetime.timedelta(self.settings.purge_bad_days)),
+                  'old_log': str(now - datetime.timedelta(self.settings.purge_log_days)),
+                  'old_stats': str(now - datetime.timedelta(self.STATS_DAYS)),
+                  'limit': self.settings.purge_batch_size}
+        tables = [('bley_status', self.__STATUS_CONDITION)]
+        if self.settings.purge_log_days > 0 and not self.settings.log_partitions:
+            tables.append(('bley_log', self.__LOG_CONDITION))
+        tables.append(('bley_stats', self.__STATS_CONDITION))
+        start = time.monotonic()
+        try:
+            for table, condition in tables:
+                table_start = time.monotonic()
+                deleted = yield self.purge_table(self.delete_query(table, condition), params)
+                if deleted or self.settings.verbose:
+                    logger.info('purged %i rows from %s in %.3f seconds' %
+                                (deleted, table, time.monotonic() - table_start))
+                self.deleted += deleted
+            if self.settings.log_partitions:
+                dropped = yield self.settings.dbpool.runInteraction(self.partitions.maintain)
+                for name in dropped:
+                    logger.info('dropped partition %s of bley_log' % name)
+        except Exception as e:
+            logger.warning('could not clean the database: %s' % e)
+        finally:
+            self.purge_duration = time.monotonic() - start
+            self.running = False
+
+    @defer.inlineCallbacks
+    def purge_table(self, query, params):
+        '''Run query until it deletes less than a full batch.
+
+        @rtype: C{Deferred}
+        @return: the number of deleted rows
+        '''
+        deleted = 0
+        while True:
+            count = yield self.settings.dbpool.runInteraction(self._delete, query, params)
+            deleted += count
+            if count < params['limit']:
+                defer.returnValue(deleted)
+            yield task.deferLater(reactor, self.BATCH_PAUSE, lambda: None)
+
+    def _delete(self, txn, query, params):
+        txn.execute(query, params)
+        return txn.rowcount
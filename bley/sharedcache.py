@@ -0,0 +1,288 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+import fcntl
+import ipaddress
+import mmap
+import os
+import struct
+import time
+import zlib
+
+GOOD = 1
+BAD = 2
+
+
+class SharedVerdictCache(object):
+    '''Cache of greylisting verdicts shared by all bley processes on a host.
+
+    The verdicts are stored in a fixed-size, open-addressed hash table in a
+    memory mapped file, keyed by the packed client IP address. Every slot
+    carries its own expiry time and a checksum, so a slot that is read
+    while another process writes it is treated as a miss.
+    The table is lossy: when all PROBES slots of a key are taken by live
+    entries, the first one is overwritten.
+    Every client address has a single verdict, storing GOOD for an address
+    replaces BAD and vice versa, so the good and the bad cache on top of
+    the table never disagree.
+    The header keeps a count of the used slots, so the size of the table
+    is known without scanning it. It is updated without locking and
+    counts expired entries until they are read or reused, so it is only
+    an approximation.
+    '''
+
+    MAGIC = b'BLEYVC02'
+    HEADER = struct.Struct('<8sII16x')
+    COUNT = struct.Struct('<q')
+    COUNT_OFFSET = 16
+    SLOT = struct.Struct('<16sBBxxId')
+    PROBES = 8
+
+    def __init__(self, path, slots, ttl, clock=time.time):
+        '''
+        @type  path: string
+        @param path: the file the table is stored in
+        @type  slots: int
+        @param slots: number of slots in the table
+        @type  ttl: int
+        @param ttl: default lifetime of an entry in seconds
+        @type  clock: callable
+        @param clock: returns the current (wall clock) time in seconds
+        '''
+        self.path = path
+        self.slots = slots
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.mmap = self._open()
+
+    def _open(self):
+        size = self.HEADER.size + self.slots * self.SLOT.size
+        header = self.HEADER.pack(self.MAGIC, self.slots, self.SLOT.size)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    # replaced by another process meanwhile
+                    continue
+                current = os.pread(fd, self.COUNT_OFFSET, 0)
+                if os.fstat(fd).st_size != size or current != header[:self.COUNT_OFFSET]:
+                    # new file or a table of another size, start from scratch
+                    self._create(size, header)
+                    continue
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+    def _create(self, size, header):
+        '''Replace the table with an empty one of size bytes.
+
+        The new table is written to a temporary file and renamed into
+        place, running processes may still have the old one mapped and
+        would crash if it was truncated.
+        '''
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            os.pwrite(fd, header, 0)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.path)
+
+    def close(self):
+        self.mmap.close()
+
+    def _key(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 4:
+            return b'\0' * 10 + b'\xff\xff' + address.packed, 4
+        return address.packed, 6
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.SLOT.size
+
+    def _read(self, slot):
+        '''Return (key, version, verdict, expiry) of slot, None if empty or torn.'''
+        offset = self._offset(slot)
+        key, version, verdict, checksum, expiry = self.SLOT.unpack_from(self.mmap, offset)
+        if not version:
+            return None
+        if checksum != self._checksum(key, version, verdict, expiry):
+            return None
+        return key, version, verdict, expiry
+
+    def _write(self, slot, key, version, verdict, expiry):
+        offset = self._offset(slot)
+        checksum = self._checksum(key, version, verdict, expiry)
+        self.mmap[offset:offset + self.SLOT.size] = self.SLOT.pack(
+            key, version, verdict, checksum, expiry)
+
+    def _checksum(self, key, version, verdict, expiry):
+        return zlib.crc32(struct.pack('<16sBBd', key, version, verdict, expiry))
+
+    def _count(self, delta):
+        count = self.COUNT.unpack_from(self.mmap, self.COUNT_OFFSET)[0]
+        self.COUNT.pack_into(self.mmap, self.COUNT_OFFSET,
+                             min(max(count + delta, 0), self.slots))
+
+    def _probe(self, key):
+        home = zlib.crc32(key) % self.slots
+        for i in range(min(self.PROBES, self.slots)):
+            yield (home + i) % self.slots
+
+    def __len__(self):
+        '''Return the approximate number of used slots from the header.'''
+        return self.COUNT.unpack_from(self.mmap, self.COUNT_OFFSET)[0]
+
+    def get(self, ip, default=None):
+        '''Return the verdict stored for ip, default if none is valid.'''
+        key = self._key(ip)
+        if key is not None:
+            now = self.clock()
+            for slot in self._probe(key[0]):
+                entry = self._read(slot)
+                if entry is None or entry[0] != key[0]:
+                    continue
+                if entry[3] <= now:
+                    self._write(slot, b'', 0, 0, 0.0)
+                    self._count(-1)
+                    self.expirations += 1
+                    break
+                self.hits += 1
+                return entry[2]
+        self.misses += 1
+        return default
+
+    def set(self, ip, verdict, ttl=None):
+        '''Store verdict for ip, valid for ttl (or the default) seconds.'''
+        key = self._key(ip)
+        if key is None:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            self.delete(ip)
+            return
+        now = self.clock()
+        target = None
+        for slot in self._probe(key[0]):
+            entry = self._read(slot)
+            if entry is not None and entry[0] == key[0]:
+                target, new = slot, False
+                break
+            if target is None and (entry is None or entry[3] <= now):
+                target, new = slot, entry is None
+        if target is None:
+            target, new = zlib.crc32(key[0]) % self.slots, False
+            self.evictions += 1
+        self._write(target, key[0], key[1], verdict, now + ttl)
+        if new:
+            self._count(1)
+
+    def delete(self, ip):
+        key = self._key(ip)
+        if key is None:
+            return
+        for slot in self._probe(key[0]):
+            entry = self._read(slot)
+            if entry is not None and entry[0] == key[0]:
+                self._write(slot, b'', 0, 0, 0.0)
+                self._count(-1)
+
+    def sweep(self):
+        '''Expired slots are reused by set(), there is nothing to remove.'''
+        pass
+
+    def stats(self):
+        '''Return the size and the counters of the cache.
+
+        The size is the approximate count from the header.
+
+        @rtype: dict
+        '''
+        return {'size': len(self), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def view(self, verdict):
+        '''Return a Cache-like view of the entries with the given verdict.
+
+        The views share the slots, setting an address in one view removes
+        it from the others.
+        '''
+        return VerdictCacheView(self, verdict)
+
+
+class VerdictCacheView(object):
+    '''The entries of a SharedVerdictCache with one verdict.
+
+    Provides the interface of bley.cache.Cache, so it can be used
+    as good_cache or bad_cache of the factory.
+    '''
+
+    def __init__(self, shared, verdict):
+        self.shared = shared
+        self.verdict = verdict
+
+    @property
+    def ttl(self):
+        return self.shared.ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self.shared.ttl = ttl
+
+    def __len__(self):
+        return len(self.shared)
+
+    def get(self, key, default=None):
+        if self.shared.get(key) == self.verdict:
+            return True
+        return default
+
+    def set(self, key, value=True, ttl=None):
+        self.shared.set(key, self.verdict, ttl)
+
+    def delete(self, key):
+        if self.shared.get(key) == self.verdict:
+            self.shared.delete(key)
+
+    def sweep(self):
+        self.shared.sweep()
+
+    def stats(self):
+        return self.shared.stats()
@@ -0,0 +1,262 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.internet import defer
+from twisted.internet import task
+
+from collections import OrderedDict
+
+import datetime
+import logging
+
+import bley.helpers
+from bley.actionlog import ActionLog
+
+logger = logging.getLogger('bley')
+
+# the actions counted as ham and spam
+ACTIONS = OrderedDict([('ham', 'DUNNO'), ('spam', 'DEFER_IF_PERMIT')])
+
+
+def categories(dnswl_threshold, dnsbl_threshold, rfc_threshold):
+    '''Return the categories of the actions logged in bley_log.
+
+    Every category is counted for one action and defined twice, as SQL
+    predicate on bley_log ('query') and as Python predicate on a dict of
+    the same columns ('test'), both have to agree.
+
+    @rtype: C{OrderedDict}
+    @return: name -> {'action', 'query', 'test', 'color'}
+    '''
+    spam = ACTIONS['spam']
+    ham = ACTIONS['ham']
+
+    def rfc(c, *checks):
+        return sum(c[check] for check in checks)
+
+    return OrderedDict([
+        ('in DNSBL', {'action': spam, 'color': 'black',
+                      'query': 'check_db=-1 and check_cache=0 and check_dnsbl>=%i' % (dnsbl_threshold),
+                      'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and c['check_dnsbl'] >= dnsbl_threshold}),
+        ('bad HELO', {'action': spam, 'color': 'red',
+                      'query': 'check_db=-1 and check_cache=0 and check_helo>=%i and check_dnsbl<%i' % (rfc_threshold, dnsbl_threshold),
+                      'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and c['check_helo'] >= rfc_threshold and c['check_dnsbl'] < dnsbl_threshold}),
+        ('bad grey', {'action': spam, 'color': 'blue',
+                      'query': 'check_db=2 and check_cache=0 and check_dnsbl<%i' % (dnsbl_threshold),
+                      'test': lambda c: c['check_db'] == 2 and c['check_cache'] == 0 and c['check_dnsbl'] < dnsbl_threshold}),
+        ('from DynIP', {'action': spam, 'color': 'orange',
+                        'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn)>=%i and check_helo<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold),
+                        'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and rfc(c, 'check_helo', 'check_dyn') >= rfc_threshold and c['check_helo'] < rfc_threshold and c['check_dnsbl'] < dnsbl_threshold}),
+        ('bad SPF', {'action': spam, 'color': 'yellow',
+                     'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn+check_spf)>=%i and (check_helo+check_dyn)<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold),
+                     'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and rfc(c, 'check_helo', 'check_dyn', 'check_spf') >= rfc_threshold and rfc(c, 'check_helo', 'check_dyn') < rfc_threshold and c['check_dnsbl'] < dnsbl_threshold}),
+        ('sender==recipient', {'action': spam, 'color': 'orange',
+                               'query': 'check_db=-1 and check_cache=0 and (check_helo+check_dyn+check_spf+check_s_eq_r)>=%i and (check_helo+check_dyn+check_spf)<%i and check_dnsbl<%i' % (rfc_threshold, rfc_threshold, dnsbl_threshold),
+                               'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and rfc(c, 'check_helo', 'check_dyn', 'check_spf', 'check_s_eq_r') >= rfc_threshold and rfc(c, 'check_helo', 'check_dyn', 'check_spf') < rfc_threshold and c['check_dnsbl'] < dnsbl_threshold}),
+        ('bad cache', {'action': spam, 'color': 'pink',
+                       'query': 'check_db=-1 and check_cache=1 and check_dnsbl<%i' % (dnsbl_threshold),
+                       'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 1 and c['check_dnsbl'] < dnsbl_threshold}),
+        ('known good', {'action': ham, 'color': 'green',
+                        'query': '(check_db=0 or check_db=1) and check_cache=0',
+                        'test': lambda c: c['check_db'] in (0, 1) and c['check_cache'] == 0}),
+        ('good grey', {'action': ham, 'color': 'lightblue',
+                       'query': 'check_db=2 and check_cache=0',
+                       'test': lambda c: c['check_db'] == 2 and c['check_cache'] == 0}),
+        ('new good', {'action': ham, 'color': 'lightgreen',
+                      'query': 'check_db=-1 and check_cache=0 and check_dnswl<%i' % (dnswl_threshold),
+                      'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and c['check_dnswl'] < dnswl_threshold}),
+        ('in DNSWL', {'action': ham, 'color': 'lightgrey',
+                      'query': 'check_db=-1 and check_cache=0 and check_dnswl>=%i' % (dnswl_threshold),
+                      'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 0 and c['check_dnswl'] >= dnswl_threshold}),
+        ('good cache', {'action': ham, 'color': 'darkgreen',
+                        'query': 'check_db=-1 and check_cache=1',
+                        'test': lambda c: c['check_db'] == -1 and c['check_cache'] == 1}),
+    ])
+
+
+def classify(columns, category_defs):
+    '''Return the names of the categories an action belongs to.
+
+    @type  columns: dict
+    @param columns: the bley_log columns of the action
+    @type  category_defs: C{OrderedDict}
+    @param category_defs: as returned by L{categories}
+    @rtype: list
+    '''
+    action = columns['action']
+    names = [name for name, logged in ACTIONS.items() if logged == action]
+    if names:
+        names.extend(name for name, category in category_defs.items()
+                     if category['action'] == action and category['test'](columns))
+    return names
+
+
+def hour_start(logtime):
+    return logtime.replace(minute=0, second=0, microsecond=0)
+
+
+# the start of the hour of logtime, as SQL expression
+HOUR = {'pgsql': "date_trunc('hour', logtime)",
+        'mysql': "DATE_FORMAT(logtime, '%%Y-%%m-%%d %%H:00:00')",
+        'sqlite3': "strftime('%Y-%m-%d %H:00:00', logtime)"}
+
+
+def count_log(txn, dbtype, category_defs, start=None, end=None):
+    '''Count the actions in bley_log per hour and category.
+
+    All categories are counted in a single scan of bley_log, grouped by
+    hour and action.
+
+    @type  txn: cursor
+    @param txn: a cursor of the database connection
+    @type  dbtype: string
+    @param dbtype: the type of the database
+    @type  category_defs: C{OrderedDict}
+    @param category_defs: as returned by L{categories}
+    @type  start: C{datetime.datetime}
+    @param start: count actions from start on, if given
+    @type  end: C{datetime.datetime}
+    @param end: count actions before end, if given
+    @rtype: list
+    @return: (period, category, mails) tuples, without zero counts
+    '''
+    sums = ['SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % category['query']
+            for category in category_defs.values()]
+    query = 'SELECT %s, action, COUNT(action), %s FROM bley_log WHERE action IN (%s)' % (
+        HOUR[dbtype], ', '.join(sums),
+        ', '.join("'%s'" % action for action in ACTIONS.values()))
+    params = {}
+    if start is not None:
+        query += ' AND logtime>=%(start)s'
+        params['start'] = str(start)
+    if end is not None:
+        query += ' AND logtime<%(end)s'
+        params['end'] = str(end)
+    query += ' GROUP BY 1, action'
+    if dbtype == 'sqlite3':
+        query = bley.helpers.adapt_query_for_sqlite3(query)
+    txn.execute(query, params)
+    counters = []
+    for row in txn.fetchall():
+        period = row[0]
+        if not isinstance(period, datetime.datetime):
+            period = datetime.datetime.strptime(str(period), '%Y-%m-%d %H:%M:%S')
+        action = row[1]
+        counts = [(name, row[2]) for name, logged in ACTIONS.items() if logged == action]
+        counts.extend((name, mails) for (name, category), mails
+                      in zip(category_defs.items(), row[3:])
+                      if category['action'] == action)
+        counters.extend((period, name, int(mails)) for name, mails in counts if mails)
+    return counters
+
+
+class StatsRollup(object):
+    '''Hourly counters of the actions per category, kept in bley_stats.
+
+    The counters are collected in memory and added to the database every
+    log_flush_interval seconds, so bleygraph does not have to scan bley_log.
+    '''
+
+    __UPSERT_QUERY = '''INSERT INTO bley_stats (period, category, mails)
+                        VALUES(%(period)s, %(category)s, %(mails)s)
+                        ON CONFLICT (period, category) DO UPDATE
+                        SET mails=bley_stats.mails+excluded.mails'''
+    __UPSERT_QUERY_MYSQL = '''INSERT INTO bley_stats (period, category, mails)
+                              VALUES(%(period)s, %(category)s, %(mails)s)
+                              ON DUPLICATE KEY UPDATE mails=mails+VALUES(mails)'''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.counters = {}
+        self.flusher = task.LoopingCall(self.flush)
+        self.settings_changed()
+
+    def settings_changed(self):
+        '''Define the categories again, for changed thresholds.'''
+        self.category_defs = categories(self.settings.dnswl_threshold,
+                                        self.settings.dnsbl_threshold,
+                                        self.settings.rfc_threshold)
+
+    def start(self):
+        self.flusher.start(self.settings.log_flush_interval, now=False)
+
+    def add(self, logtime, row):
+        '''Count an action.
+
+        @type  logtime: C{datetime.datetime}
+        @param logtime: when the action was taken
+        @type  row: tuple
+        @param row: the action as appended to the L{ActionLog}
+        '''
+        period = hour_start(logtime)
+        for name in classify(dict(zip(ActionLog.COLUMNS, row)), self.category_defs):
+            key = (period, name)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def flush(self):
+        '''Add the collected counters to bley_stats.
+
+        @rtype: C{Deferred}
+        @return: fires when the counters are written
+        '''
+        if not self.counters:
+            return defer.succeed(None)
+        counters, self.counters = self.counters, {}
+        rows = [{'period': str(period), 'category': name, 'mails': mails}
+                for (period, name), mails in counters.items()]
+        d = self.settings.dbpool.runInteraction(self._write, rows)
+        d.addErrback(self._flush_failed, counters)
+        return d
+
+    def backfill(self, txn):
+        '''Count the actions already in bley_log.
+
+        Used once, when bley_stats is created.
+
+        @type  txn: cursor
+        @param txn: a cursor of the database connection
+        '''
+        rows = [{'period': str(period), 'category': name, 'mails': mails}
+                for period, name, mails in
+                count_log(txn, self.settings.dbtype, self.category_defs)]
+        self._write(txn, rows)
+
+    def _write(self, txn, rows):
+        if self.settings.dbtype == 'mysql':
+            query = self.__UPSERT_QUERY_MYSQL
+        elif self.settings.dbtype == 'sqlite3':
+            query = bley.helpers.adapt_query_for_sqlite3(self.__UPSERT_QUERY)
+        else:
+            query = self.__UPSERT_QUERY
+        txn.executemany(query, rows)
+
+    def _flush_failed(self, failure, counters):
+        logger.warning('could not write bley_stats to the database: %s' %
+                       failure.getErrorMessage())
+        for key, mails in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + mails
@@ -0,0 +1,200 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+import datetime
+import logging
+
+import bley.helpers
+
+logger = logging.getLogger('bley')
+
+
+class TripletStore(object):
+    '''In-memory copy of the bley_status table.
+
+    The (ip,sender,recipient) tuples are loaded from the database at startup
+    and answered from memory afterwards. Changed tuples are written back to
+    the database periodically in one transaction.
+    '''
+
+    __LOAD_QUERY = '''SELECT ip, sender, recipient, status, last_action,
+                      fail_count FROM bley_status'''
+    __UPSERT_QUERY = '''INSERT INTO bley_status (ip, status, last_action,
+                        sender, recipient, fail_count)
+                        VALUES(%(ip)s, %(status)s, %(last_action)s,
+                        %(sender)s, %(recipient)s, %(fail_count)s)
+                        ON CONFLICT (ip, sender, recipient) DO UPDATE
+                        SET status=excluded.status,
+                        last_action=excluded.last_action,
+                        fail_count=excluded.fail_count'''
+    __UPSERT_QUERY_MYSQL = '''INSERT INTO bley_status (ip, status, last_action,
+                              sender, recipient, fail_count)
+                              VALUES(%(ip)s, %(status)s, %(last_action)s,
+                              %(sender)s, %(recipient)s, %(fail_count)s)
+                              ON DUPLICATE KEY UPDATE status=VALUES(status),
+                              last_action=VALUES(last_action),
+                              fail_count=VALUES(fail_count)'''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.triplets = {}
+        self.dirty = set()
+        self.loaded = False
+        self.flusher = task.LoopingCall(self.flush)
+        self.purger = task.LoopingCall(self.purge)
+
+    def start(self):
+        '''Load the database and start flushing changes periodically.'''
+        d = self.load()
+        d.addCallback(self._start_flusher)
+        return d
+
+    def _start_flusher(self, result):
+        self.flusher.start(self.settings.memory_store_flush, now=False)
+        self.purger.start(30 * 60, now=False)
+
+    def load(self):
+        '''Load all tuples from bley_status into memory.
+
+        @rtype: C{Deferred}
+        @return: fires when the tuples are loaded
+        '''
+        d = self.settings.dbpool.runQuery(self.__LOAD_QUERY)
+        d.addCallbacks(self._loaded, self._load_failed)
+        return d
+
+    def _loaded(self, rows):
+        for (ip, sender, recipient, status, last_action, fail_count) in rows:
+            key = (bley.helpers.unpack_ip(ip), sender, recipient)
+            if key in self.triplets and self.triplets[key][0] <= status:
+                continue
+            self.triplets[key] = [status, last_action, fail_count or 0]
+        self.loaded = True
+        logger.info('loaded %i entries of bley_status into memory' %
+                    len(self.triplets))
+
+    def _load_failed(self, failure):
+        logger.warning('could not load bley_status into memory: %s' %
+                       failure.getErrorMessage())
+        return task.deferLater(reactor, 60, self.load)
+
+    def lookup(self, postfix_params):
+        '''Look up the (ip,sender,recipient) tuple.
+
+        @type  postfix_params: dict
+        @param postfix_params: parameters we got from Postfix
+        @rtype: tuple
+        @return: the tuple in the same form the database would return it,
+                 -1 if not found
+        '''
+        key = (postfix_params['client_address'], postfix_params['sender'],
+               postfix_params['recipient'])
+        entry = self.triplets.get(key)
+        if entry is None:
+            return -1
+        return (entry[0], entry[1], entry[2], key[1], key[2])
+
+    def update(self, postfix_params, operation):
+        '''Update the (ip,sender,recipient) tuple in memory.
+
+        The change will be written to the database by the next flush().
+
+        @type  postfix_params: dict
+        @param postfix_params: parameters we got from Postfix
+        @type  operation: string
+        @param operation: one of the keys of C{bley.bley.STATUS_QUERIES}
+        '''
+        key = (postfix_params['client_address'], postfix_params['sender'],
+               postfix_params['recipient'])
+        entry = self.triplets.get(key)
+        if operation == 'insert':
+            if entry is not None:
+                # the other request already inserted while we checked, ignore
+                return
+            self.triplets[key] = [postfix_params['new_status'],
+                                  postfix_params['now'], 0]
+        elif entry is None:
+            return
+        elif operation == 'ungrey':
+            entry[0] = 0
+            entry[1] = postfix_params['now']
+        elif operation == 'fail':
+            entry[2] += 1
+        elif operation == 'touch':
+            entry[1] = postfix_params['now']
+        self.dirty.add(key)
+
+    def flush(self):
+        '''Write all changed tuples to the database.
+
+        @rtype: C{Deferred}
+        @return: fires when the changes are committed
+        '''
+        if not self.dirty:
+            return defer.succeed(None)
+        keys, self.dirty = self.dirty, set()
+        rows = []
+        for key in keys:
+            entry = self.triplets.get(key)
+            if entry is None:
+                continue
+            rows.append({'ip': bley.helpers.pack_ip(self.settings, key[0]),
+                         'sender': key[1], 'recipient': key[2],
+                         'status': entry[0], 'last_action': entry[1],
+                         'fail_count': entry[2]})
+        d = self.settings.dbpool.runInteraction(self._write, rows)
+        d.addErrback(self._flush_failed, keys)
+        return d
+
+    def _write(self, txn, rows):
+        if self.settings.dbtype == 'mysql':
+            query = self.__UPSERT_QUERY_MYSQL
+        elif self.settings.dbtype == 'sqlite3':
+            query = bley.helpers.adapt_query_for_sqlite3(self.__UPSERT_QUERY)
+        else:
+            query = self.__UPSERT_QUERY
+        txn.executemany(query, rows)
+
+    def _flush_failed(self, failure, keys):
+        logger.warning('could not write bley_status to the database: %s' %
+                       failure.getErrorMessage())
+        self.dirty |= keys
+
+    def purge(self):
+        '''Drop old entries from memory, like L{bley.purge.Purger} does in SQL.'''
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(self.settings.purge_days, 0, 0)
+        old_bad = now - datetime.timedelta(self.settings.purge_bad_days, 0, 0)
+        for key, entry in list(self.triplets.items()):
+            if entry[1] < old or (entry[1] < old_bad and entry[0] >= 2):
+                del self.triplets[key]
+                self.dirty.discard(key)
@@ -0,0 +1,180 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+import re
+
+regexp_type = type(re.compile(''))
+_separator = re.compile(r'[.@]')
+_backreference = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class Whitelist(object):
+    '''Compiled matcher for the entries of a whitelist file.
+
+    An address matches if any of
+        the address matches the entire entry
+        the address matches a regular expression entry
+        the address domain (or subdomain) matches the entry (which is a
+        domain name)
+        the address user@ part matches an entry of the form user@
+
+    Instead of testing every entry, plain entries are kept in hash sets
+    and all regular expressions are combined into one, so the cost of a
+    lookup does not grow with the length of the whitelist.
+    '''
+
+    def __init__(self, entries=()):
+        '''
+        @type  entries: list
+        @param entries: strings and compiled regular expressions
+        '''
+        self.domains = set()
+        self.users = set()
+        self.prefixes = []
+        self.patterns = []
+        self.regex = None
+        self.regex_rules = {}
+        combinable = []
+        for entry in entries:
+            if isinstance(entry, regexp_type):
+                if entry.flags == re.compile('').flags and not _backreference.search(entry.pattern):
+                    combinable.append(entry)
+                else:
+                    self.patterns.append(entry)
+            elif entry.endswith('@'):
+                if entry.count('@') == 1:
+                    self.users.add(entry)
+                else:
+                    self.prefixes.append(entry)
+            else:
+                self.domains.add(entry)
+        if combinable:
+            alternatives = []
+            for i, entry in enumerate(combinable):
+                name = '_wl%i' % i
+                alternatives.append('(?P<%s>%s)' % (name, entry.pattern))
+                self.regex_rules[name] = entry.pattern
+            try:
+                self.regex = re.compile('|'.join(alternatives))
+            except re.error:
+                # e.g. the same named group in two entries
+                self.regex_rules = {}
+                self.patterns.extend(combinable)
+
+    def __len__(self):
+        return (len(self.domains) + len(self.users) + len(self.prefixes)
+                + len(self.patterns) + len(self.regex_rules))
+
+    def match(self, email):
+        '''Check email against the whitelist.
+
+        @type  email: string
+        @param email: the (lowercased) address or host name to check
+        @rtype: string
+        @return: the matching entry, None if no entry matches
+        '''
+        if email in self.domains:
+            # Whole email match (for whitelist_recipients)
+            # Or domain match (for whitelist_clients)
+            return email
+        for separator in _separator.finditer(email):
+            # @domain or subdomain match
+            suffix = email[separator.end():]
+            if suffix in self.domains:
+                return suffix
+        at = email.find('@')
+        if at != -1 and email[:at + 1] in self.users:
+            # user@ (any domain) match
+            return email[:at + 1]
+        for entry in self.prefixes:
+            if email.startswith(entry):
+                return entry
+        if self.regex is not None:
+            m = self.regex.search(email)
+            if m is not None:
+                return self.regex_rules[m.lastgroup]
+        for entry in self.patterns:
+            if entry.search(email) is not None:
+                return entry.pattern
+        return None
+
+
+class NetworkWhitelist(object):
+    '''Longest prefix match of IP addresses against a list of networks.
+
+    The networks are kept in a binary trie per IP version, so a lookup
+    takes at most 32 (or 128) steps, no matter how many networks are
+    whitelisted.
+    '''
+
+    def __init__(self, networks=()):
+        '''
+        @type  networks: list
+        @param networks: C{ipaddress} network objects
+        '''
+        # every node is a list of [child for bit 0, child for bit 1, network]
+        self.tries = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+        for network in networks:
+            self.add(network)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, network):
+        '''Add an C{ipaddress} network to the whitelist.'''
+        node = self.tries[network.version]
+        address = int(network.network_address)
+        width = network.max_prefixlen
+        for i in range(network.prefixlen):
+            bit = (address >> (width - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.count += 1
+        node[2] = network
+
+    def match(self, ip):
+        '''Find the most specific network containing ip.
+
+        @type  ip: C{ipaddress.IPv4Address} or C{ipaddress.IPv6Address}
+        @param ip: the address to check
+        @return: the matching network, None if ip is not whitelisted
+        '''
+        node = self.tries[ip.version]
+        address = int(ip)
+        width = ip.max_prefixlen
+        best = node[2]
+        for i in range(width - 1, -1, -1):
+            node = node[(address >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                best = node[2]
+        return best
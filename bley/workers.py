@@ -0,0 +1,183 @@
+# Copyright (c) 2009-2014 Evgeni Golov <evgeni@golov.de>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+
+from twisted.application import service
+from twisted.internet import defer
+from twisted.internet import protocol
+from twisted.internet import reactor
+from twisted.internet import error
+
+import logging
+import os
+import signal
+import socket
+import sys
+
+logger = logging.getLogger('bley')
+
+
+def listen_socket(address, port, backlog=50):
+    '''Create the listening socket which is shared by all workers.
+
+    @type  address: string
+    @param address: the address to listen on
+    @type  port: int
+    @param port: the port to listen on
+    @type  backlog: int
+    @param backlog: the length of the queue of pending connections
+    @rtype: C{socket.socket}
+    @return: a non-blocking, listening socket
+    '''
+    if ':' in address:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class AdoptedPortService(service.Service):
+    '''Serve factory on a listening socket inherited from the supervisor.'''
+
+    def __init__(self, fd, factory):
+        self.fd = fd
+        self.factory = factory
+        self.port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        sock = socket.socket(fileno=self.fd)
+        self.port = reactor.adoptStreamPort(sock.fileno(), sock.family,
+                                            self.factory)
+        # adoptStreamPort() works on a copy of the descriptor
+        sock.close()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            return self.port.stopListening()
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    '''Watch one worker process and tell the supervisor when it ended.'''
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+        self.ended.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    '''Run settings.workers bley processes on one shared listening socket.
+
+    The workers are started as "python -m bley.cli" with the socket passed
+    as an inherited file descriptor. Crashed workers are restarted after
+    RESTART_DELAY seconds, SIGHUP is forwarded to all workers and on
+    shutdown the workers are stopped with SIGTERM.
+    '''
+
+    RESTART_DELAY = 1
+
+    def __init__(self, settings, sock):
+        self.settings = settings
+        self.sock = sock
+        self.workers = {}
+
+    def startService(self):
+        service.Service.startService(self)
+        signal.signal(signal.SIGHUP, self.sighup_handler)
+        for worker_id in range(self.settings.workers):
+            self.spawn_worker(worker_id)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = []
+        for worker in list(self.workers.values()):
+            ended.append(worker.ended)
+            self.signal_worker(worker, 'TERM')
+        return defer.DeferredList(ended)
+
+    def worker_args(self, worker_id):
+        fd = self.sock.fileno()
+        args = [sys.executable, '-m', 'bley.cli',
+                '--worker-fd', str(fd), '--worker-id', str(worker_id)]
+        for conffile in self.settings.conffile or []:
+            args.extend(['-c', os.path.abspath(conffile)])
+        if self.settings.debug:
+            args.append('-d')
+        else:
+            args.append('-f')
+        if self.settings.verbose:
+            args.append('-v')
+        return args
+
+    def spawn_worker(self, worker_id):
+        fd = self.sock.fileno()
+        worker = WorkerProtocol(self, worker_id)
+        reactor.spawnProcess(worker, sys.executable,
+                             self.worker_args(worker_id), env=os.environ,
+                             childFDs={0: 0, 1: 1, 2: 2, fd: fd})
+        self.workers[worker_id] = worker
+        logger.info('Started worker %s (pid %s)' %
+                    (worker_id, worker.transport.pid))
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+        if not self.running:
+            return
+        logger.warning('Worker %s exited (%s), restarting' %
+                       (worker.worker_id, reason.getErrorMessage()))
+        reactor.callLater(self.RESTART_DELAY, self.restart_worker,
+                          worker.worker_id)
+
+    def restart_worker(self, worker_id):
+        if self.running and worker_id not in self.workers:
+            self.spawn_worker(worker_id)
+
+    def signal_worker(self, worker, signame):
+        try:
+            worker.transport.signalProcess(signame)
+        except error.ProcessExitedAlready:
+            pass
+
+    def sighup_handler(self, signum, frame):
+        reactor.callFromThread(self.reload_workers)
+
+    def reload_workers(self):
+        logger.info('Reloading workers')
+        for worker in list(self.workers.values()):
+            self.signal_worker(worker, 'HUP')
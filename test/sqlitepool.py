@@ -0,0 +1,50 @@
+import sqlite3
+from twisted.internet import defer
+
+SCHEMA = '''
+  CREATE TABLE bley_status (ip VARCHAR(39), status SMALLINT,
+    last_action TIMESTAMP, sender VARCHAR(254), recipient VARCHAR(254),
+    fail_count INT);
+  CREATE UNIQUE INDEX bley_status_key ON bley_status (ip, sender, recipient);
+  CREATE TABLE bley_log (logtime TIMESTAMP, ip VARCHAR(39),
+    sender VARCHAR(254), recipient VARCHAR(254), action VARCHAR(254),
+    check_dnswl INT, check_dnsbl INT, check_helo INT, check_dyn INT,
+    check_db INT, check_spf INT, check_s_eq_r INT, check_postmaster INT,
+    check_cache INT);
+  CREATE TABLE bley_stats (period TIMESTAMP NOT NULL,
+    category VARCHAR(32) NOT NULL, mails INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, category));
+'''
+
+
+class SQLitePool(object):
+    '''Runs interactions synchronously on an in-memory SQLite database
+    with the tables of bley, in place of an adbapi.ConnectionPool.
+
+    Set fail to let every interaction fail as if the database was gone.
+    '''
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript(SCHEMA)
+        self.transactions = 0
+        self.fail = False
+
+    def runInteraction(self, interaction, *args):
+        self.transactions += 1
+        if self.fail:
+            return defer.fail(Exception('database is gone'))
+        cursor = self.db.cursor()
+        try:
+            result = interaction(cursor, *args)
+            self.db.commit()
+            return defer.succeed(result)
+        except Exception:
+            self.db.rollback()
+            return defer.fail()
+
+    def count(self, table):
+        return self.db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def rows(self, table):
+        return self.db.execute('SELECT * FROM %s ORDER BY rowid' % table).fetchall()
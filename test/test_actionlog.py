@@ -0,0 +1,78 @@
+import os
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer
+from bley.actionlog import ActionLog
+from test.sqlitepool import SQLitePool
+
+
+class ActionLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SQLitePool()
+        self.settings = Values({'dbpool': self.pool, 'dbtype': 'sqlite3',
+                                'compact_ip': False,
+                                'verbose': False, 'log_queue_size': 3,
+                                'log_overflow': 'drop',
+                                'log_spill_file': self.mktemp()})
+        self.log = ActionLog(self.settings)
+
+    def _row(self, i):
+        return ('2014-07-31 12:00:00', '192.0.2.%i' % i, 'root@example.com',
+                'user@example.com', 'DUNNO', 0, 0, 0, 0, -1, 0, 0, 0, 0)
+
+    @defer.inlineCallbacks
+    def test_flush(self):
+        self.log.BATCH_SIZE = 2
+        for i in range(3):
+            self.log.append(self._row(i))
+        yield self.log.flush()
+        self.assertEqual(len(self.log), 0)
+        self.assertEqual(self.pool.rows('bley_log'), [self._row(i) for i in range(3)])
+        self.assertEqual(self.pool.transactions, 2)
+        self.assertEqual(self.log.stats()['written'], 3)
+
+    @defer.inlineCallbacks
+    def test_flush_compact_ip(self):
+        self.settings.compact_ip = True
+        self.log.append(self._row(1))
+        yield self.log.flush()
+        self.assertEqual(self.pool.rows('bley_log')[0][1], b'\xc0\x00\x02\x01')
+        self.assertEqual(self.pool.rows('bley_log')[0][2:], self._row(1)[2:])
+
+    @defer.inlineCallbacks
+    def test_flush_malformed_ip(self):
+        self.settings.compact_ip = True
+        self.log.append(self._row(1))
+        self.log.append(('2014-07-31 12:00:00', 'unknown') + self._row(2)[2:])
+        yield self.log.flush()
+        self.assertEqual(len(self.log), 0)
+        self.assertEqual([row[1] for row in self.pool.rows('bley_log')], [b'\xc0\x00\x02\x01'])
+        self.assertEqual(self.log.stats()['dropped'], 1)
+
+    def test_drop(self):
+        for i in range(5):
+            self.log.append(self._row(i))
+        self.assertEqual(len(self.log), 3)
+        self.assertEqual(self.log.stats()['dropped'], 2)
+
+    @defer.inlineCallbacks
+    def test_spill(self):
+        self.settings.log_overflow = 'spill'
+        for i in range(5):
+            self.log.append(self._row(i))
+        self.assertEqual(len(self.log), 3)
+        self.assertEqual(self.log.stats()['spilled'], 2)
+        yield self.log.flush()
+        self.assertEqual(self.pool.rows('bley_log'), [self._row(i) for i in range(5)])
+        self.assertFalse(os.path.exists(self.settings.log_spill_file))
+
+    @defer.inlineCallbacks
+    def test_failed_flush(self):
+        self.pool.fail = True
+        self.log.append(self._row(1))
+        yield self.log.flush()
+        self.assertEqual(len(self.log), 1)
+        self.pool.fail = False
+        yield self.log.flush()
+        self.assertEqual(self.pool.rows('bley_log'), [self._row(1)])
@@ -1,4 +1,6 @@
 from twisted.trial import unittest
+from optparse import Values
+from twisted.names import dns
 import bley.helpers
 import ipaddress
 
@@ -99,5 +101,45 @@ class BleyHelpersTestCase(unittest.TestCase):
             }
             self.assertEquals(bley.helpers.check_helo(params), 2)
 
+    def test_dns_ttl(self):
+        answers = [
+            dns.RRHeader('1.2.0.192.dnsbl.example', ttl=300,
+                         payload=dns.Record_A('127.0.0.2')),
+            dns.RRHeader('1.2.0.192.dnsbl.example', ttl=60,
+                         payload=dns.Record_A('127.0.0.3')),
+        ]
+        self.assertEqual(bley.helpers.dns_ttl(answers, []), 60)
+
+    def test_dns_ttl_negative(self):
+        soa = dns.RRHeader('dnsbl.example', type=dns.SOA, ttl=900,
+                           payload=dns.Record_SOA(minimum=120))
+        self.assertEqual(bley.helpers.dns_ttl([], [soa]), 120)
+        self.assertEqual(bley.helpers.dns_ttl([], []), 0)
+
+    def test_aggregate_ip(self):
+        self.assertEqual(bley.helpers.aggregate_ip('192.0.2.23', 24, 64), '192.0.2.0')
+        self.assertEqual(bley.helpers.aggregate_ip('192.0.2.23', 32, 64), '192.0.2.23')
+        self.assertEqual(bley.helpers.aggregate_ip('2001:db8:1:2:3::1', 24, 64),
+                         '2001:0db8:0001:0002:0000:0000:0000:0000')
+        self.assertEqual(bley.helpers.aggregate_ip('2001:db8::1', 24, 128), '2001:db8::1')
+        self.assertEqual(bley.helpers.aggregate_ip('unknown', 24, 64), 'unknown')
+
+    def test_pack_ip(self):
+        settings = Values({'compact_ip': True, 'dbtype': 'sqlite3'})
+        packed = bley.helpers.pack_ip(settings, '2001:db8::1')
+        self.assertEqual(len(packed), 16)
+        self.assertEqual(bley.helpers.unpack_ip(packed),
+                         '2001:0db8:0000:0000:0000:0000:0000:0001')
+        self.assertEqual(bley.helpers.pack_ip(settings, '192.0.2.1'),
+                         b'\xc0\x00\x02\x01')
+        settings.dbtype = 'pgsql'
+        self.assertEqual(bley.helpers.pack_ip(settings, '192.0.2.1'), '192.0.2.1')
+        settings.compact_ip = False
+        settings.dbtype = 'mysql'
+        self.assertEqual(bley.helpers.pack_ip(settings, '192.0.2.1'), '192.0.2.1')
+        self.assertEqual(bley.helpers.unpack_ip('192.0.2.1'), '192.0.2.1')
+        self.assertEqual(bley.helpers.unpack_ip('2001:db8::1'),
+                         '2001:0db8:0000:0000:0000:0000:0000:0001')
+
     def test_check_spf(self):
         raise unittest.SkipTest("SPF checks need a working network")
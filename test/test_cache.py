@@ -0,0 +1,67 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from bley.cache import Cache
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.cache = Cache(3, 60, clock=self.clock.seconds)
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+        self.cache.set('192.0.2.1')
+        self.assertEqual(self.cache.get('192.0.2.1'), True)
+        self.cache.set('192.0.2.2', 'bad')
+        self.assertEqual(self.cache.get('192.0.2.2'), 'bad')
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expiry(self):
+        self.cache.set('192.0.2.1')
+        self.cache.set('192.0.2.2', ttl=120)
+        self.clock.advance(60)
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+        self.assertEqual(self.cache.get('192.0.2.2'), True)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_zero_ttl(self):
+        cache = Cache(3, 0, clock=self.clock.seconds)
+        cache.set('192.0.2.1')
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        for i in range(1, 4):
+            self.cache.set('192.0.2.%i' % i)
+        self.cache.get('192.0.2.1')
+        self.cache.set('192.0.2.4')
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.cache.get('192.0.2.2'), None)
+        self.assertEqual(self.cache.get('192.0.2.1'), True)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_sweep(self):
+        self.cache.set('192.0.2.1')
+        self.cache.set('192.0.2.2', ttl=120)
+        self.clock.advance(90)
+        self.cache.sweep()
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_dump_load(self):
+        self.cache.set('192.0.2.1')
+        self.cache.set('192.0.2.2', ttl=120)
+        self.clock.advance(30)
+        self.assertEqual(self.cache.dump(),
+                         [('192.0.2.1', True, 30), ('192.0.2.2', True, 90)])
+        other = Cache(3, 60, clock=self.clock.seconds)
+        other.load(self.cache.dump(), max_ttl=60)
+        other.load([('192.0.2.3', True, 0)])
+        self.clock.advance(59)
+        self.assertEqual(other.get('192.0.2.1'), None)
+        self.assertEqual(other.get('192.0.2.2'), True)
+        self.assertEqual(other.get('192.0.2.3'), None)
+        self.clock.advance(1)
+        self.assertEqual(other.get('192.0.2.2'), None)
@@ -0,0 +1,75 @@
+import datetime
+import os
+import sqlite3
+from optparse import Values
+from twisted.trial import unittest
+from bley.bley import STATUS_QUERIES
+from bley.cli import create_db
+from bley.helpers import adapt_query_for_sqlite3
+
+# bley_status as created by versions without the unique key
+OLD_STATUS_TABLE = '''
+  CREATE TABLE bley_status (ip VARCHAR(39) NOT NULL,
+    status SMALLINT NOT NULL DEFAULT 1, last_action TIMESTAMP NOT NULL,
+    sender VARCHAR(254), recipient VARCHAR(254), fail_count INT DEFAULT 0);
+  CREATE INDEX bley_status_index ON bley_status (ip, sender, recipient);
+'''
+
+
+class CreateDbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        path = self.mktemp()
+        os.makedirs(path)
+        self.settings = Values({'database': sqlite3, 'dbtype': 'sqlite3',
+                                'dbsettings': {'database': os.path.join(path, 'bley.db'),
+                                               'detect_types': 1},
+                                'compact_ip': False, 'log_partitions': False,
+                                'log_flush_interval': 60,
+                                'dnswl_threshold': 1, 'dnsbl_threshold': 1,
+                                'rfc_threshold': 2})
+
+    def connect(self):
+        db = sqlite3.connect(**self.settings.dbsettings)
+        self.addCleanup(db.close)
+        return db
+
+    def indexes(self, db):
+        return [name for (name,) in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'bley_status'")]
+
+    def insert(self, db, ip, sender, recipient, status):
+        db.execute(adapt_query_for_sqlite3(STATUS_QUERIES['insert']),
+                   {'client_address': ip, 'sender': sender, 'recipient': recipient,
+                    'new_status': status, 'now': datetime.datetime.now()})
+        db.commit()
+
+    def test_new_db(self):
+        create_db(self.settings)
+        db = self.connect()
+        self.assertEqual(sorted(self.indexes(db)),
+                         ['bley_status_action_index', 'bley_status_key'])
+
+    def test_add_key(self):
+        db = self.connect()
+        db.executescript(OLD_STATUS_TABLE)
+        now = datetime.datetime.now()
+        rows = [('192.0.2.1', 2, 'a@example.com', 'b@example.com'),
+                ('192.0.2.1', 0, 'a@example.com', 'b@example.com'),
+                ('192.0.2.1', 1, 'a@example.com', 'b@example.com'),
+                ('192.0.2.2', 2, 'a@example.com', 'b@example.com'),
+                ('192.0.2.2', 2, 'a@example.com', 'b@example.com')]
+        db.executemany('INSERT INTO bley_status (ip, status, last_action, sender, recipient) VALUES (?, ?, ?, ?, ?)',
+                       [(ip, status, now, sender, recipient)
+                        for (ip, status, sender, recipient) in rows])
+        db.commit()
+        create_db(self.settings)
+        self.assertIn('bley_status_key', self.indexes(db))
+        self.assertNotIn('bley_status_index', self.indexes(db))
+        self.assertEqual(sorted(db.execute('SELECT ip, status FROM bley_status')),
+                         [('192.0.2.1', 0), ('192.0.2.2', 2)])
+        self.insert(db, '192.0.2.1', 'a@example.com', 'b@example.com', 2)
+        self.assertEqual(sorted(db.execute('SELECT ip, status FROM bley_status')),
+                         [('192.0.2.1', 0), ('192.0.2.2', 2)])
+        create_db(self.settings)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM bley_status').fetchone(), (2,))
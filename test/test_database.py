@@ -0,0 +1,163 @@
+import sqlite3
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from bley.bley import BleyPolicyFactory
+from bley.cache import Cache
+from bley.metrics import Metrics
+from bley.whitelist import Whitelist, NetworkWhitelist
+
+
+class FailingPool(object):
+    '''Fails the next C{failures} queries with an OperationalError.'''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.queries = []
+
+    def _run(self, query, params=None):
+        self.queries.append(query)
+        if self.failures:
+            self.failures -= 1
+            return defer.fail(sqlite3.OperationalError('database is gone'))
+        return defer.succeed([])
+
+    runQuery = _run
+    runOperation = _run
+
+
+class FakeFactory(BleyPolicyFactory):
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.clock = task.Clock()
+        self.db_available = True
+        self.db_reconnect_delay = 1
+        self.store = None
+        self.good_cache = Cache(10, 60)
+        self.bad_cache = Cache(10, 60)
+        self.metrics = Metrics()
+        self.exim_workaround = False
+        self.actions = []
+
+    def log_action(self, postfix_params, action, check_results):
+        self.actions.append(action)
+
+
+def fake_factory(pool):
+    settings = Values({'dbpool': pool, 'database': sqlite3,
+                       'dbtype': 'sqlite3', 'db_reconnect_max': 10,
+                       'db_failure_action': 'DEFER_IF_PERMIT db down',
+                       'whitelist_recipients': Whitelist(),
+                       'whitelist_clients': Whitelist(),
+                       'whitelist_clients_ip': NetworkWhitelist(),
+                       'aggregate_ipv4_prefix': 32,
+                       'aggregate_ipv6_prefix': 128,
+                       'compact_ip': False, 'verbose': False})
+    return FakeFactory(settings)
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FailingPool()
+        self.factory = fake_factory(self.pool)
+        self.clock = self.factory.clock
+
+    def _lose_connection(self):
+        failure = defer.fail(sqlite3.OperationalError('database is gone'))
+        failure.addErrback(self.factory.database_error)
+        self.assertFailure(failure, sqlite3.OperationalError)
+        return failure
+
+    def test_backoff(self):
+        self.pool.failures = 10
+        self._lose_connection()
+        self.assertFalse(self.factory.db_available)
+        delays = []
+        for i in range(5):
+            self.clock.advance(self.factory.db_reconnect_delay)
+            delays.append(self.factory.db_reconnect_delay)
+        self.assertEqual(delays, [2, 4, 8, 10, 10])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertFalse(self.factory.db_available)
+
+    def test_reconnect(self):
+        self.pool.failures = 2
+        self._lose_connection()
+        self.clock.advance(1)
+        self.clock.advance(2)
+        self.assertEqual(self.factory.db_reconnect_delay, 4)
+        self.clock.advance(4)
+        self.assertTrue(self.factory.db_available)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.pool.failures = 1
+        self._lose_connection()
+        self.assertEqual(self.factory.db_reconnect_delay, 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(),
+                         self.clock.seconds() + 1)
+
+    def test_lost_twice(self):
+        self.pool.failures = 1
+        self._lose_connection()
+        self._lose_connection()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_db_failure_action(self):
+        self.factory.db_available = False
+        policy = self.factory.buildProtocol(('127.0.0.1', 0))
+        transport = proto_helpers.StringTransport()
+        policy.makeConnection(transport)
+        for line in (b'sender=root@example.com', b'recipient=user@example.com',
+                     b'client_address=192.0.2.1', b'client_name=mx.example.com',
+                     b'helo_name=mx.example.com', b''):
+            policy.lineReceived(line)
+        self.assertEqual(transport.value(), b'action=DEFER_IF_PERMIT db down\n\n')
+        self.assertEqual(self.factory.actions, ['DEFER_IF_PERMIT db down'])
+        self.assertEqual(self.pool.queries, [])
+
+    def test_whitelisted_not_looked_up(self):
+        self.factory.settings.whitelist_recipients = Whitelist(['postmaster@'])
+        policy = self.factory.buildProtocol(('127.0.0.1', 0))
+        transport = proto_helpers.StringTransport()
+        policy.makeConnection(transport)
+        for line in (b'sender=root@example.com', b'recipient=postmaster@example.com',
+                     b'client_address=192.0.2.1', b'client_name=mx.example.com',
+                     b'helo_name=mx.example.com', b''):
+            policy.lineReceived(line)
+        self.assertEqual(transport.value(), b'action=DUNNO\n\n')
+        self.assertEqual(self.pool.queries, [])
+
+
+class SafeExecuteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FailingPool()
+        self.factory = fake_factory(self.pool)
+        self.clock = self.factory.clock
+        self.policy = self.factory.buildProtocol(('127.0.0.1', 0))
+
+    def test_retry(self):
+        self.pool.failures = 1
+        d = self.policy.safe_execute('SELECT status FROM bley_status WHERE ip=%(ip)s',
+                                     {'ip': '192.0.2.1'}, fetch=True)
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(self.pool.queries,
+                         ['SELECT status FROM bley_status WHERE ip=:ip'] * 2)
+        self.assertTrue(self.factory.db_available)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_retry_failed(self):
+        self.pool.failures = 2
+        d = self.policy.safe_execute('DELETE FROM bley_status')
+        self.failureResultOf(d, sqlite3.OperationalError)
+        self.assertEqual(len(self.pool.queries), 2)
+        self.assertFalse(self.factory.db_available)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_other_error(self):
+        self.pool.runOperation = lambda query, params: defer.fail(ValueError())
+        d = self.policy.safe_execute('DELETE FROM bley_status')
+        self.failureResultOf(d, ValueError)
+        self.assertTrue(self.factory.db_available)
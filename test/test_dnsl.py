@@ -0,0 +1,52 @@
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from bley.bley import BleyPolicyFactory
+
+
+class FakeFactory(BleyPolicyFactory):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class DNSLTestCase(unittest.TestCase):
+
+    def setUp(self):
+        settings = Values({'dnsbls': ['fast.example', 'slow.example',
+                                      'never.example'],
+                           'dnswls': [], 'dnsl_timeout': 0.5})
+        self.policy = FakeFactory(settings).buildProtocol(('127.0.0.1', 0))
+        self.lookups = {}
+        self.calls = []
+        self.policy.check_dnsl = self._check_dnsl
+
+    def tearDown(self):
+        for call in self.calls:
+            if call.active():
+                call.cancel()
+
+    def _check_dnsl(self, lst, ip):
+        d = defer.Deferred()
+        self.lookups[lst] = d
+        if lst == 'fast.example':
+            self.calls.append(reactor.callLater(0, d.callback, (['127.0.0.2'], [], [])))
+        elif lst == 'slow.example':
+            self.calls.append(reactor.callLater(0.1, d.callback, (['127.0.0.2'], [], [])))
+        return d
+
+    @defer.inlineCallbacks
+    def test_threshold(self):
+        listed = yield self.policy.check_dnsbls('192.0.2.1', 1)
+        self.assertEqual(listed, 1)
+        self.assertTrue(self.lookups['never.example'].called)
+
+    @defer.inlineCallbacks
+    def test_deadline(self):
+        listed = yield self.policy.check_dnsbls('192.0.2.1', 3)
+        self.assertEqual(listed, 2)
+
+    @defer.inlineCallbacks
+    def test_no_lists(self):
+        listed = yield self.policy.check_dnswls('192.0.2.1', 1)
+        self.assertEqual(listed, 0)
@@ -0,0 +1,139 @@
+import csv
+import datetime
+import json
+import os
+import sqlite3
+import sys
+from twisted.trial import unittest
+from bley.graph import (export_csv, export_json, load_state, main, output_files,
+                        save_state, series, TIMESLOTS)
+from bley.stats import categories, hour_start
+
+
+class StateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.source = {'log': False, 'thresholds': [1, 1, 2]}
+        self.period = datetime.datetime(2014, 7, 31, 12, 0, 0)
+
+    def test_roundtrip(self):
+        hour = datetime.timedelta(0, 60 * 60, 0)
+        counters = [(self.period, 'ham', 3), (self.period + hour, 'spam', 1)]
+        save_state(self.filename, self.source, self.period + hour, counters, {'ar-12h.png': 'abc'})
+        until, loaded, digests = load_state(self.filename, self.source)
+        self.assertEqual(until, self.period + hour)
+        self.assertEqual(loaded, counters[:1])
+        self.assertEqual(digests, {'ar-12h.png': 'abc'})
+
+    def test_other_source(self):
+        save_state(self.filename, self.source, self.period, [])
+        self.assertEqual(load_state(self.filename, {'log': True, 'thresholds': [1, 1, 2]}),
+                         (None, [], {}))
+
+    def test_missing(self):
+        self.assertEqual(load_state(self.filename, self.source), (None, [], {}))
+
+
+class SeriesTestCase(unittest.TestCase):
+
+    def test_series(self):
+        end = datetime.datetime(2014, 7, 31, 12, 0, 0)
+        hour = datetime.timedelta(0, 60 * 60, 0)
+        counters = [(end - hour, 'ham', 3), (end - 2 * hour, 'ham', 1),
+                    (end - 2 * hour, 'in DNSBL', 2), (end - 24 * hour, 'spam', 5),
+                    (end, 'ham', 7)]
+        data = series(counters, end, categories(1, 1, 2), TIMESLOTS[1])
+        self.assertEqual(data['dates'][:2], [end, end - 2 * hour])
+        self.assertEqual(data['ham'], [4] + [0] * 11)
+        self.assertEqual(data['spam'], [0] * 11 + [5])
+        self.assertEqual(data['checks'][0], ('in DNSBL', 'black', [2] + [0] * 11))
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.destdir = self.mktemp()
+        os.mkdir(self.destdir)
+        end = datetime.datetime(2014, 7, 31, 12, 0, 0)
+        counters = [(end - datetime.timedelta(0, 60 * 60, 0), 'spam', 2),
+                    (end - datetime.timedelta(0, 60 * 60, 0), 'bad HELO', 2)]
+        self.timeslots = [(s, series(counters, end, categories(1, 1, 2), s))
+                          for s in TIMESLOTS[:2]]
+
+    def test_json(self):
+        files = export_json(self.destdir, self.timeslots)
+        with open(files[0]) as f:
+            stats = json.load(f)
+        self.assertEqual(sorted(stats), ['12h', '24h'])
+        self.assertEqual(stats['12h']['dates'][0], '2014-07-31 12:00:00')
+        self.assertEqual(stats['12h']['spam'], [2] + [0] * 11)
+        self.assertEqual(stats['24h']['checks']['bad HELO'], [2] + [0] * 11)
+
+    def test_csv(self):
+        files = export_csv(self.destdir, self.timeslots)
+        self.assertEqual([os.path.basename(f) for f in files], ['stats-12h.csv', 'stats-24h.csv'])
+        with open(files[0]) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0][:4], ['date', 'ham', 'spam', 'in DNSBL'])
+        self.assertEqual(rows[1][:5], ['2014-07-31 12:00:00', '0', '2', '0', '2'])
+        self.assertEqual(len(rows), 13)
+
+
+class SkipUnchangedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.destdir = os.path.abspath(self.mktemp())
+        os.mkdir(self.destdir)
+        dbname = os.path.join(self.destdir, 'bley.db')
+        db = sqlite3.connect(dbname)
+        db.execute('CREATE TABLE bley_stats (period TIMESTAMP, category VARCHAR(32), mails INT)')
+        period = hour_start(datetime.datetime.now()) - datetime.timedelta(0, 60 * 60, 0)
+        db.execute("INSERT INTO bley_stats VALUES(?, 'spam', 2)", (str(period),))
+        db.commit()
+        db.close()
+        self.conffile = os.path.join(self.destdir, 'bley.conf')
+        with open(self.conffile, 'w') as f:
+            f.write('[bley]\ndbtype = sqlite3\ndbname = %s\n' % dbname)
+
+    def run_main(self, fmt):
+        self.patch(sys, 'argv', ['bleygraph', '-c', self.conffile, '-d', self.destdir,
+                                 '-F', fmt, '-j', '1', '-q', '-s'])
+        main()
+
+    def mark(self, names):
+        for name in names:
+            with open(os.path.join(self.destdir, name), 'w') as f:
+                f.write('old')
+
+    def read(self, name):
+        with open(os.path.join(self.destdir, name), 'rb') as f:
+            return f.read()
+
+    def test_output_files(self):
+        self.assertEqual(output_files('png', TIMESLOTS[0]), ['ar-12h.png', 'ch-12h.png'])
+        self.assertEqual(output_files('csv', TIMESLOTS[0]), ['stats-12h.csv'])
+        self.assertEqual(output_files('json', TIMESLOTS[0]), ['stats.json'])
+
+    def test_csv(self):
+        self.run_main('csv')
+        self.mark(['stats-12h.csv', 'stats-24h.csv'])
+        os.remove(os.path.join(self.destdir, 'stats-7d.csv'))
+        self.run_main('csv')
+        self.assertEqual(self.read('stats-12h.csv'), b'old')
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, 'stats-7d.csv')))
+        # the digests of the csv files do not count for stats.json
+        self.run_main('json')
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, 'stats.json')))
+
+    def test_png(self):
+        try:
+            import matplotlib  # noqa: F401
+        except ImportError:
+            raise unittest.SkipTest('matplotlib is not installed')
+        self.run_main('png')
+        self.mark(['ch-12h.png', 'ar-24h.png', 'ch-24h.png'])
+        os.remove(os.path.join(self.destdir, 'ar-12h.png'))
+        self.run_main('png')
+        self.assertNotEqual(self.read('ch-12h.png'), b'old')
+        self.assertEqual(self.read('ch-24h.png'), b'old')
@@ -0,0 +1,52 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from bley.metrics import Histogram, Metrics
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram()
+        for value in (0.0001, 0.001, 0.3, 20):
+            histogram.observe(value)
+        buckets = dict(histogram.buckets())
+        self.assertEqual(buckets['0.0005'], 1)
+        self.assertEqual(buckets['0.001'], 2)
+        self.assertEqual(buckets['0.25'], 2)
+        self.assertEqual(buckets['0.5'], 3)
+        self.assertEqual(buckets['10'], 3)
+        self.assertEqual(buckets['+Inf'], 4)
+        self.assertEqual(histogram.count, 4)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = Metrics(clock=self.clock.seconds)
+
+    def test_timer(self):
+        with self.metrics.timer('dnsbl'):
+            self.clock.advance(0.02)
+        self.assertEqual(self.metrics.stages['dnsbl'].count, 1)
+        self.assertEqual(self.metrics.stages['dnsbl'].sum, 0.02)
+
+    def test_timer_exception(self):
+        def failing():
+            with self.metrics.timer('db'):
+                raise ValueError()
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(self.metrics.stages['db'].count, 1)
+
+    def test_render(self):
+        self.metrics.decision('new', -1.5)
+        self.metrics.collectors.append(
+            lambda: [('bley_cache_entries', 'gauge', 'Entries in the caches.',
+                      [({'cache': 'good'}, 3)])])
+        text = self.metrics.render()
+        self.assertIn('# TYPE bley_decision_duration_seconds histogram\n', text)
+        self.assertIn('bley_decision_duration_seconds_bucket{path="new",le="2.5"} 1\n', text)
+        self.assertIn('bley_decision_duration_seconds_bucket{path="new",le="1"} 0\n', text)
+        self.assertIn('bley_decision_duration_seconds_count{path="new"} 1\n', text)
+        self.assertIn('bley_stage_duration_seconds_count{stage="spf"} 0\n', text)
+        self.assertIn('# TYPE bley_cache_entries gauge\nbley_cache_entries{cache="good"} 3\n', text)
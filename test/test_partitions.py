@@ -0,0 +1,143 @@
+import datetime
+import sqlite3
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import task
+from bley.partitions import LogPartitions, next_month
+
+START = datetime.datetime(2014, 12, 15, 12, 0, 0)
+
+
+def datetime_clock(clock):
+    '''Return the time of the task.Clock clock as datetime, from START.'''
+    return lambda: START + datetime.timedelta(seconds=clock.seconds())
+
+
+def advance_to(clock, now):
+    '''Advance the task.Clock clock to the datetime now.'''
+    clock.advance((now - START).total_seconds() - clock.seconds())
+
+
+class LogPartitionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.settings = Values({'dbtype': 'sqlite3', 'purge_log_days': 0})
+        self.partitions = LogPartitions(self.settings, clock=datetime_clock(self.clock))
+
+    def test_bounds(self):
+        self.assertEqual(self.partitions.bounds('bley_log_201412'),
+                         (datetime.datetime(2014, 12, 1), datetime.datetime(2015, 1, 1)))
+        self.assertEqual(self.partitions.bounds('bley_log_before_201412'),
+                         (None, datetime.datetime(2014, 12, 1)))
+        self.assertEqual(self.partitions.bounds('bley_log_index'), None)
+        self.assertEqual(next_month(datetime.datetime(2014, 11, 30)),
+                         datetime.datetime(2014, 12, 1))
+
+    def test_plan(self):
+        create, drop = self.partitions.plan(['bley_log_before_201412'])
+        self.assertEqual(create, [datetime.datetime(2014, 12, 1), datetime.datetime(2015, 1, 1)])
+        self.assertEqual(drop, [])
+        create, drop = self.partitions.plan(['bley_log_201412', 'bley_log_201501'])
+        self.assertEqual(create, [])
+        self.settings.purge_log_days = 20
+        advance_to(self.clock, datetime.datetime(2015, 1, 25))
+        create, drop = self.partitions.plan(['bley_log_201412', 'bley_log_201501'])
+        self.assertEqual(create, [datetime.datetime(2015, 2, 1)])
+        self.assertEqual(drop, ['bley_log_201412'])
+
+
+class SQLiteLogPartitionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.settings = Values({'dbtype': 'sqlite3', 'purge_log_days': 40})
+        self.partitions = LogPartitions(self.settings, clock=datetime_clock(self.clock))
+        self.db = sqlite3.connect(':memory:')
+        self.db.executescript('''
+          CREATE TABLE IF NOT EXISTS bley_log
+          (
+            logtime TIMESTAMP NOT NULL, ip VARCHAR(39) NOT NULL,
+            sender VARCHAR(254), recipient VARCHAR(254), action VARCHAR(254),
+            check_dnswl INT DEFAULT 0, check_dnsbl INT DEFAULT 0,
+            check_helo INT DEFAULT 0, check_dyn INT DEFAULT 0,
+            check_db INT DEFAULT 0, check_spf INT DEFAULT 0,
+            check_s_eq_r INT DEFAULT 0, check_postmaster INT DEFAULT 0,
+            check_cache INT DEFAULT 0
+          );
+          CREATE INDEX IF NOT EXISTS bley_log_index
+           ON bley_log (logtime DESC, action ASC);
+        ''')
+        self.insert('2014-11-20 10:00:00')
+
+    def insert(self, logtime):
+        self.db.execute("INSERT INTO bley_log (logtime, ip, action) VALUES(?, '192.0.2.1', 'DUNNO')",
+                        (logtime,))
+
+    def count(self, table):
+        return self.db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+    def tables(self):
+        return [row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+    def test_maintain(self):
+        # bley_log already holds rows of the month it is partitioned in
+        self.insert('2014-12-10 08:00:00')
+        self.assertEqual(self.partitions.maintain(self.db.cursor()), [])
+        self.assertEqual(self.tables(), ['bley_log_201501', 'bley_log_before_201501'])
+        self.assertEqual(self.count('bley_log_before_201501'), 2)
+        self.insert('2014-12-15 12:00:00.123456')
+        self.insert('2015-01-01 00:00:00')
+        self.insert('2015-03-01 00:00:00')
+        self.assertEqual(self.count('bley_log'), 5)
+        self.assertEqual(self.count('bley_log_before_201501'), 3)
+        self.assertEqual(self.count('bley_log_201501'), 2)
+
+        # the rows of December are kept for purge_log_days
+        advance_to(self.clock, datetime.datetime(2015, 1, 15))
+        self.assertEqual(self.partitions.maintain(self.db.cursor()), [])
+        self.assertEqual(self.tables(), ['bley_log_201501', 'bley_log_201502',
+                                         'bley_log_before_201501'])
+        self.assertEqual(self.count('bley_log'), 5)
+        self.insert('2015-02-02 00:00:00')
+        self.assertEqual(self.count('bley_log_201502'), 1)
+
+        advance_to(self.clock, datetime.datetime(2015, 2, 10))
+        self.assertEqual(self.partitions.maintain(self.db.cursor()),
+                         ['bley_log_before_201501'])
+        self.assertEqual(self.tables(), ['bley_log_201501', 'bley_log_201502',
+                                         'bley_log_201503'])
+        self.assertEqual(self.count('bley_log'), 3)
+
+
+class RecordingCursor(object):
+    '''Records the queries and answers them from a list of results.'''
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((' '.join(query.split()), params))
+
+    def fetchone(self):
+        return self.results.pop(0)[0]
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+
+class PostgreSQLLogPartitionsTestCase(unittest.TestCase):
+
+    def test_convert(self):
+        clock = task.Clock()
+        settings = Values({'dbtype': 'pgsql', 'purge_log_days': 0})
+        partitions = LogPartitions(settings, clock=datetime_clock(clock))
+        txn = RecordingCursor([[('r',)], [('bley_log_before_201501',)]])
+        partitions.maintain(txn)
+        attach = [params for query, params in txn.queries if 'ATTACH PARTITION' in query]
+        self.assertEqual(attach, [(datetime.datetime(2015, 1, 1),)])
+        created = [query.split()[2] for query, params in txn.queries
+                   if query.startswith('CREATE TABLE') and 'PARTITION OF' in query]
+        self.assertEqual(created, ['bley_log_201501'])
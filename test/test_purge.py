@@ -0,0 +1,62 @@
+import datetime
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer
+from bley.purge import Purger
+from test.sqlitepool import SQLitePool
+
+
+class PurgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SQLitePool()
+        self.settings = Values({'dbpool': self.pool, 'dbtype': 'sqlite3',
+                                'verbose': False, 'purge_days': 40,
+                                'purge_bad_days': 10, 'purge_log_days': 0,
+                                'purge_batch_size': 2, 'log_partitions': False})
+        self.purger = Purger(self.settings)
+        self.purger.BATCH_PAUSE = 0
+        now = datetime.datetime.now()
+        for i, (days, status) in enumerate(((50, 0), (45, 2), (20, 2), (20, 0), (1, 2), (41, 0))):
+            self.pool.db.execute('INSERT INTO bley_status VALUES(?, ?, ?, ?, ?, 0)',
+                                 ('192.0.2.%i' % i, status,
+                                  str(now - datetime.timedelta(days)),
+                                  'root@example.com', 'user@example.com'))
+        for days in (1, 20, 40):
+            self.pool.db.execute('INSERT INTO bley_log (logtime, ip) VALUES(?, ?)',
+                                 (str(now - datetime.timedelta(days)), '192.0.2.1'))
+        self.pool.db.commit()
+
+    @defer.inlineCallbacks
+    def test_purge_status(self):
+        yield self.purger.purge()
+        self.assertEqual(self.pool.count('bley_status'), 2)
+        self.assertEqual(self.pool.count('bley_log'), 3)
+        self.assertEqual(self.purger.deleted, 4)
+        # two full batches and an empty one, and one for bley_stats
+        self.assertEqual(self.pool.transactions, 4)
+
+    @defer.inlineCallbacks
+    def test_purge_log(self):
+        self.settings.purge_log_days = 10
+        yield self.purger.purge()
+        self.assertEqual(self.pool.count('bley_log'), 1)
+        self.assertEqual(self.purger.deleted, 6)
+
+    @defer.inlineCallbacks
+    def test_purge_stats(self):
+        now = datetime.datetime.now()
+        for days in (1, 300, 400):
+            self.pool.db.execute('INSERT INTO bley_stats VALUES(?, ?, 1)',
+                                 (str(now - datetime.timedelta(days)), 'ham'))
+        self.pool.db.commit()
+        yield self.purger.purge()
+        self.assertEqual(self.pool.count('bley_stats'), 2)
+        self.assertEqual(self.purger.deleted, 5)
+
+    @defer.inlineCallbacks
+    def test_purge_failed(self):
+        self.pool.db.execute('DROP TABLE bley_status')
+        yield self.purger.purge()
+        self.assertFalse(self.purger.running)
+        self.assertEqual(self.purger.deleted, 0)
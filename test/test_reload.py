@@ -0,0 +1,136 @@
+import os
+import signal
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from bley import cli
+from bley.bley import parse_config
+
+CONFIG = '''[bley]
+listen_port = 1337
+dbname = bley.db
+cache_valid = %(cache_valid)s
+dnsbl_threshold = %(dnsbl_threshold)s
+db_failure_action = %(db_failure_action)s
+whitelist_recipients_file = whitelist_recipients
+whitelist_clients_file = whitelist_clients
+'''
+
+
+class FakeFactory(object):
+
+    def __init__(self):
+        self.changes = 0
+
+    def settings_changed(self):
+        self.changes += 1
+
+
+class ReloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.confdir = self.mktemp()
+        os.makedirs(self.confdir)
+        self.conffile = os.path.join(self.confdir, 'bley.conf')
+        self.write_config()
+        with open(os.path.join(self.confdir, 'whitelist_recipients'), 'w') as f:
+            f.write('postmaster@\n')
+        with open(os.path.join(self.confdir, 'whitelist_clients'), 'w') as f:
+            f.write('example.com\n192.0.2.0/24\n')
+        self.settings = Values({'conffile': [self.conffile],
+                                'confdir': self.confdir,
+                                'listen_port': 1337,
+                                'dbsettings': {'database': 'bley.db'}})
+        cli.read_policy_config(self.settings, parse_config(self.settings.conffile))
+        self.factory = FakeFactory()
+
+    def write_config(self, cache_valid=60, dnsbl_threshold=1,
+                     db_failure_action='DUNNO'):
+        with open(self.conffile, 'w') as f:
+            f.write(CONFIG % {'cache_valid': cache_valid,
+                              'dnsbl_threshold': dnsbl_threshold,
+                              'db_failure_action': db_failure_action})
+
+    def test_read_policy_config(self):
+        self.assertEqual(self.settings.cache_valid, 60)
+        self.assertEqual(self.settings.db_failure_action, 'DUNNO')
+        self.assertEqual(self.settings.whitelist_recipients.match('postmaster@example.org'),
+                         'postmaster@')
+        self.assertNotEqual(self.settings.whitelist_clients.match('mx.example.com'), None)
+        self.assertEqual(self.settings.whitelist_clients_file,
+                         os.path.join(self.confdir, 'whitelist_clients'))
+
+    def test_invalid_failure_action(self):
+        self.write_config(db_failure_action='REJECT')
+        self.assertRaises(ValueError, cli.read_policy_config, Values(),
+                          parse_config(self.settings.conffile))
+
+    @defer.inlineCallbacks
+    def test_reload(self):
+        dbsettings = self.settings.dbsettings
+        self.settings.listen_port = 1338
+        self.write_config(cache_valid=120, dnsbl_threshold=3,
+                          db_failure_action='defer')
+        yield cli.reload_config(self.settings, self.factory)
+        self.assertEqual(self.settings.cache_valid, 120)
+        self.assertEqual(self.settings.dnsbl_threshold, 3)
+        self.assertEqual(self.settings.db_failure_action,
+                         'DEFER_IF_PERMIT greylisted, try again later')
+        self.assertIdentical(self.settings.dbsettings, dbsettings)
+        self.assertEqual(self.settings.listen_port, 1338)
+        self.assertEqual(self.factory.changes, 1)
+
+    @defer.inlineCallbacks
+    def test_reload_keeps_other_settings(self):
+        self.write_config(cache_valid=120)
+
+        def parse(conffile):
+            # changed by the reactor while the files are parsed
+            self.settings.db_available = False
+            self.settings.listen_port = 1338
+            return parse_config(conffile)
+        self.patch(cli, 'parse_config', parse)
+        yield cli.reload_config(self.settings, self.factory)
+        self.assertEqual(self.settings.cache_valid, 120)
+        self.assertFalse(self.settings.db_available)
+        self.assertEqual(self.settings.listen_port, 1338)
+
+    @defer.inlineCallbacks
+    def test_reload_failed(self):
+        self.write_config(cache_valid='many', dnsbl_threshold=3)
+        yield cli.reload_config(self.settings, self.factory)
+        self.assertEqual(self.settings.cache_valid, 60)
+        self.assertEqual(self.settings.dnsbl_threshold, 1)
+        self.assertEqual(self.factory.changes, 0)
+
+    def _patch_reload(self):
+        reloads = []
+        self.patch(cli, 'reload_config',
+                   lambda settings, factory: reloads.append((settings, factory)))
+        return reloads
+
+    def test_reload_interval(self):
+        reloads = self._patch_reload()
+        clock = task.Clock()
+        self.settings.reload_interval = 5
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.getsignal(signal.SIGHUP))
+        checker = cli.install_reload_handler(self.settings, self.factory, clock)
+        self.addCleanup(checker.stop)
+        clock.advance(5)
+        self.assertEqual(reloads, [])
+        mtime = os.stat(self.settings.whitelist_clients_file).st_mtime
+        os.utime(self.settings.whitelist_clients_file, (mtime + 10, mtime + 10))
+        clock.advance(5)
+        self.assertEqual(reloads, [(self.settings, self.factory)])
+        clock.advance(5)
+        self.assertEqual(len(reloads), 1)
+
+    @defer.inlineCallbacks
+    def test_sighup(self):
+        reloads = self._patch_reload()
+        self.settings.reload_interval = 0
+        self.addCleanup(signal.signal, signal.SIGHUP, signal.getsignal(signal.SIGHUP))
+        self.assertEqual(cli.install_reload_handler(self.settings, self.factory), None)
+        signal.getsignal(signal.SIGHUP)(signal.SIGHUP, None)
+        yield task.deferLater(reactor, 0, lambda: None)
+        self.assertEqual(reloads, [(self.settings, self.factory)])
@@ -0,0 +1,123 @@
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import task
+from bley.bley import BleyPolicyFactory
+from bley.sharedcache import SharedVerdictCache, GOOD, BAD
+
+
+class FakeFactory(BleyPolicyFactory):
+
+    def __init__(self, settings, shared_cache):
+        self.settings = settings
+        self.shared_cache = shared_cache
+
+
+class SharedVerdictCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.path = self.mktemp()
+        self.cache = self.open(64)
+
+    def open(self, slots):
+        cache = SharedVerdictCache(self.path, slots, 60, clock=self.clock.seconds)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+        self.cache.set('192.0.2.1', GOOD)
+        self.cache.set('2001:db8::1', BAD)
+        self.assertEqual(self.cache.get('192.0.2.1'), GOOD)
+        self.assertEqual(self.cache.get('2001:db8::1'), BAD)
+        self.assertEqual(self.cache.get('::ffff:192.0.2.1'), GOOD)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalid_address(self):
+        self.cache.set('unknown', GOOD)
+        self.assertEqual(self.cache.get('unknown'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expiry(self):
+        self.cache.set('192.0.2.1', GOOD)
+        self.cache.set('192.0.2.2', GOOD, ttl=120)
+        self.clock.advance(60)
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+        self.assertEqual(self.cache.get('192.0.2.2'), GOOD)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_overwrite_and_delete(self):
+        self.cache.set('192.0.2.1', GOOD)
+        self.cache.set('192.0.2.1', BAD)
+        self.assertEqual(self.cache.get('192.0.2.1'), BAD)
+        self.assertEqual(len(self.cache), 1)
+        self.cache.delete('192.0.2.1')
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+
+    def test_shared_between_instances(self):
+        other = self.open(64)
+        self.cache.set('192.0.2.1', BAD)
+        self.assertEqual(other.get('192.0.2.1'), BAD)
+
+    def test_resize_resets(self):
+        self.cache.set('192.0.2.1', BAD)
+        other = self.open(128)
+        self.assertEqual(other.get('192.0.2.1'), None)
+        # the old table is replaced, not truncated under the running process
+        self.assertEqual(self.cache.get('192.0.2.1'), BAD)
+        self.assertEqual(self.open(128).get('192.0.2.1'), None)
+        other.set('192.0.2.2', GOOD)
+        self.assertEqual(self.open(128).get('192.0.2.2'), GOOD)
+
+    def test_full_table(self):
+        cache = SharedVerdictCache(self.mktemp(), 4, 60, clock=self.clock.seconds)
+        self.addCleanup(cache.close)
+        for i in range(10):
+            cache.set('192.0.2.%d' % i, GOOD)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.get('192.0.2.9'), GOOD)
+        self.assertEqual(cache.stats()['evictions'], 6)
+
+    def test_torn_slot(self):
+        self.cache.set('192.0.2.1', GOOD)
+        for slot in range(self.cache.slots):
+            offset = self.cache._offset(slot)
+            if self.cache.mmap[offset + 16] != 0:
+                self.cache.mmap[offset + 17] = BAD
+        self.assertEqual(self.cache.get('192.0.2.1'), None)
+
+    def test_views(self):
+        good = self.cache.view(GOOD)
+        bad = self.cache.view(BAD)
+        good.set('192.0.2.1')
+        self.assertEqual(good.get('192.0.2.1'), True)
+        self.assertEqual(bad.get('192.0.2.1'), None)
+        bad.delete('192.0.2.1')
+        self.assertEqual(good.get('192.0.2.1'), True)
+        good.ttl = 10
+        self.assertEqual(self.cache.ttl, 10)
+        # an address has a single verdict, the last one stored
+        bad.set('192.0.2.1')
+        self.assertEqual(good.get('192.0.2.1'), None)
+        self.assertEqual(bad.get('192.0.2.1'), True)
+        self.assertEqual(len(good), 1)
+
+    def test_verdict_caches(self):
+        factory = FakeFactory(Values({'shared_cache_file': self.path}), self.cache)
+        self.cache.set('192.0.2.1', GOOD)
+        self.assertEqual([name for name, stats in factory.verdict_caches()], ['shared'])
+        self.assertEqual(factory.verdict_caches()[0][1]['size'], 1)
+
+    def test_count(self):
+        other = self.open(64)
+        self.cache.set('192.0.2.1', GOOD)
+        self.cache.set('192.0.2.2', GOOD, ttl=120)
+        other.set('192.0.2.2', BAD)
+        self.assertEqual(len(other), 2)
+        self.clock.advance(60)
+        self.assertEqual(other.get('192.0.2.1'), None)
+        self.assertEqual(len(self.cache), 1)
+        self.cache.delete('192.0.2.2')
+        self.assertEqual(len(other), 0)
+        self.assertEqual(self.cache.stats()['size'], 0)
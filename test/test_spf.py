@@ -0,0 +1,89 @@
+import threading
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.python.threadpool import ThreadPool
+import bley.helpers
+from bley.bley import BleyPolicyFactory
+from bley.cache import Cache
+
+
+class FakeFactory(BleyPolicyFactory):
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.clock = task.Clock()
+        self.spf_cache = Cache(10, 60)
+        self.spf_pool = ThreadPool(0, 1, 'bley-spf')
+
+
+class SPFTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = Values({'spf_timeout': 10, 'use_spf_guess': 0})
+        self.factory = FakeFactory(self.settings)
+        self.factory.spf_pool.start()
+        self.addCleanup(self.factory.spf_pool.stop)
+        self.policy = self.factory.buildProtocol(('127.0.0.1', 0))
+        self.calls = []
+        self.score = 1
+        self.release = threading.Event()
+        self.release.set()
+        self.addCleanup(self.release.set)
+        self.patch(bley.helpers, 'check_spf', self._check_spf)
+
+    def _check_spf(self, params, guess, timeout):
+        self.calls.append((threading.current_thread().name, params, guess, timeout))
+        self.release.wait()
+        return self.score
+
+    def _params(self, sender='root@example.com', helo_name='mx.example.com'):
+        return {'client_address': '192.0.2.1', 'sender': sender,
+                'recipient': 'user@example.com', 'helo_name': helo_name}
+
+    @defer.inlineCallbacks
+    def test_thread_pool(self):
+        score = yield self.policy.check_spf(self._params())
+        self.assertEqual(score, 1)
+        self.assertEqual(self.calls, [
+            (self.calls[0][0], {'client_address': '192.0.2.1',
+                                'sender': 'root@example.com',
+                                'helo_name': 'mx.example.com'}, 0, 10)])
+        self.assertIn('bley-spf', self.calls[0][0])
+
+    @defer.inlineCallbacks
+    def test_cache(self):
+        yield self.policy.check_spf(self._params())
+        self.assertEqual(self.factory.spf_cache.get(('192.0.2.1', 'example.com',
+                                                     'mx.example.com')), 1)
+        self.score = 0
+        score = yield self.policy.check_spf(self._params(sender='other@example.com'))
+        self.assertEqual(score, 1)
+        self.assertEqual(len(self.calls), 1)
+        score = yield self.policy.check_spf(self._params(helo_name='mail.example.com'))
+        self.assertEqual(score, 0)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_timeout(self):
+        self.release.clear()
+        d = self.policy.check_spf(self._params())
+        self.factory.clock.advance(9)
+        self.assertNoResult(d)
+        self.factory.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(self.factory.spf_cache.get(('192.0.2.1', 'example.com',
+                                                     'mx.example.com')), None)
+
+    @defer.inlineCallbacks
+    def test_no_timeout(self):
+        for timeout in (0, -1):
+            self.settings.spf_timeout = timeout
+            self.factory.spf_cache.entries.clear()
+            self.release.clear()
+            d = self.policy.check_spf(self._params())
+            self.factory.clock.advance(3600)
+            self.assertNoResult(d)
+            self.release.set()
+            score = yield d
+            self.assertEqual(score, 1)
+            self.assertEqual(self.calls[-1][3], 0)
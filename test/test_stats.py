@@ -0,0 +1,102 @@
+import datetime
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer
+from bley.actionlog import ActionLog
+from bley.stats import StatsRollup, categories, classify, count_log, hour_start
+from test.sqlitepool import SQLitePool
+
+
+class StatsRollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SQLitePool()
+        self.settings = Values({'dbpool': self.pool, 'dbtype': 'sqlite3',
+                                'log_flush_interval': 1,
+                                'dnswl_threshold': 1, 'dnsbl_threshold': 1,
+                                'rfc_threshold': 2})
+        self.rollup = StatsRollup(self.settings)
+        self.logtime = datetime.datetime(2014, 7, 31, 12, 34, 56)
+
+    def stats(self):
+        return dict(((period, category), mails)
+                    for (period, category, mails) in self.pool.rows('bley_stats'))
+
+    def _row(self, action, dnsbl=0, db=-1, cache=0):
+        return (str(self.logtime), '192.0.2.1', 'root@example.com',
+                'user@example.com', action, 0, dnsbl, 0, 0, db, 0, 0, 0, cache)
+
+    def test_classify(self):
+        category_defs = categories(1, 1, 2)
+        columns = dict(zip(ActionLog.COLUMNS, self._row('DEFER_IF_PERMIT', dnsbl=1)))
+        self.assertEqual(classify(columns, category_defs), ['spam', 'in DNSBL'])
+        columns = dict(zip(ActionLog.COLUMNS, self._row('DUNNO', db=0)))
+        self.assertEqual(classify(columns, category_defs), ['ham', 'known good'])
+        columns = dict(zip(ActionLog.COLUMNS, self._row('REJECT')))
+        self.assertEqual(classify(columns, category_defs), [])
+
+    @defer.inlineCallbacks
+    def test_flush(self):
+        self.rollup.add(self.logtime, self._row('DUNNO', cache=1))
+        self.rollup.add(self.logtime, self._row('DUNNO', cache=1))
+        yield self.rollup.flush()
+        self.rollup.add(self.logtime, self._row('DEFER_IF_PERMIT', dnsbl=1))
+        yield self.rollup.flush()
+        self.assertEqual(self.rollup.counters, {})
+        self.assertEqual(self.stats(), {
+            ('2014-07-31 12:00:00', 'ham'): 2,
+            ('2014-07-31 12:00:00', 'good cache'): 2,
+            ('2014-07-31 12:00:00', 'spam'): 1,
+            ('2014-07-31 12:00:00', 'in DNSBL'): 1,
+        })
+
+    def test_settings_changed(self):
+        period = hour_start(self.logtime)
+        self.settings.dnsbl_threshold = 2
+        self.rollup.add(self.logtime, self._row('DEFER_IF_PERMIT', dnsbl=1))
+        self.assertEqual(self.rollup.counters[(period, 'in DNSBL')], 1)
+        self.rollup.settings_changed()
+        self.rollup.add(self.logtime, self._row('DEFER_IF_PERMIT', dnsbl=1))
+        self.assertEqual(self.rollup.counters[(period, 'in DNSBL')], 1)
+        self.assertEqual(self.rollup.counters[(period, 'spam')], 2)
+
+    @defer.inlineCallbacks
+    def test_flush_failed(self):
+        self.pool.fail = True
+        self.rollup.add(self.logtime, self._row('DUNNO', db=2))
+        yield self.rollup.flush()
+        self.rollup.add(self.logtime, self._row('DUNNO', db=2))
+        self.pool.fail = False
+        yield self.rollup.flush()
+        self.assertEqual(self.stats(), {
+            ('2014-07-31 12:00:00', 'ham'): 2,
+            ('2014-07-31 12:00:00', 'good grey'): 2,
+        })
+
+    @defer.inlineCallbacks
+    def test_backfill(self):
+        rows = [self._row('DUNNO', cache=1), self._row('DUNNO', db=1),
+                self._row('DEFER_IF_PERMIT', dnsbl=2),
+                self._row('DEFER_IF_PERMIT', db=2), self._row('REJECT')]
+        self.pool.db.executemany('INSERT INTO bley_log VALUES(%s)' %
+                                 ', '.join(['?'] * len(ActionLog.COLUMNS)), rows)
+        yield self.pool.runInteraction(self.rollup.backfill)
+        for row in rows:
+            self.rollup.add(self.logtime, row)
+        expected = dict(((str(period), name), mails)
+                        for (period, name), mails in self.rollup.counters.items())
+        self.assertEqual(self.stats(), expected)
+
+    def test_count_log(self):
+        rows = [self._row('DUNNO', cache=1), self._row('DEFER_IF_PERMIT', dnsbl=2)]
+        self.logtime = datetime.datetime(2014, 7, 31, 13, 0, 0)
+        rows.append(self._row('DUNNO', cache=1))
+        self.pool.db.executemany('INSERT INTO bley_log VALUES(%s)' %
+                                 ', '.join(['?'] * len(ActionLog.COLUMNS)), rows)
+        counters = count_log(self.pool.db.cursor(), 'sqlite3', categories(1, 1, 2),
+                             end=datetime.datetime(2014, 7, 31, 13, 0, 0))
+        period = datetime.datetime(2014, 7, 31, 12, 0, 0)
+        self.assertEqual(sorted(counters), sorted([
+            (period, 'ham', 1), (period, 'good cache', 1),
+            (period, 'spam', 1), (period, 'in DNSBL', 1),
+        ]))
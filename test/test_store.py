@@ -0,0 +1,116 @@
+import datetime
+import ipaddress
+from optparse import Values
+from twisted.trial import unittest
+from twisted.internet import defer
+import bley.helpers
+from bley.store import TripletStore
+from test.sqlitepool import SQLitePool
+
+
+class TripletStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        settings = Values({'purge_days': 40, 'purge_bad_days': 10})
+        self.store = TripletStore(settings)
+        self.store.loaded = True
+        self.now = datetime.datetime.now()
+        self.params = {
+            'client_address': '192.0.2.1',
+            'sender': 'root@example.com',
+            'recipient': 'user@example.com',
+            'new_status': 2,
+            'now': self.now,
+        }
+
+    def test_lookup_unknown(self):
+        self.assertEqual(self.store.lookup(self.params), -1)
+
+    def test_insert(self):
+        self.store.update(self.params, 'insert')
+        self.assertEqual(self.store.lookup(self.params),
+                         (2, self.now, 0, 'root@example.com', 'user@example.com'))
+        self.assertEqual(len(self.store.dirty), 1)
+
+    def test_insert_existing(self):
+        self.store.update(self.params, 'insert')
+        self.params['new_status'] = 0
+        self.store.update(self.params, 'insert')
+        self.assertEqual(self.store.lookup(self.params)[0], 2)
+
+    def test_fail_and_ungrey(self):
+        self.store.update(self.params, 'insert')
+        self.store.update(self.params, 'fail')
+        self.store.update(self.params, 'fail')
+        self.assertEqual(self.store.lookup(self.params)[2], 2)
+        self.params['now'] = later = self.now + datetime.timedelta(0, 60)
+        self.store.update(self.params, 'ungrey')
+        self.assertEqual(self.store.lookup(self.params)[:3], (0, later, 2))
+
+    def test_update_unknown(self):
+        self.store.update(self.params, 'touch')
+        self.assertEqual(self.store.lookup(self.params), -1)
+        self.assertEqual(len(self.store.dirty), 0)
+
+    def test_purge(self):
+        self.params['now'] = self.now - datetime.timedelta(20)
+        self.store.update(self.params, 'insert')
+        self.params['client_address'] = '192.0.2.2'
+        self.params['new_status'] = 0
+        self.store.update(self.params, 'insert')
+        self.store.purge()
+        self.assertEqual(self.store.lookup(self.params)[0], 0)
+        self.params['client_address'] = '192.0.2.1'
+        self.assertEqual(self.store.lookup(self.params), -1)
+        self.assertEqual(len(self.store.dirty), 1)
+
+    @defer.inlineCallbacks
+    def test_flush(self):
+        pool = SQLitePool()
+        self.store.settings = Values({'dbpool': pool, 'dbtype': 'sqlite3',
+                                      'compact_ip': False})
+        self.store.update(self.params, 'insert')
+        self.params['client_address'] = '192.0.2.2'
+        self.params['new_status'] = 0
+        self.store.update(self.params, 'insert')
+        yield self.store.flush()
+        self.assertEqual(self.store.dirty, set())
+        self.assertEqual(sorted(pool.rows('bley_status')),
+                         [('192.0.2.1', 2, str(self.now), 'root@example.com', 'user@example.com', 0),
+                          ('192.0.2.2', 0, str(self.now), 'root@example.com', 'user@example.com', 0)])
+        # the changed tuple replaces its row, the unchanged one is not written
+        self.params['client_address'] = '192.0.2.1'
+        self.params['now'] = later = self.now + datetime.timedelta(0, 60)
+        self.store.update(self.params, 'fail')
+        self.store.update(self.params, 'ungrey')
+        yield self.store.flush()
+        self.assertEqual(sorted(pool.rows('bley_status')),
+                         [('192.0.2.1', 0, str(later), 'root@example.com', 'user@example.com', 1),
+                          ('192.0.2.2', 0, str(self.now), 'root@example.com', 'user@example.com', 0)])
+        self.assertEqual(pool.transactions, 2)
+        yield self.store.flush()
+        self.assertEqual(pool.transactions, 2)
+
+    @defer.inlineCallbacks
+    def test_flush_failed(self):
+        pool = SQLitePool()
+        pool.fail = True
+        self.store.settings = Values({'dbpool': pool, 'dbtype': 'sqlite3',
+                                      'compact_ip': False})
+        self.store.update(self.params, 'insert')
+        yield self.store.flush()
+        self.assertEqual(len(self.store.dirty), 1)
+        pool.fail = False
+        yield self.store.flush()
+        self.assertEqual(pool.count('bley_status'), 1)
+        self.assertEqual(self.store.dirty, set())
+
+    def test_load_compact_ipv6(self):
+        settings = Values({'compact_ip': True, 'dbtype': 'sqlite3'})
+        exploded = ipaddress.ip_address('2001:db8::1').exploded
+        rows = [(bley.helpers.pack_ip(settings, exploded), 'root@example.com',
+                 'user@example.com', 0, self.now, 0)]
+        self.store.triplets = {}
+        self.store._loaded(rows)
+        self.params['client_address'] = exploded
+        self.assertEqual(self.store.lookup(self.params)[0], 0)
@@ -0,0 +1,131 @@
+import ipaddress
+import re
+from twisted.trial import unittest
+from bley.whitelist import Whitelist, NetworkWhitelist
+
+
+def linear_match(email, whitelist):
+    '''The original linear whitelist check, used as reference.'''
+    for entry_wl in whitelist:
+        if not isinstance(entry_wl, str):
+            if entry_wl.search(email) is not None:
+                return 1
+            continue
+        if entry_wl.endswith('@'):
+            if email.startswith(entry_wl):
+                return 1
+            continue
+        if len(email) > len(entry_wl):
+            entry_wl_length = len(entry_wl) + 1
+            if ('.' + entry_wl) == email[-entry_wl_length:]:
+                return 1
+            elif ('@' + entry_wl) == email[-entry_wl_length:]:
+                return 1
+        if entry_wl == email:
+            return 1
+    return 0
+
+
+class WhitelistTestCase(unittest.TestCase):
+
+    entries = [
+        'user@example.com',
+        'postmaster@',
+        'a@b@',
+        'dontgreylist.test',
+        'mail.wlclient.test',
+        re.compile('app.*example'),
+        re.compile('^important\\.(customer|partner)\\.test$'),
+        re.compile('(?i)CASE\\.test'),
+        re.compile('(x)\\1\\.test'),
+    ]
+    emails = [
+        'user@example.com',
+        'other@example.com',
+        'user@example.com.evil.test',
+        'postmaster@anything.test',
+        'postmaster.evil@anything.test',
+        'a@b@c.test',
+        'user@dontgreylist.test',
+        'user@subdomain.dontgreylist.test',
+        'user@xxxxdontgreylist.test',
+        'dontgreylist.test',
+        'sub.dontgreylist.test',
+        'greylist.test',
+        'mail.wlclient.test',
+        'other.mail.wlclient.test',
+        'wlclient.test',
+        'user@application.example',
+        'important.customer.test',
+        'very.important.customer.test',
+        'host.case.test',
+        'xx.test',
+        'x.test',
+        '',
+    ]
+
+    def setUp(self):
+        self.whitelist = Whitelist(self.entries)
+
+    def test_same_as_linear(self):
+        for email in self.emails:
+            self.assertEqual(self.whitelist.match(email) is not None,
+                             linear_match(email, self.entries) == 1, email)
+
+    def test_rule(self):
+        self.assertEqual(self.whitelist.match('user@sub.dontgreylist.test'),
+                         'dontgreylist.test')
+        self.assertEqual(self.whitelist.match('postmaster@example.net'),
+                         'postmaster@')
+        self.assertEqual(self.whitelist.match('important.partner.test'),
+                         '^important\\.(customer|partner)\\.test$')
+
+    def test_empty(self):
+        self.assertEqual(Whitelist().match('user@example.com'), None)
+
+    def test_conflicting_regex(self):
+        whitelist = Whitelist([re.compile('(?P<n>a)'), re.compile('(?P<n>b)')])
+        self.assertEqual(whitelist.match('b'), '(?P<n>b)')
+        self.assertEqual(len(whitelist), 2)
+
+
+class NetworkWhitelistTestCase(unittest.TestCase):
+
+    networks = [
+        '192.0.2.200/30',
+        '192.0.2.0/24',
+        '198.51.100.7/32',
+        '2001:db8::/32',
+        '2001:db8:1::/48',
+    ]
+
+    def setUp(self):
+        self.whitelist = NetworkWhitelist(
+            [ipaddress.ip_network(n) for n in self.networks])
+
+    def _match(self, ip):
+        net = self.whitelist.match(ipaddress.ip_address(ip))
+        return str(net) if net is not None else None
+
+    def test_len(self):
+        self.assertEqual(len(self.whitelist), 5)
+
+    def test_longest_prefix(self):
+        self.assertEqual(self._match('192.0.2.202'), '192.0.2.200/30')
+        self.assertEqual(self._match('192.0.2.1'), '192.0.2.0/24')
+        self.assertEqual(self._match('2001:db8:1::1'), '2001:db8:1::/48')
+        self.assertEqual(self._match('2001:db8:2::1'), '2001:db8::/32')
+
+    def test_host(self):
+        self.assertEqual(self._match('198.51.100.7'), '198.51.100.7/32')
+        self.assertEqual(self._match('198.51.100.8'), None)
+
+    def test_no_match(self):
+        self.assertEqual(self._match('203.0.113.1'), None)
+        self.assertEqual(self._match('2001:db9::1'), None)
+        self.assertEqual(NetworkWhitelist().match(ipaddress.ip_address('192.0.2.1')), None)
+
+    def test_default_route(self):
+        whitelist = NetworkWhitelist([ipaddress.ip_network('0.0.0.0/0')])
+        self.assertEqual(str(whitelist.match(ipaddress.ip_address('203.0.113.1'))), '0.0.0.0/0')
+        self.assertEqual(whitelist.match(ipaddress.ip_address('2001:db8::1')), None)
@@ -0,0 +1,50 @@
+import socket
+import sys
+from optparse import Values
+from twisted.trial import unittest
+from bley.workers import WorkerSupervisor, listen_socket
+
+
+class ListenSocketTestCase(unittest.TestCase):
+
+    def test_ipv4(self):
+        sock = listen_socket('127.0.0.1', 0)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertNotEqual(sock.getsockname()[1], 0)
+
+    def test_ipv6(self):
+        if not socket.has_ipv6:
+            raise unittest.SkipTest('no IPv6 support')
+        try:
+            sock = listen_socket('::1', 0)
+        except socket.error:
+            raise unittest.SkipTest('could not bind to ::1')
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.family, socket.AF_INET6)
+
+
+class WorkerSupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = listen_socket('127.0.0.1', 0)
+        self.addCleanup(self.sock.close)
+        self.settings = Values({'workers': 2, 'conffile': ['/etc/bley/bley.conf'],
+                                'debug': False, 'verbose': False})
+
+    def test_worker_args(self):
+        supervisor = WorkerSupervisor(self.settings, self.sock)
+        fd = str(self.sock.fileno())
+        self.assertEqual(supervisor.worker_args(1),
+                         [sys.executable, '-m', 'bley.cli',
+                          '--worker-fd', fd, '--worker-id', '1',
+                          '-c', '/etc/bley/bley.conf', '-f'])
+
+    def test_worker_args_debug(self):
+        self.settings.debug = True
+        self.settings.verbose = True
+        self.settings.conffile = None
+        supervisor = WorkerSupervisor(self.settings, self.sock)
+        args = supervisor.worker_args(0)
+        self.assertEqual(args[-2:], ['-d', '-v'])
+        self.assertNotIn('-c', args)